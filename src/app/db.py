@@ -1,15 +1,138 @@
 import os
+import time
+import contextvars
+import itertools
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from sqlmodel import SQLModel
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncEngine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncEngine, AsyncConnection
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError, DBAPIError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import text
+
+from fastapi import Depends
+
+from app.logger import logger
 
 load_dotenv()
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# реплики только для чтения через запятую, без них get_read_session отдает сессию основной базы
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+DB_REPLICA_STRATEGY = os.environ.get("DB_REPLICA_STRATEGY", "round_robin")  # round_robin | least_connections
+# сколько секунд не обращаться к реплике после ошибки соединения
+DB_REPLICA_RETRY_AFTER = float(os.environ.get("DB_REPLICA_RETRY_AFTER", 5))
+
+# настройки пула соединений, max_connections в Postgres должно хватать на
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW) * количество воркеров * количество реплик
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() == "true"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # секунды ожидания свободного соединения
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # секунды, -1 - не пересоздавать соединения
+# кэш подготовленных выражений asyncpg, 0 - если перед базой стоит pgbouncer в режиме transaction
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 100))
+
+
+# время открытия новых соединений внутри текущего connect(), оно не считается ожиданием свободного соединения
+_connect_time: contextvars.ContextVar = contextvars.ContextVar("pool_connect_time", default=0.0)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который считает время ожидания свободного соединения, время открытия новых соединений и таймауты
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.connect_total = 0.0
+        creator = self._invoke_creator
+
+        def timed_creator(record):
+            started = time.perf_counter()
+            try:
+                return creator(record)
+            finally:
+                elapsed = time.perf_counter() - started
+                self.connects += 1
+                self.connect_total += elapsed
+                _connect_time.set(_connect_time.get() + elapsed)
+
+        self._invoke_creator = timed_creator
+
+    def connect(self):
+        started = time.perf_counter()
+        token = _connect_time.set(0.0)
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - started - _connect_time.get()
+            _connect_time.reset(token)
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+def make_engine(url: str, **kwargs) -> AsyncEngine:
+    """
+    Создает движок с настройками пула из переменных окружения, kwargs переопределяют их
+    """
+    url = make_url(url)
+    options = {"echo": DB_ECHO}
+    # у SQLite свой пул, настройки размера к нему не применяются
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            poolclass=InstrumentedPool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    options.update(kwargs)
+    return create_async_engine(url, **options)
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+def pool_stats(engine: AsyncEngine) -> dict:
+    """
+    Состояние пула соединений движка
+    """
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if hasattr(pool, "checkedout"):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, InstrumentedPool):
+        stats.update(
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_avg=pool.wait_total / (pool.checkouts or 1),
+            wait_max=pool.wait_max,
+            connects=pool.connects,
+            connect_avg=pool.connect_total / (pool.connects or 1),
+        )
+    return stats
+
+
+engine = make_engine(DATABASE_URL)
 async_session = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
@@ -20,4 +143,80 @@ async def init_db(engine: AsyncEngine):
 
 async def get_session():
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+replica_engines = [make_engine(url) for url in DATABASE_REPLICA_URLS]
+replica_sessions = [
+    sessionmaker(replica, class_=AsyncSession, expire_on_commit=False) for replica in replica_engines
+]
+_replica_counter = itertools.count()
+_replica_down_until: dict = {}  # индекс реплики -> время, до которого она считается недоступной
+
+def _replica_order() -> list:
+    """
+    Порядок, в котором пробуются реплики для очередного запроса
+    """
+    now = time.monotonic()
+    indexes = [i for i in range(len(replica_sessions)) if _replica_down_until.get(i, 0) <= now]
+    if not indexes:
+        return []
+    if DB_REPLICA_STRATEGY == "least_connections":
+        return sorted(indexes, key=lambda i: getattr(replica_engines[i].pool, "checkedout", lambda: 0)())
+    start = next(_replica_counter) % len(indexes)
+    return indexes[start:] + indexes[:start]
+
+async def get_read_session(primary: AsyncSession = Depends(get_session)):
+    """
+    Сессия для запросов только на чтение: реплика, а если реплик нет или все недоступны - сессия основной базы
+    текущего запроса (она не открывает соединение, пока не используется).
+    Данные на реплике могут отставать от основной базы
+    """
+    for index in _replica_order():
+        session = replica_sessions[index]()
+        try:
+            # соединение берется заранее, чтобы при недоступной реплике перейти к следующей
+            await session.connection()
+        except (DBAPIError, OSError) as e:
+            await session.close()
+            _replica_down_until[index] = time.monotonic() + DB_REPLICA_RETRY_AFTER
+            logger.warning(f"Реплика {index} недоступна: {e}")
+            continue
+        try:
+            yield session
+        finally:
+            await session.close()
+        return
+
+    yield primary
+
+def insert_ignore(table, dialect_name: str):
+    """
+    INSERT ... ON CONFLICT DO NOTHING для PostgreSQL и SQLite
+    """
+    if dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    raise ValueError(f"insert_ignore не поддерживается для {dialect_name}")
+
+@asynccontextmanager
+async def advisory_lock(conn: AsyncConnection, key: int):
+    """
+    Сессионная advisory-блокировка PostgreSQL, отдает True если блокировка получена.
+    Держится до выхода из контекста, переживает commit внутри него.
+    В других СУБД блокировки между процессами нет, считается что она всегда получена
+    """
+    if conn.dialect.name != "postgresql":
+        yield True
+        return
+
+    acquired = (await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": key})).scalar()
+    await conn.commit()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+            await conn.commit()
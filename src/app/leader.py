@@ -0,0 +1,187 @@
+"""
+Координация воркеров при запуске нескольких процессов (gunicorn, uvicorn --workers N).
+
+Создание схемы и ролей выполняется под блокировкой запуска: воркеры проходят ее по очереди, первый создает
+таблицы и роли, остальные видят, что все уже создано. Фоновые задачи выполняет только ведущий процесс -
+тот, кто получил блокировку ведущего. Остальные периодически пытаются ее получить и заменяют ведущий процесс,
+если он завершился.
+
+Блокировки - advisory lock PostgreSQL на выделенном соединении (работает и для воркеров на разных серверах),
+для SQLite - flock файла в LOCK_DIR (только воркеры на одном сервере)
+"""
+import asyncio
+import fcntl
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app.db import engine
+from app.logger import logger
+
+LOCK_DIR = os.environ.get("LOCK_DIR", tempfile.gettempdir())
+# как часто воркеры, не ставшие ведущими, пытаются получить блокировку, и ведущий проверяет, что она не потеряна
+LEADER_RETRY_INTERVAL = float(os.environ.get("LEADER_RETRY_INTERVAL", 15))
+
+STARTUP_LOCK_KEY = 7_200_001
+LEADER_LOCK_KEY = 7_200_002
+
+
+class ProcessLock:
+    """
+    Межпроцессная блокировка, которая держится до release или завершения процесса
+    """
+    def __init__(self, key: int, engine: AsyncEngine = engine, lock_dir: str = LOCK_DIR):
+        self.key = key
+        self.engine = engine
+        self.path = os.path.join(lock_dir, f"auth_api_{key}.lock")
+        self._conn: Optional[AsyncConnection] = None
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._conn is not None or self._fd is not None
+
+    async def acquire(self, blocking: bool = False) -> bool:
+        if self.held:
+            return True
+        if self.engine.dialect.name == "postgresql":
+            return await self._acquire_advisory(blocking)
+        return await self._acquire_file(blocking)
+
+    async def _acquire_advisory(self, blocking: bool) -> bool:
+        # сессионная блокировка принадлежит соединению, поэтому оно не возвращается в пул до release
+        conn = await self.engine.connect()
+        try:
+            if blocking:
+                await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": self.key})
+                acquired = True
+            else:
+                acquired = (await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key})).scalar()
+            await conn.commit()
+        except BaseException:
+            await conn.close()
+            raise
+        if not acquired:
+            await conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    async def _acquire_file(self, blocking: bool) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if blocking:
+                await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    async def is_held(self) -> bool:
+        """
+        Проверяет, что блокировка не потеряна (соединение с PostgreSQL, державшее ее, живо)
+        """
+        if self._conn is None:
+            return self._fd is not None
+        try:
+            await self._conn.execute(text("SELECT 1"))
+            await self._conn.commit()
+            return True
+        except (SQLAlchemyError, OSError):
+            await self._discard_connection()
+            return False
+
+    async def release(self):
+        if self._conn is not None:
+            try:
+                await self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+                await self._conn.commit()
+            except (SQLAlchemyError, OSError) as e:
+                # при закрытии соединения PostgreSQL снимет блокировку сам
+                logger.warning(f"Не удалось снять блокировку {self.key}: {e}")
+            await self._discard_connection()
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    async def _discard_connection(self):
+        conn, self._conn = self._conn, None
+        try:
+            await conn.close()
+        except (SQLAlchemyError, OSError):
+            pass
+
+
+@asynccontextmanager
+async def startup_lock(engine: AsyncEngine = engine):
+    """
+    Выполняет блок не больше чем в одном процессе одновременно (ожидая остальные)
+    """
+    lock = ProcessLock(STARTUP_LOCK_KEY, engine)
+    await lock.acquire(blocking=True)
+    try:
+        yield
+    finally:
+        await lock.release()
+
+
+async def _cancel(tasks: list):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _restart_if_done(task: asyncio.Task, job) -> asyncio.Task:
+    """
+    Перезапускает фоновую задачу ведущего, если она завершилась (упала с ошибкой или вернулась)
+    """
+    if not task.done():
+        return task
+    error = None if task.cancelled() else task.exception()
+    if error is not None:
+        logger.error(f"Фоновая задача {getattr(job, '__name__', job)} завершилась с ошибкой, перезапуск: {error!r}")
+    else:
+        logger.warning(f"Фоновая задача {getattr(job, '__name__', job)} завершилась, перезапуск")
+    return asyncio.create_task(job())
+
+
+async def run_as_leader(jobs: list, lock: Optional[ProcessLock] = None, retry_interval: float = LEADER_RETRY_INTERVAL):
+    """
+    Запускает jobs (функции без аргументов, возвращающие корутины), пока процесс держит блокировку ведущего.
+    Завершившиеся задачи перезапускаются при очередной проверке блокировки. Работает до отмены задачи, в которой запущена
+    """
+    lock = lock or ProcessLock(LEADER_LOCK_KEY)
+    tasks: list = []
+    try:
+        while True:
+            if not tasks:
+                try:
+                    acquired = await lock.acquire()
+                except (SQLAlchemyError, OSError) as e:
+                    logger.error(f"Не удалось получить блокировку ведущего процесса: {e}")
+                    acquired = False
+                if acquired:
+                    logger.info(f"Процесс {os.getpid()} стал ведущим и выполняет фоновые задачи")
+                    tasks = [asyncio.create_task(job()) for job in jobs]
+            elif not await lock.is_held():
+                logger.warning(f"Процесс {os.getpid()} потерял блокировку ведущего, фоновые задачи остановлены")
+                await _cancel(tasks)
+                tasks = []
+            else:
+                tasks = [_restart_if_done(task, job) for task, job in zip(tasks, jobs)]
+            await asyncio.sleep(retry_interval)
+    finally:
+        await _cancel(tasks)
+        await lock.release()
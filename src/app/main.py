@@ -1,33 +1,42 @@
-from fastapi import FastAPI
+import hashlib
+import json
+from fastapi import FastAPI, Request, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import AsyncSession
 import asyncio
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError, OperationalError, DatabaseError
 
-from app.worker import cleanup_expired_refresh_tokens
-from app.db import init_db, engine
+from app.worker import scheduler, SCHEDULER_MODE
+from app.db import init_db, engine, async_session, pool_stats
 from app.models.auth import UserAuthModel, RoleModel
 from app.routers.auth import router as auth_router
-from app.db import get_session
+from app.leader import startup_lock, run_as_leader
+from app.services.cache import get_cache_backend
+from app.services.hashers import shutdown_hasher_pool
+from app.services.auth import wait_password_rehash
+from app.services.sessions import session_activity
+from app.services.write_behind import login_writer, LOGIN_WRITE_BEHIND
+from app.metrics import PrometheusMiddleware, render_metrics
+from app.services.keys import get_key_ring, JWKS_MAX_AGE
+from app.services.roles import require_permissions
+from app.services.permissions import Permission
 from app.logger import logger
 
-# вызов функции для очистки невалидных токенов каждые 24 часа
-async def run_periodically():
-    while True:
-        await cleanup_expired_refresh_tokens()
-        await asyncio.sleep(60*60*24)
-
 async def create_default_roles(session: AsyncSession):
     """
-    создает основные роли в базе данных при запуске программы
+    создает основные роли в базе данных при запуске программы (только отсутствующие)
     """
     DEFAULT_ROLES = [
         {"name": "admin"},
         {"name": "moderator"},
         {"name": "user"}
     ]
+    existing = set((await session.execute(select(RoleModel.role))).scalars())
     for r in DEFAULT_ROLES:
+        if r["name"] in existing:
+            continue
         role_model = RoleModel(role=r["name"])
         session.add(role_model)
 
@@ -43,28 +52,41 @@ async def create_default_roles(session: AsyncSession):
         await session.rollback()
         logger.critical(f"Неожиданна ошибка{e}")
         raise
+    # реестр ролей процесса, по нему require_role проверяет роли без запросов к базе
+    await RoleModel.load_registry(session)
 
 # инициализация базы данных
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db(engine)
-    task = asyncio.create_task(run_periodically())
-    await create_default_roles(session=get_session)
+    # при нескольких воркерах схему и роли создает первый, остальные ждут и только загружают реестр ролей
+    async with startup_lock():
+        await init_db(engine)
+        async with async_session() as session:
+            await create_default_roles(session)
+    await get_cache_backend().start()
+    # время использования сессий записывается пачками, последняя пачка - при остановке
+    await session_activity.start()
+    if LOGIN_WRITE_BEHIND:
+        await login_writer.start()
+    # фоновые задачи выполняет ведущий воркер, если для них не запущен отдельный процесс (python -m app.worker)
+    task = asyncio.create_task(run_as_leader([scheduler.run])) if SCHEDULER_MODE == "inprocess" else None
     yield
 
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        logger.info("Периодическая задача остановлена")
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info("Планировщик остановлен")
+    await wait_password_rehash()
+    # входы, принятые до остановки, записываются до закрытия соединений
+    await login_writer.stop()
+    await session_activity.stop()
+    await get_cache_backend().stop()
+    shutdown_hasher_pool()
 
 app = FastAPI(lifespan=lifespan)
 
-async def run_periodically():
-    while True:
-        await cleanup_expired_refresh_tokens()
-        await asyncio.sleep(60)  # Запускать каждую минуту
-
 # настройка CORS
 app.add_middleware(
     CORSMiddleware,
@@ -74,8 +96,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# метрики Prometheus, подключается последним, чтобы время запроса включало остальные middleware
+app.add_middleware(PrometheusMiddleware)
+
 app.include_router(auth_router)
 
 @app.get("/")
 def read_root():
-    return {'Hello': 'World!'}
\ No newline at end of file
+    return {'Hello': 'World!'}
+
+@app.get("/health/pool")
+def read_pool_stats(_ = Depends(require_permissions(Permission.MANAGE_SETTINGS))):
+    """
+    Состояние пула соединений с базой данных: занятые соединения, overflow, время ожидания свободного соединения
+    и открытия новых. Раскрывает настройки и нагрузку базы, поэтому доступно только администраторам
+    """
+    return pool_stats(engine)
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    """
+    Метрики в формате Prometheus
+    """
+    data, content_type = render_metrics()
+    return Response(content=data, media_type=content_type)
+
+@app.get("/.well-known/jwks.json", include_in_schema=False)
+def read_jwks(request: Request):
+    """
+    Открытые ключи для проверки access токенов другими сервисами (пустой список при подписи HS256)
+    """
+    key_ring = get_key_ring()
+    body = json.dumps(key_ring.jwks() if key_ring is not None else {"keys": []}).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    headers = {"Cache-Control": f"public, max-age={JWKS_MAX_AGE}", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
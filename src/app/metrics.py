@@ -0,0 +1,120 @@
+"""
+Метрики Prometheus: количество и время запросов по маршрутам и время отдельных этапов авторизации.
+
+При запуске нескольких воркеров uvicorn/gunicorn нужно задать PROMETHEUS_MULTIPROC_DIR - пустой каталог,
+общий для всех воркеров (очищать перед запуском). Тогда /metrics собирает значения всех процессов
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# этапы внутри запроса короткие, поэтому бакеты начинаются с долей миллисекунды
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Количество HTTP запросов", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP запроса", ["method", "route"], buckets=STAGE_BUCKETS
+)
+AUTH_STAGE_DURATION = Histogram(
+    "auth_stage_duration_seconds", "Время этапов авторизации", ["stage"], buckets=STAGE_BUCKETS
+)
+HASHER_QUEUE_WAIT = Histogram(
+    "hasher_queue_wait_seconds", "Ожидание свободного воркера пула хэширования", buckets=STAGE_BUCKETS
+)
+HASHER_HASH_TIME = Histogram(
+    "hasher_hash_seconds", "Время хэширования или проверки пароля", buckets=STAGE_BUCKETS
+)
+HASHER_REJECTED = Counter(
+    "hasher_rejected_total", "Запросы, отклоненные из-за переполнения пула хэширования"
+)
+USER_CACHE_LOOKUPS = Counter(
+    "user_cache_lookups_total", "Обращения к кэшу пользователей в current_user", ["result"]
+)
+RATE_LIMIT_REJECTED = Counter(
+    "rate_limit_rejected_total", "Запросы, отклоненные ограничением частоты", ["scope"]
+)
+TOKEN_CLEANUP_REMOVED = Counter(
+    "token_cleanup_removed_total", "Удалено недействительных refresh токенов"
+)
+WRITE_BEHIND_BATCH_SIZE = Histogram(
+    "write_behind_batch_logins", "Входов, записанных одним коммитом отложенной записи",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+WRITE_BEHIND_REJECTED = Counter(
+    "write_behind_rejected_total", "Входы, отклоненные из-за переполнения очереди отложенной записи"
+)
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """
+    Засекает время блока и записывает его в auth_stage_duration_seconds, в том числе при исключении
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        AUTH_STAGE_DURATION.labels(stage).observe(time.perf_counter() - started)
+
+
+def _route_path(scope) -> str:
+    # шаблон маршрута (/users/{id}), а не реальный путь, чтобы не раздувать количество серий
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class PrometheusMiddleware:
+    """
+    ASGI middleware: считает запросы и время ответа по методу, шаблону маршрута и статусу
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = _route_path(scope)
+            HTTP_REQUEST_DURATION.labels(scope["method"], route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(scope["method"], route, str(status_code)).inc()
+
+
+def render_metrics() -> tuple:
+    """
+    Текст метрик для /metrics и его content type
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead(pid: int):
+    """
+    Для хука child_exit в gunicorn: удаляет файлы метрик завершившегося воркера
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
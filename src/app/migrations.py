@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+from datetime import datetime, timezone
+
+from jose import jwt, JWTError
+from sqlalchemy import inspect, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import SQLModel
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.db import engine, insert_ignore
+from app.models.auth import TokenModel
+from app.services.tokens import refresh_token_id
+from app.services.token_store import maintain_token_partitions, TOKEN_PARTITION_PERIOD, TOKEN_PARTITIONS_AHEAD_DAYS
+from app.logger import logger
+
+# python -m app.migrations
+# python -m app.migrations partition-tokens --period day  (PostgreSQL, затем TOKEN_STORE_BACKEND=sql_partitioned)
+
+
+async def add_missing_columns(engine: AsyncEngine) -> list:
+    """
+    Добавляет в существующие таблицы колонки, которые появились в моделях (create_all этого не делает).
+    Колонки NOT NULL без значения по умолчанию на сервере пропускаются. Возвращает список добавленных колонок
+    """
+    added = []
+    async with engine.begin() as conn:
+        existing = await conn.run_sync(
+            lambda sync_conn: {
+                table: {column["name"] for column in inspect(sync_conn).get_columns(table)}
+                for table in inspect(sync_conn).get_table_names()
+            }
+        )
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            for column in table.columns:
+                if column.name in existing[table.name]:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    logger.warning(f"Колонку {table.name}.{column.name} нужно добавить вручную")
+                    continue
+                column_type = column.type.compile(dialect=conn.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    default = conn.dialect.ddl_compiler(conn.dialect, None).get_column_default_string(column)
+                    if conn.dialect.name == "sqlite" and not isinstance(column.server_default.arg, str):
+                        # SQLite не добавляет колонку с вычисляемым значением по умолчанию (now()),
+                        # существующие строки получают значение, вычисленное один раз
+                        value = (await conn.execute(select(column.server_default.arg))).scalar()
+                        default = f"'{value}'"
+                    ddl += f" DEFAULT {default}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                await conn.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+                logger.info(f"Добавлена колонка {table.name}.{column.name}")
+                for index in table.indexes:
+                    if column.name in index.columns:
+                        await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+    return added
+
+
+async def add_missing_indexes(engine: AsyncEngine) -> list:
+    """
+    Создает индексы моделей, которых нет в существующих таблицах. Уникальный индекс не создается,
+    если в таблице уже есть нарушающие его строки (например, email, отличающиеся только регистром) -
+    их нужно исправить вручную. Возвращает список созданных индексов
+    """
+    created = []
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                # каждый индекс в своей транзакции, ошибка одного не откатывает остальные
+                async with engine.begin() as conn:
+                    missing = await conn.run_sync(
+                        lambda sync_conn: inspect(sync_conn).has_table(table.name)
+                        and not inspect(sync_conn).has_index(table.name, index.name)
+                    )
+                    if not missing:
+                        continue
+                    await conn.run_sync(lambda sync_conn: index.create(sync_conn))
+            except IntegrityError as e:
+                logger.error(f"Не удалось создать индекс {index.name}: {e}")
+                continue
+            created.append(index.name)
+            logger.info(f"Создан индекс {index.name}")
+    return created
+
+
+async def migrate_refresh_tokens(engine: AsyncEngine, batch_size: int = 1000) -> int:
+    """
+    Переносит refresh токены из старой схемы (полный JWT в индексируемой колонке token)
+    в новую, где ключ - sha256 от jti. Старые токены без jti продолжают работать,
+    их ключ считается от всего токена. Возвращает количество перенесенных строк
+    """
+    async with engine.begin() as conn:
+        columns = await conn.run_sync(
+            lambda sync_conn: [column["name"] for column in inspect(sync_conn).get_columns("tokenmodel")]
+        )
+        if "token" not in columns:
+            logger.info("Таблица tokenmodel уже в новой схеме, миграция не нужна")
+            return 0
+
+        await conn.execute(text("ALTER TABLE tokenmodel RENAME TO tokenmodel_legacy"))
+        # индексы старой таблицы освобождают имена для индексов новой
+        await conn.execute(text("DROP INDEX IF EXISTS ix_tokenmodel_token"))
+        await conn.execute(text("DROP INDEX IF EXISTS ix_tokenmodel_user_id"))
+        await conn.run_sync(TokenModel.__table__.create)
+
+        migrated = 0
+        last_id = 0
+        while True:
+            result = await conn.execute(
+                text(
+                    "SELECT id, token, user_id, invalidated FROM tokenmodel_legacy "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": batch_size},
+            )
+            rows = result.all()
+            if not rows:
+                break
+
+            values = []
+            for row in rows:
+                try:
+                    payload = jwt.get_unverified_claims(row.token)
+                except JWTError:
+                    logger.warning(f"Пропущен невалидный токен id={row.id}")
+                    continue
+                now = datetime.now(timezone.utc)
+                exp = payload.get("exp")
+                iat = payload.get("iat")
+                values.append({
+                    "token_hash": refresh_token_id(payload, row.token),
+                    "user_id": row.user_id,
+                    "issued_at": datetime.fromtimestamp(iat, timezone.utc) if iat else now,
+                    "expires_at": datetime.fromtimestamp(exp, timezone.utc) if exp else now,
+                    "invalidated": bool(row.invalidated),
+                })
+            if values:
+                # одинаковые токены в старой таблице схлопываются в одну строку,
+                # считаются только действительно вставленные
+                table = TokenModel.__table__
+                statement = insert_ignore(table, conn.dialect.name).values(values).returning(table.c.token_hash)
+                migrated += len((await conn.execute(statement)).all())
+            last_id = rows[-1].id
+            logger.info(f"Перенесено refresh токенов: {migrated}")
+
+        await conn.execute(text("DROP TABLE tokenmodel_legacy"))
+    return migrated
+
+
+async def partition_refresh_tokens(engine: AsyncEngine, period: str = TOKEN_PARTITION_PERIOD,
+                                   ahead_days: int = TOKEN_PARTITIONS_AHEAD_DAYS) -> int:
+    """
+    Переводит таблицу refresh токенов в секционированную по expires_at (только PostgreSQL),
+    после этого нужно запускать сервис с TOKEN_STORE_BACKEND=sql_partitioned.
+    Переносятся только действующие токены. Возвращает количество перенесенных строк
+    """
+    async with engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            raise RuntimeError("Секционирование таблицы токенов поддерживается только для PostgreSQL")
+        partitioned = (await conn.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'tokenmodel'::regclass)"
+        ))).scalar()
+        if partitioned:
+            logger.info("Таблица tokenmodel уже секционирована")
+            return 0
+
+        await conn.execute(text("ALTER TABLE tokenmodel RENAME TO tokenmodel_unpartitioned"))
+        # первичный ключ секционированной таблицы должен включать ключ секционирования
+        await conn.execute(text(
+            "CREATE TABLE tokenmodel (LIKE tokenmodel_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (expires_at)"
+        ))
+        await maintain_token_partitions(conn, period=period, ahead_days=ahead_days)
+        result = await conn.execute(text(
+            "INSERT INTO tokenmodel SELECT * FROM tokenmodel_unpartitioned WHERE expires_at > now()"
+        ))
+        await conn.execute(text("DROP TABLE tokenmodel_unpartitioned"))
+        # индексы создаются после переноса строк, имена освободились вместе со старой таблицей
+        await conn.execute(text("ALTER TABLE tokenmodel ADD PRIMARY KEY (token_hash, expires_at)"))
+        for index in TokenModel.__table__.indexes:
+            await conn.run_sync(lambda sync_conn: index.create(sync_conn))
+    logger.info(f"Таблица tokenmodel секционирована, перенесено токенов: {result.rowcount}")
+    return result.rowcount
+
+
+async def migrate(engine: AsyncEngine):
+    await migrate_refresh_tokens(engine)
+    await add_missing_columns(engine)
+    await add_missing_indexes(engine)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграции базы данных")
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "partition-tokens"])
+    parser.add_argument("--period", default=TOKEN_PARTITION_PERIOD, choices=["day", "week"])
+    args = parser.parse_args()
+    if args.command == "partition-tokens":
+        asyncio.run(partition_refresh_tokens(engine, args.period))
+    else:
+        asyncio.run(migrate(engine))
@@ -1,18 +1,53 @@
 import re
+from datetime import datetime, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import SQLModel, Field, Relationship
 from pydantic import field_validator, BaseModel
 from typing_extensions import Optional
-from sqlalchemy import select, update
+from sqlalchemy import select, update, func, text, false, Index, LargeBinary, DateTime
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 
-from app.services.hashers import make_password
+from app.services.hashers import make_password_async
+from app.services.cache import invalidate_user
+from app.services.role_registry import role_registry, user_role_name
+from app.services.permissions import permissions_for
 from app.logger import logger
 
 EMAIL_REGEX = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}"
 PASSWORD_REGEX = r"^(?=.*[a-z,A-Z])(?=.*\d)(?=.*[@$!%*#?&])[A-Za-z\d@$!%*#?&]{8,}$"
 
+
+# ограничения уникальности email: индекс lower(email) и UNIQUE (email) колонки.
+# PostgreSQL сообщает имя ограничения, SQLite - индекс или колонку
+EMAIL_UNIQUE_CONSTRAINTS = ("ux_userauthmodel_email_lower", "userauthmodel_email_key", "userauthmodel.email")
+# код PostgreSQL для нарушения уникальности
+UNIQUE_VIOLATION = "23505"
+
+
+class EmailAlreadyExistsError(Exception):
+    pass
+
+
+def is_email_conflict(error: IntegrityError) -> bool:
+    """
+    Нарушена уникальность email, а не другое ограничение (NOT NULL, внешний ключ и т.п.)
+    """
+    sqlstate = getattr(error.orig, "sqlstate", None)
+    if sqlstate is not None and sqlstate != UNIQUE_VIOLATION:
+        return False
+    # asyncpg передает имя ограничения в исходной ошибке, в остальных случаях оно есть в тексте
+    constraint = getattr(error.orig.__cause__, "constraint_name", None) or str(error.orig)
+    return any(name in constraint for name in EMAIL_UNIQUE_CONSTRAINTS)
+
+
+def normalize_email(email: str) -> str:
+    """
+    Email в виде, по которому проверяется уникальность и ищется пользователь при входе
+    """
+    return email.strip().lower()
+
 class RoleModel(SQLModel, table=True):
     """
     Набор разрешений, который определяет какие действия может выполнить пользователь.
@@ -20,17 +55,52 @@ class RoleModel(SQLModel, table=True):
     admin - Может иметь разрешения на создание, редактирование и удаление ресурсов.
     moderator - Включает разрешения на создание, редактирование и публикацию контента, но не на удаление пользователей или изменение настроек системы. 
     user - Имеет разрешение на просмотр ресурсов.
+    Разрешения ролей и их наследование описаны в app.services.permissions.
     """
     id: int = Field(default=None, primary_key=True)
     role: str = Field(default=None)
 
     users: list["UserAuthModel"] = Relationship(back_populates="role")
 
+    @classmethod
+    async def load_registry(cls, session: AsyncSession):
+        """
+        Загружает все роли в реестр ролей процесса (app.services.role_registry)
+        """
+        result = await session.execute(select(cls.id, cls.role))
+        role_registry.load(result.all())
+
+    @classmethod
+    async def get_id_by_name(cls, name: str, session: AsyncSession) -> Optional[int]:
+        """
+        id роли по имени: из реестра, а если роли там нет - из базы данных с добавлением в реестр
+        """
+        role_id = role_registry.id(name)
+        if role_id is None:
+            role_id = (await session.execute(select(cls.id).where(cls.role == name))).scalar_one_or_none()
+            if role_id is not None:
+                role_registry.add(role_id, name)
+        return role_id
+
 class TokenModel(SQLModel, table=True):
-    id: int = Field(default=None, primary_key=True)
-    token: str = Field(default=None, index=True)
+    """
+    Выданные refresh токены. Сам токен не хранится, ключ - sha256 от его jti (32 байта),
+    см. app.services.tokens.refresh_token_id.
+    При обновлении токен заменяется новым из того же семейства (family_id - ключ первого токена, выданного при входе),
+    повторное использование замененного токена отзывает все семейство. Замененные токены (rotated)
+    хранятся до истечения срока, остальные отозванные удаляются очисткой
+    """
+    token_hash: bytes = Field(sa_type=LargeBinary(32), primary_key=True)
     user_id: int = Field(index=True)
+    family_id: Optional[bytes] = Field(default=None, sa_type=LargeBinary(32), nullable=True, index=True)
+    # значение на сервере нужно, чтобы колонку можно было добавить в таблицу со старыми токенами (app.migrations)
+    issued_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True),
+        sa_column_kwargs={"server_default": func.now()},
+    )
+    expires_at: datetime = Field(sa_type=DateTime(timezone=True), index=True)
     invalidated: bool = Field(default=False)
+    rotated: bool = Field(default=False, sa_column_kwargs={"server_default": false()})
 
 
 class UserModel(SQLModel):
@@ -40,8 +110,8 @@ class UserModel(SQLModel):
     is_active: bool = Field(default=True)
     is_superuser: bool = Field(default=False)
 
-    def set_password(self, password: str):
-        self.password = make_password(password)
+    async def set_password(self, password: str):
+        self.password = await make_password_async(password)
     # функция для создания пользователя
     @classmethod
     async def create_user(cls, username:str, email:str, password:str, session: AsyncSession):
@@ -53,19 +123,20 @@ class UserModel(SQLModel):
         # создание объекта с валидацией
         user = cls.model_validate(user_data)
         # хэширование пароля
-        user.set_password(password)
+        await user.set_password(password)
         try:
-            check_email = await cls.email_exists(email=user_data["email"], session=session)
-            if check_email is True:
-                logger.error("Почта уже используется")
+            # занятый email определяется по уникальному индексу, без отдельного запроса перед вставкой
+            session.add(user)
+            await session.commit()
+            return user
+
+        except IntegrityError as e:
+            await session.rollback()
+            if not is_email_conflict(e):
+                logger.error(f"Ошибка целостности данных при создании пользователя: {e}")
                 raise
-            else:
-                #добавление пользователя в базу данных
-                session.add(user)
-                await session.commit()
-                await session.refresh(user)
-                return user
-            
+            logger.warning("Почта уже используется")
+            raise EmailAlreadyExistsError(email)
         except SQLAlchemyError as e:
             await session.rollback()
             logger.error(f"Ошибка базы данных: {e}", exc_info=True)
@@ -90,7 +161,7 @@ class UserModel(SQLModel):
         """
         Проверка существует ли пользователь с указанным email в базе данных
         """
-        statement = select(cls).where(cls.email==email)
+        statement = select(cls.id).where(func.lower(cls.email) == normalize_email(email))
         email_check = await session.execute(statement)
         result = email_check.scalar_one_or_none()
         return result is not None
@@ -104,8 +175,9 @@ class UserModel(SQLModel):
             user = update(UserAuthModel).where(UserAuthModel.id==user_id).values(username=new_username)
             await session.execute(user)
             await session.commit()
+            invalidate_user(user_id=user_id)
             return True
-        except IntegrityError:  # Перехват ошибки нарушения уникальности
+        except IntegrityError as e:  # Перехват ошибки нарушения уникальности
             await session.rollback()
             logger.warning(f"Ошибка уникальности при изменении username: {e}")
             return False 
@@ -124,15 +196,13 @@ class UserModel(SQLModel):
         Изменяет email пользователя по id
         """
         try:
-            if await UserAuthModel.email_exists(email=new_email, session=session):
-                return False
-            else:
-                user = update(UserAuthModel).where(UserAuthModel.id==user_id).values(email=new_email)
-                await session.execute(user)
-                await session.commit()
-                return True
-            
-        except IntegrityError:  # Перехват ошибки нарушения уникальности (если email уже существует)
+            user = update(UserAuthModel).where(UserAuthModel.id==user_id).values(email=new_email)
+            await session.execute(user)
+            await session.commit()
+            invalidate_user(user_id=user_id)
+            return True
+
+        except IntegrityError as e:  # Перехват ошибки нарушения уникальности (если email уже существует)
             await session.rollback()
             logger.warning(f"Ошибка уникальности при изменении email: {e}")
             return False 
@@ -159,25 +229,43 @@ class UserModel(SQLModel):
         return password
 
 class UserAuthModel(UserModel, table=True):
+    # email уникален без учета регистра, по этому индексу ищется пользователь при входе
+    __table_args__ = (Index("ux_userauthmodel_email_lower", text("lower(email)"), unique=True),)
+
     id: int = Field(default=None, primary_key=True)
 
     role_id: Optional[int] = Field(default=None, foreign_key="rolemodel.id", nullable=True)
     role: Optional[RoleModel] = Relationship(back_populates="users")
+    # увеличивается при смене роли или пароля, access токены со старой версией считаются устаревшими
+    token_version: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    # refresh токены, выданные до этого момента, недействительны (выход на всех устройствах)
+    tokens_valid_after: Optional[datetime] = Field(default=None, sa_type=DateTime(timezone=True), nullable=True)
 
     @classmethod
     async def set_role(cls, user_id: int, rol_name: str, session: AsyncSession):
         # Находим роль по имени
         try:
-            role_query = await session.execute(select(RoleModel).where(RoleModel.role == rol_name))
-            role = role_query.scalar_one_or_none()
+            role_id = await RoleModel.get_id_by_name(rol_name, session)
 
-            if role is None:
+            if role_id is None:
                 raise ValueError(f"Роль с именем '{rol_name}' не найдена")
 
             # Обновляем роль пользователя
-            user_update = update(cls).where(cls.id == user_id).values(role_id=role.id)
-            await session.execute(user_update)
+            user_update = (
+                update(cls)
+                .where(cls.id == user_id)
+                .values(role_id=role_id, token_version=cls.token_version + 1)
+                .returning(cls.token_version)
+            )
+            token_version = (await session.execute(user_update)).scalar_one_or_none()
             await session.commit()
+            # если пользователь уже загружен в сессию, обновляем у него связанную роль
+            # (объект роли берется из сессии, запрос к базе только если его там нет)
+            user = session.identity_map.get(identity_key(cls, user_id))
+            if user is not None:
+                set_committed_value(user, "role_id", role_id)
+                set_committed_value(user, "role", await session.get(RoleModel, role_id))
+            invalidate_user(user_id=user_id, token_version=token_version)
         except SQLAlchemyError as e:
             logger.error(f"Ошибка базы данных: {e}")
             raise
@@ -187,13 +275,24 @@ class UserAuthModel(UserModel, table=True):
     @classmethod
     async def check_user_role(cls, user_id: int, session: AsyncSession):
         try:
-        # нужно явно загрузить связанный объект. это можно сделать с помощью метода .options() и функции selectinload (или joinedload).
-            user = await session.execute(select(UserAuthModel).where(UserAuthModel.id==user_id).options(selectinload(UserAuthModel.role)))
-            user = user.scalar_one_or_none()
-            if user is None:
-                raise ValueError(f"Пользователь с ID {user_id} не найден")
+            # имя роли берется из реестра ролей, из базы читается только role_id пользователя,
+            # если пользователь еще не загружен в сессию
+            user = session.identity_map.get(identity_key(cls, user_id))
+            if user is not None:
+                role_id = user.role_id
+            else:
+                row = (await session.execute(select(cls.role_id).where(cls.id == user_id))).one_or_none()
+                if row is None:
+                    raise ValueError(f"Пользователь с ID {user_id} не найден")
+                role_id = row.role_id
+            if role_id is None:
+                return None
+            role_name = role_registry.name(role_id)
+            if role_name is None:
+                role_name = (await session.execute(select(RoleModel.role).where(RoleModel.id == role_id))).scalar_one()
+                role_registry.add(role_id, role_name)
             # возвращает имя роли
-            return user.role.role
+            return role_name
         
         except SQLAlchemyError as e:
             logger.error(f"Ошибка базы данных: {e}")
@@ -206,6 +305,53 @@ class CreateUserModel(UserModel):
     pass
 
 
+class UserClaims(BaseModel):
+    """
+    Данные пользователя из access токена, достаточные для авторизации без обращения к базе данных
+    """
+    id: int
+    email: str
+    role: Optional[str] = None
+    is_active: bool = True
+    is_superuser: bool = False
+    token_version: int = 0
+    # битовая маска app.services.permissions.Permission
+    permissions: int = 0
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "UserClaims":
+        role = payload.get("role")
+        is_superuser = payload.get("su", False)
+        permissions = payload.get("perm")
+        if permissions is None:
+            permissions = permissions_for(role, is_superuser)
+        return cls(
+            id=payload["uid"],
+            email=payload["sub"],
+            role=role,
+            is_active=payload.get("act", True),
+            is_superuser=is_superuser,
+            token_version=payload.get("ver", 0),
+            permissions=permissions,
+        )
+
+    @classmethod
+    def from_user(cls, user: "UserAuthModel") -> "UserClaims":
+        """
+        имя роли берется из реестра ролей, если его там нет - роль должна быть загружена заранее (joinedload)
+        """
+        role = user_role_name(user)
+        return cls(
+            id=user.id,
+            email=user.email,
+            role=role,
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+            token_version=user.token_version,
+            permissions=permissions_for(role, user.is_superuser),
+        )
+
+
 class ChangePasswordRequest(BaseModel):
     current_password: str
     new_password: str
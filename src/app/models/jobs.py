@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import DateTime
+from sqlmodel import SQLModel, Field
+
+
+class JobRunModel(SQLModel, table=True):
+    """
+    Последний запуск фоновой задачи (app.scheduler), по нему после перезапуска
+    вычисляется время следующего запуска
+    """
+    name: str = Field(primary_key=True, max_length=100)
+    last_started_at: Optional[datetime] = Field(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    last_finished_at: Optional[datetime] = Field(default=None, sa_type=DateTime(timezone=True), nullable=True)
+    last_status: Optional[str] = Field(default=None, max_length=20)  # running | ok | error | timeout
+    last_duration: Optional[float] = Field(default=None)  # секунды
+    last_error: Optional[str] = Field(default=None, max_length=1000)
@@ -0,0 +1,26 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import DateTime, Index, LargeBinary
+from sqlmodel import SQLModel, Field
+
+
+class SessionModel(SQLModel, table=True):
+    """
+    Сессия (устройство) пользователя: один вход и все refresh токены, выданные взамен первого.
+    id передается в refresh токене (claim sid), family_id - семейство токенов сессии (см. TokenModel).
+    last_used_at и expires_at обновляются при обновлении токена, но не сразу, а пачками (app.services.sessions)
+    """
+    # список сессий пользователя - диапазон этого индекса, отсортированный по сроку действия
+    __table_args__ = (Index("ix_sessionmodel_user_id_expires_at", "user_id", "expires_at"),)
+
+    id: str = Field(primary_key=True, max_length=32)
+    user_id: int
+    family_id: bytes = Field(sa_type=LargeBinary(32))
+    device: Optional[str] = Field(default=None, max_length=100)
+    ip: Optional[str] = Field(default=None, max_length=45)
+    user_agent: Optional[str] = Field(default=None, max_length=255)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+    last_used_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_type=DateTime(timezone=True))
+    # отдельный индекс для удаления истекших сессий всех пользователей
+    expires_at: datetime = Field(sa_type=DateTime(timezone=True), index=True)
@@ -1,6 +1,7 @@
-from fastapi import Depends, Response
+import codecs
+from fastapi import Depends, Request, Response, UploadFile, File, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.exc import SQLAlchemyError
 from fastapi import APIRouter, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
@@ -10,12 +11,23 @@ from pydantic import ValidationError
 
 
 from app.db import get_session
-from app.models.auth import UserAuthModel, CreateUserModel, TokenModel, ChangePasswordRequest
-from app.services.auth import login, current_user
-from app.services.tokens import refresh_access_token, get_refresh_token
-from app.services.hashers import get_password, make_password
+from app.models.auth import UserAuthModel, CreateUserModel, TokenModel, ChangePasswordRequest, EmailAlreadyExistsError
+from app.services.auth import login, current_user, current_user_claims
+from app.services.tokens import (
+    refresh_access_token, get_refresh_token, decode_refresh_token, refresh_token_id, refresh_token_expires_at,
+)
+from app.services.token_store import get_token_store, TokenStoreUnavailable
+from app.services.hashers import verify_password_async, make_password_async, hasher_pool, HasherBusyError
 from app.logger import logger
-from app.services.roles import require_role
+from app.services.roles import require_role, require_permissions
+from app.services.permissions import Permission
+from app.services.user_import import import_users, read_rows, detect_format, FORMATS
+from app.services.cache import invalidate_user
+from app.services.rate_limit import limit_login, limit_signup, RateLimitExceeded
+from app.services.sessions import (
+    client_info, list_sessions, session_info, revoke_session, end_session, end_all_sessions,
+    SESSIONS_PAGE_SIZE, SESSIONS_MAX_PAGE_SIZE,
+)
 
 router = APIRouter()
 
@@ -34,11 +46,24 @@ async def get_myself_info(current_user = Depends(current_user)) -> dict:
     return user_info
 
 
+def rate_limit_exception(e: RateLimitExceeded) -> HTTPException:
+    logger.warning(f"Превышен лимит запросов ({e.scope})")
+    return HTTPException(status_code=429, detail="Too many requests", headers={"Retry-After": str(e.retry_after)})
+
+
 @router.post('/signup')
-async def signup(user: CreateUserModel, session: AsyncSession=Depends(get_session)):
+async def signup(request: Request, user: CreateUserModel, session: AsyncSession=Depends(get_session)):
     try:
+        # лимит проверяется до хэширования пароля
+        await limit_signup(request)
         result_user = await UserAuthModel.create_user(username=user.username, email=user.email, password=user.password, session=session)
         return result_user
+    except RateLimitExceeded as e:
+        raise rate_limit_exception(e)
+    except EmailAlreadyExistsError:
+        raise HTTPException(status_code=409, detail="Email already registered")
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="Service unavailable", headers={"Retry-After": "1"})
     except SQLAlchemyError as e:
         await session.rollback()
         logger.error(f"Ошибка базы данных: {e}", exc_info=True)
@@ -51,23 +76,32 @@ async def signup(user: CreateUserModel, session: AsyncSession=Depends(get_sessio
 # возвращает слоаврь с JWT-токенами
 @router.post('/login')
 async def signin(
+    request: Request,
     response: Response,
     form_data: OAuth2PasswordRequestForm=Depends(),
     session: AsyncSession=Depends(get_session)) -> dict:
 
-    user = await login(form_data=form_data, db=session)
+    # попытки сверх лимита отклоняются до обращения к базе и проверки пароля
+    try:
+        await limit_login(request, form_data.username)
+    except RateLimitExceeded as e:
+        raise rate_limit_exception(e)
+    user = await login(form_data=form_data, db=session, client=client_info(request))
 
     # устанавливаем refresk_token в cookies
+    set_refresh_cookie(response, user["refresh_token"])
+    # access_token должен храниться в переменной JavaScript
+    return {'access_token': user['access_token']}
+
+def set_refresh_cookie(response: Response, refresh_token: str):
     response.set_cookie(
         key="refresh_token",
-        value=user["refresh_token"],
+        value=refresh_token,
         httponly=True, # Запрещаем доступ к cookie через JavaScript
         max_age=30 * 24 * 60 * 60,
         samesite='lax', # Защита от CSRF
         secure=True, # Использовать только через HTTPS
     )
-    # access_token должен храниться в переменной JavaScript
-    return {'access_token': user['access_token']}
 
 
 """
@@ -80,10 +114,15 @@ async def signin(
 """
 @router.post('/refresh_token')
 async def refresh_token(
+    response: Response,
     refresh_token: str = Depends(get_refresh_token),
     session: AsyncSession = Depends(get_session)
 ):
     new_access_token = await refresh_access_token(refresh_token, session)
+    # новый refresh токен (REFRESH_TOKEN_ROTATION) отдается только в cookie
+    new_refresh_token = new_access_token.pop('refresh_token', None)
+    if new_refresh_token is not None:
+        set_refresh_cookie(response, new_refresh_token)
     # возвращает access_token в котором access_token и token_type
     return {'access_token': new_access_token}
 
@@ -96,27 +135,29 @@ async def logout(
     """
     Выход из системы (отзыв конкретного refresh токена)
     """
-    # ищем refresh_token в базе данных
     try:
-        statement = select(TokenModel).where(TokenModel.token == refresh_token)
-        db_token = await session.execute(statement)
-        result = db_token.scalar_one_or_none()
-
-        if not result:
+        # помечаем токен как недействительный
+        payload = decode_refresh_token(refresh_token)
+        revoked = payload is not None and await get_token_store().revoke(
+            refresh_token_id(payload, refresh_token), session, token_expires_at=refresh_token_expires_at(payload),
+        )
+        if not revoked:
             raise HTTPException(
                 status_code=404, detail="Refresh token not found"
             )
-        
-        # помечаем токен как недействительный
-        result.invalidated = True
-        await session.commit()
-        await session.refresh(result)
+        if payload.get("sid"):
+            await end_session(payload["sid"], session)
         response.delete_cookie(key="refresh_token")
 
         headers = {"Cache-Control": "no-cache, no-store, must-revalidate", "Pragma": "no-cache", "Expires": "0"}
         content = {"message": "Logged out successfully"}
         return JSONResponse(content=content, headers=headers)
     
+    except HTTPException:
+        raise
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
     except SQLAlchemyError as e:
         await session.rollback()
         logger.error(f"Ошибка базы данных при изменении username: {e}", exc_info=True)
@@ -135,19 +176,20 @@ async def logout_all(
     """
     # поулчаем id текущего пользователя
     user_id = current_user.id
-    # находим все токены пользователя
     try:
-        statement = select(TokenModel).where(TokenModel.user_id == user_id)
-        refresh_token = await session.execute(statement)
-        result = refresh_token.scalars().all() # возвращает список
-        # помечаем токены как недействительные
-        for token in result:
-            token.invalidated = True
+        # помечаем все токены пользователя как недействительные
+        await get_token_store().revoke_all(user_id, session)
+        await end_all_sessions(user_id, session)
 
         headers = {"Cache-Control": "no-cache, no-store, must-revalidate", "Pragma": "no-cache", "Expires": "0"}
         content = {"message": "Logged out from all devices successfully"}
         return JSONResponse(content=content, headers=headers)
     
+    except HTTPException:
+        raise
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
     except SQLAlchemyError as e:
         await session.rollback()
         logger.error(f"Ошибка базы данных при изменении username: {e}", exc_info=True)
@@ -163,20 +205,117 @@ async def change_password(
     current_user = Depends(current_user),
     session: AsyncSession = Depends(get_session)
 ):
-    # сверяем пароли
-    if not get_password(password_data.current_password, current_user.password):
-        raise HTTPException(status_code=400, detail='Incorrect current password')
-    # меняем новый пароль для пользователя
-    current_user.password = make_password(password_data.new_password)
+    # current_user мог быть прочитан с реплики или из кэша со старым хэшем, пароль сверяется с основной базой
+    password_hash = (await session.execute(
+        select(UserAuthModel.password).where(UserAuthModel.id == current_user.id)
+    )).scalar_one_or_none()
+    # транзакция не держится открытой во время хэширования
+    await session.commit()
+    if password_hash is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+    try:
+        # сверяем пароли
+        if not await verify_password_async(password_data.current_password, password_hash):
+            raise HTTPException(status_code=400, detail='Incorrect current password')
+        # меняем новый пароль для пользователя
+        new_password = await make_password_async(password_data.new_password)
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="Service unavailable", headers={"Retry-After": "1"})
+    statement = (
+        update(UserAuthModel)
+        # пароль не должен был измениться параллельным запросом после проверки
+        .where(UserAuthModel.id == current_user.id, UserAuthModel.password == password_hash)
+        .values(password=new_password, token_version=UserAuthModel.token_version + 1)
+        .returning(UserAuthModel.token_version)
+    )
+    token_version = (await session.execute(statement)).scalar_one_or_none()
     await session.commit()
+    if token_version is None:
+        raise HTTPException(status_code=400, detail='Incorrect current password')
+    invalidate_user(user_id=current_user.id, email=current_user.email, token_version=token_version)
 
     return {'message', 'Password changed successfully'}
 
 
+@router.get('/sessions')
+async def get_sessions(
+    limit: int = Query(SESSIONS_PAGE_SIZE, ge=1, le=SESSIONS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    claims = Depends(current_user_claims),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Действующие сессии (устройства) текущего пользователя. Следующая страница - с параметром cursor из next_cursor
+    """
+    try:
+        sessions, next_cursor = await list_sessions(claims.id, session, limit=limit, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка базы данных при получении сессий: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Database error")
+    return {"sessions": [session_info(item) for item in sessions], "next_cursor": next_cursor}
+
+@router.delete('/sessions/{session_id}')
+async def delete_session(
+    session_id: str,
+    claims = Depends(current_user_claims),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Завершает сессию текущего пользователя на другом устройстве: ее refresh токены отзываются
+    """
+    try:
+        if not await revoke_session(claims.id, session_id, session):
+            raise HTTPException(status_code=404, detail="Session not found")
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    except SQLAlchemyError as e:
+        await session.rollback()
+        logger.error(f"Ошибка базы данных при завершении сессии: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Database error")
+    return {"message": "Session revoked"}
+
+
 # Для тестов
 @router.post('/admin')
 async def admin(_ = Depends(require_role("admin"))):
     return {'message': 'success'}
 
 
+# отчет об импорте содержит не больше этого количества строк с ошибками
+IMPORT_MAX_REPORTED_ERRORS = 1000
+
+@router.post('/admin/users/import')
+async def import_users_endpoint(
+    file: UploadFile = File(...),
+    format: Optional[str] = None,
+    session: AsyncSession = Depends(get_session),
+    _ = Depends(require_permissions(Permission.MANAGE_USERS)),
+):
+    """
+    Массовый импорт пользователей из CSV или JSONL (см. app.services.user_import)
+    """
+    fmt = format or detect_format(file.filename or "")
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, expected one of: {', '.join(FORMATS)}")
+    try:
+        # загруженный файл читается потоково, без чтения целиком в память
+        lines = codecs.iterdecode(file.file, "utf-8-sig")
+        # пароли хэшируются в общем пуле приложения, свои процессы в воркере не создаются
+        report = await import_users(read_rows(lines, fmt), session, hasher=hasher_pool)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+    except HasherBusyError:
+        # уже вставленные пачки остаются, повторный импорт пропустит их как существующие
+        raise HTTPException(status_code=503, detail="Service unavailable", headers={"Retry-After": "1"})
+    except SQLAlchemyError as e:
+        await session.rollback()
+        logger.error(f"Ошибка базы данных при импорте пользователей: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Database error")
+    logger.info(f"Импортировано пользователей: {report.imported} из {report.processed}")
+    return report.as_dict(max_errors=IMPORT_MAX_REPORTED_ERRORS)
+
+
 # TODO Восстановление пароля (/forgot-password и /reset-password)
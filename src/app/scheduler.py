@@ -0,0 +1,220 @@
+"""
+Планировщик фоновых задач. Задача запускается через интервал после окончания предыдущего запуска
+или по расписанию cron (UTC), со случайной задержкой jitter и ограничением времени работы max_runtime.
+Одна задача не запускается повторно, пока не закончился предыдущий запуск. Время и результат
+последнего запуска сохраняются в таблице jobrunmodel, поэтому перезапуск процесса не сбивает расписание.
+
+Планировщик выполняется в ведущем процессе (app.leader): в веб-воркере (SCHEDULER_MODE=inprocess)
+или отдельным процессом (SCHEDULER_MODE=external в веб-воркерах и python -m app.worker)
+"""
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.db import async_session
+from app.models.jobs import JobRunModel
+from app.logger import logger
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> set:
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+        else:
+            start = int(part)
+            # "5/15" - с 5 до конца диапазона с шагом 15
+            end = high if step else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Значение {part} вне диапазона {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronSchedule:
+    """
+    Выражение cron из пяти полей: минута, час, день месяца, месяц, день недели (0 или 7 - воскресенье).
+    Поддерживаются *, списки через запятую, диапазоны и шаг (*/15, 1-5, 0,30)
+    """
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Выражение cron должно состоять из 5 полей: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_cron_field(fields[4], 0, 7)}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = moment.isoweekday() % 7 in self.weekdays
+        # как в cron: если заданы и день месяца, и день недели, достаточно совпадения одного из них
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, after: datetime) -> datetime:
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Выражение cron {self.expression} не совпадает ни с одной датой")
+
+
+def _utc(moment: Optional[datetime]) -> Optional[datetime]:
+    # SQLite возвращает даты без часового пояса
+    if moment is not None and moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+class Job:
+    def __init__(self, name: str, func: Callable, interval: Optional[float] = None, cron: Optional[str] = None,
+                 jitter: float = 0.0, max_runtime: Optional[float] = None):
+        if (interval is None) == (cron is None):
+            raise ValueError(f"Для задачи {name} нужно задать interval или cron")
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        self.jitter = jitter
+        self.max_runtime = max_runtime
+        self.next_run_at: Optional[datetime] = None
+        self.running = False
+
+    def schedule_after(self, moment: datetime):
+        if self.cron is not None:
+            next_run = self.cron.next_after(moment)
+        else:
+            next_run = moment + timedelta(seconds=self.interval)
+        # случайная задержка разносит запуски одинаковых задач разных сервисов
+        self.next_run_at = next_run + timedelta(seconds=random.uniform(0, self.jitter))
+
+
+class Scheduler:
+    def __init__(self, session_factory=async_session, persist: bool = True):
+        self.session_factory = session_factory
+        self.persist = persist
+        self.jobs: dict = {}
+        self._wakeup = asyncio.Event()
+
+    def add_job(self, name: str, func: Callable, **kwargs) -> Job:
+        """
+        func - функция без аргументов, возвращающая корутину. kwargs - параметры Job
+        """
+        if name in self.jobs:
+            raise ValueError(f"Задача {name} уже зарегистрирована")
+        job = self.jobs[name] = Job(name, func, **kwargs)
+        return job
+
+    async def load_state(self):
+        now = datetime.now(timezone.utc)
+        last_runs = {}
+        if self.persist:
+            try:
+                async with self.session_factory() as session:
+                    result = await session.execute(select(JobRunModel).where(JobRunModel.name.in_(list(self.jobs))))
+                    last_runs = {run.name: run for run in result.scalars()}
+            except SQLAlchemyError as e:
+                logger.error(f"Не удалось загрузить время последних запусков задач: {e}")
+        for job in self.jobs.values():
+            run = last_runs.get(job.name)
+            last = _utc(run.last_finished_at or run.last_started_at) if run is not None else None
+            if last is not None:
+                job.schedule_after(last)
+            elif job.cron is not None:
+                job.schedule_after(now)
+            else:
+                # задача с интервалом, которая еще не запускалась, выполняется сразу
+                job.next_run_at = now + timedelta(seconds=random.uniform(0, job.jitter))
+
+    async def _save(self, job: Job, **values):
+        if not self.persist:
+            return
+        try:
+            async with self.session_factory() as session:
+                run = await session.get(JobRunModel, job.name) or JobRunModel(name=job.name)
+                for key, value in values.items():
+                    setattr(run, key, value)
+                session.add(run)
+                await session.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"Не удалось сохранить запуск задачи {job.name}: {e}")
+
+    async def run_job(self, job: Job) -> str:
+        if job.running:
+            logger.warning(f"Задача {job.name} еще выполняется, запуск пропущен")
+            return "skipped"
+        job.running = True
+        started_at = datetime.now(timezone.utc)
+        started = time.monotonic()
+        error = None
+        await self._save(job, last_started_at=started_at, last_status="running")
+        try:
+            await asyncio.wait_for(job.func(), job.max_runtime)
+            status = "ok"
+        except asyncio.TimeoutError:
+            status = "timeout"
+            logger.error(f"Задача {job.name} прервана: работает дольше {job.max_runtime} с")
+        except Exception as e:
+            status, error = "error", str(e)[:1000]
+            logger.error(f"Ошибка в задаче {job.name}: {e}", exc_info=True)
+        finally:
+            job.running = False
+        finished_at = datetime.now(timezone.utc)
+        job.schedule_after(finished_at)
+        await self._save(
+            job, last_finished_at=finished_at, last_status=status, last_duration=time.monotonic() - started,
+            last_error=error,
+        )
+        self._wakeup.set()
+        return status
+
+    async def run(self):
+        """
+        Выполняет задачи по расписанию до отмены
+        """
+        await self.load_state()
+        logger.info(f"Планировщик запущен: {', '.join(self.jobs) or 'нет задач'}")
+        tasks: set = set()
+        try:
+            while True:
+                now = datetime.now(timezone.utc)
+                for job in self.jobs.values():
+                    if not job.running and job.next_run_at <= now:
+                        task = asyncio.create_task(self.run_job(job))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                pending = [job.next_run_at for job in self.jobs.values() if not job.running]
+                delay = (min(pending) - now).total_seconds() if pending else None
+                # просыпаемся к ближайшему запуску или когда закончилась одна из задач
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(delay, 0) if delay is not None else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
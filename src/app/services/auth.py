@@ -1,55 +1,148 @@
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
+import asyncio
 from typing import Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import Depends, HTTPException, status
 from sqlalchemy.exc import OperationalError, IntegrityError, SQLAlchemyError, NoResultFound
 
-from app.models.auth import UserAuthModel, TokenModel
-from app.db import get_session
-from hashers import get_password
+from app.models.auth import UserAuthModel, RoleModel, TokenModel, UserClaims, normalize_email
+from app.db import get_session, get_read_session, async_session, DATABASE_REPLICA_URLS
+from app.services.hashers import (
+    verify_password_async, make_password_async, password_needs_update, hasher_pool, HasherBusyError,
+)
+from app.services.cache import user_cache, token_version_cache, invalidate_user
+from app.metrics import observe_stage, USER_CACHE_LOOKUPS
 from app.logger import logger
-from .tokens import create_access_token, create_refresh_token, decode_access_token
+from .tokens import create_access_token, issue_refresh_token, decode_access_token, user_token_claims
+from .token_store import get_token_store, TokenStoreUnavailable
+from .sessions import new_session_id, new_session
+from .write_behind import login_writer, WriteQueueFull, LOGIN_WRITE_BEHIND
 
 # ДЛЯ ТЕСТОВ!
 # engine = create_async_engine("sqlite+aiosqlite:///test.db", echo=True)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 
+# фоновые задачи пересчета хэшей паролей, ссылки хранятся, чтобы задачи не удалил сборщик мусора
+_rehash_tasks: set = set()
+
+
+async def rehash_password(user_id: int, password: str, old_hash: str):
+    """
+    Пересчитывает хэш пароля текущей схемой и стоимостью. Хэш заменяется, только если пароль
+    не меняли за время пересчета
+    """
+    try:
+        new_hash = await make_password_async(password)
+        async with async_session() as session:
+            await session.execute(
+                update(UserAuthModel)
+                .where(UserAuthModel.id == user_id, UserAuthModel.password == old_hash)
+                .values(password=new_hash)
+            )
+            await session.commit()
+        # в кэше пользователей остался старый хэш
+        invalidate_user(user_id=user_id)
+    except HasherBusyError:
+        # пул занят входами - хэш обновится при следующем входе
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось обновить хэш пароля пользователя {user_id}: {e}")
+
+
+def schedule_password_rehash(user: UserAuthModel, password: str):
+    """
+    Запускает пересчет устаревшего хэша после успешного входа. Ответ не ждет пересчета,
+    а при загруженном пуле хэширования пересчет откладывается до следующего входа
+    """
+    if not password_needs_update(user.password) or hasher_pool.in_flight >= hasher_pool.size:
+        return
+    task = asyncio.create_task(rehash_password(user.id, password, user.password))
+    _rehash_tasks.add(task)
+    task.add_done_callback(_rehash_tasks.discard)
+
+
+async def wait_password_rehash():
+    """
+    Дожидается запущенных пересчетов хэшей (при остановке приложения)
+    """
+    if _rehash_tasks:
+        await asyncio.gather(*_rehash_tasks, return_exceptions=True)
+
 # функция для входа пользователя
 # ожидает на вход email и password, возвращает словарь с JWT-токенами
 ######################################################
 ##  access_token хранить в локальной переменной JS  ##
 ##  refresh_token хранить в куки HttpOnly           ##
 ######################################################
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_session)) -> dict:
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_session),
+                client: Optional[dict] = None) -> dict:
+    """
+    Проверяет email и пароль, создает сессию и выдает токены. client - данные устройства (sessions.client_info)
+    """
     try:
-        statement = select(UserAuthModel).where(UserAuthModel.email == form_data.username) # form_data.username содержит email в OAuth2PasswordRequestForm
-        result = await db.execute(statement)
-        user = result.scalar_one_or_none()
+        statement = (
+            select(UserAuthModel)
+            # form_data.username содержит email в OAuth2PasswordRequestForm, email сравнивается без учета регистра
+            .where(func.lower(UserAuthModel.email) == normalize_email(form_data.username))
+            .options(joinedload(UserAuthModel.role))
+        )
+        with observe_stage("login.user_lookup"):
+            result = await db.execute(statement)
+            user = result.scalar_one_or_none()
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect email or password")
         # проверка правильности пароля
-        if get_password(form_data.password, statement.password) is False:
+        with observe_stage("login.verify_password"):
+            password_ok = await verify_password_async(form_data.password, user.password)
+        if password_ok is False:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect password")
+        schedule_password_rehash(user, form_data.password)
     
-        refresh_token = create_refresh_token(user.email)
-
-        refresh_token_save = TokenModel(token=refresh_token, user_id=user.id)
-        db.add(refresh_token_save)
-        await db.commit()
-        await db.refresh(refresh_token_save)
+        with observe_stage("login.token_encode"):
+            session_id = new_session_id()
+            refresh_token, token_id, expires_at = issue_refresh_token(user.email, session_id=session_id)
+            access_token = create_access_token(user.email, claims=user_token_claims(user))
+        with observe_stage("login.token_store"):
+            session = new_session(session_id, user.id, token_id, expires_at, client)
+            store = get_token_store()
+            if LOGIN_WRITE_BEHIND:
+                # строки токена и сессии вставляются общей пачкой с другими входами
+                rows = [session]
+                token = store.token_model(token_id, user.id, expires_at)
+                if token is None:
+                    await store.add(token_id, user.id, expires_at, db)
+                else:
+                    rows.append(token)
+                await login_writer.write(*rows)
+            else:
+                # строка сессии записывается в одной транзакции с токеном, если токены хранятся в базе
+                db.add(session)
+                await store.add(token_id, user.id, expires_at, db)
+                await db.commit()
 
         # возвращает JWT токены
         return {
-            "access_token": create_access_token(user.email),
+            "access_token": access_token,
             "refresh_token": refresh_token,
         }
     
+    except HasherBusyError:
+        logger.warning("Пул хэширования переполнен, вход отклонен")
+        raise HTTPException(status_code=503, detail="Service unavailable", headers={"Retry-After": "1"})
+    except WriteQueueFull:
+        logger.warning("Очередь отложенной записи переполнена, вход отклонен")
+        raise HTTPException(status_code=503, detail="Service unavailable", headers={"Retry-After": "1"})
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
     except OperationalError as e:
         logger.error(f"Ошибка соединения с базой данных: {e}")
         raise HTTPException(status_code=503, detail="Service unavailable")
@@ -61,7 +154,23 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSessi
         raise HTTPException(status_code=500, detail="Database error")
     
 
-async def current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_session)) -> Optional[UserAuthModel]:
+async def _attach_cached_user(data: dict, db: AsyncSession) -> UserAuthModel:
+    """
+    Новый объект пользователя из значений в кэше, привязанный к сессии запроса как уже загруженный
+    """
+    data = dict(data)
+    role_data = data.pop("role")
+    user = UserAuthModel(**data)
+    make_transient_to_detached(user)
+    user = await db.merge(user, load=False)
+    if role_data is not None:
+        role = RoleModel(**role_data)
+        make_transient_to_detached(role)
+        set_committed_value(user, "role", await db.merge(role, load=False))
+    return user
+
+
+async def current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_read_session)) -> Optional[UserAuthModel]:
     """
     Возвращает объект UserAuthModel со всей информацие о пользователе
     """
@@ -73,20 +182,36 @@ async def current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = D
     )
 
     # получаем access токен
-    payload = decode_access_token(token)
+    with observe_stage("current_user.decode"):
+        payload = decode_access_token(token)
     if payload is None:
         raise credentials_exception
     # извлекаем email и получаем всю информацию по пользователю
     email: str = payload.get('sub')
     if email is None:
         raise credentials_exception
+    # пользователь из кэша привязывается к сессии запроса без обращения к базе данных
+    cached_user = user_cache.get(email)
+    if cached_user is not None:
+        USER_CACHE_LOOKUPS.labels("hit").inc()
+        return await _attach_cached_user(cached_user, db)
+    USER_CACHE_LOOKUPS.labels("miss").inc()
     try:
-        statement = select(UserAuthModel).where(UserAuthModel.email == email)
-        result = await db.execute(statement)
-        user = result.scalars().first()
+        # роль загружается тем же запросом, ленивая загрузка связи в AsyncSession невозможна
+        statement = select(UserAuthModel).where(UserAuthModel.email == email).options(joinedload(UserAuthModel.role))
+        with observe_stage("current_user.db_lookup"):
+            result = await db.execute(statement)
+            user = result.scalars().first()
+
+            # только что зарегистрированного пользователя может еще не быть на реплике
+            if user is None and DATABASE_REPLICA_URLS:
+                async with async_session() as primary:
+                    user = (await primary.execute(statement)).scalars().first()
 
         if user is None:
             raise credentials_exception
+        user_cache.set_user(user)
+        token_version_cache.set(user.id, user.token_version)
         return user
     except OperationalError as e:
         logger.error(f"Ошибка соединения с базой данных: {e}")
@@ -97,5 +222,48 @@ async def current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = D
     except SQLAlchemyError as e:
         logger.error(f"Ошибка SQLAlchemy: {e}")
         raise HTTPException(status_code=500, detail="Database error")
-    
-    
+
+
+async def current_user_claims(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_read_session)) -> UserClaims:
+    """
+    Возвращает UserClaims пользователя. Для fat токенов (ACCESS_TOKEN_MODE=fat) данные берутся из самого токена,
+    в базу данных запрос идет только если версия токенов пользователя изменилась после выдачи токена.
+    Версии известны только текущему процессу, поэтому смена роли в другом воркере видна после истечения токена
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    payload = decode_access_token(token)
+    if payload is None or payload.get('sub') is None:
+        raise credentials_exception
+
+    if 'uid' in payload:
+        claims = UserClaims.from_payload(payload)
+        known_version = token_version_cache.get(claims.id)
+        if known_version is None or claims.token_version >= known_version:
+            return claims
+
+    # тонкий токен или устаревшие claims: берем актуальные данные из базы
+    try:
+        statement = (
+            select(UserAuthModel)
+            .where(UserAuthModel.email == payload['sub'])
+            .options(joinedload(UserAuthModel.role))
+            .execution_options(populate_existing=True)
+        )
+        result = await db.execute(statement)
+        user = result.scalars().first()
+    except OperationalError as e:
+        logger.error(f"Ошибка соединения с базой данных: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка SQLAlchemy: {e}")
+        raise HTTPException(status_code=500, detail="Database error")
+
+    if user is None:
+        raise credentials_exception
+    token_version_cache.set(user.id, user.token_version)
+    return UserClaims.from_user(user)
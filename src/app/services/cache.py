@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy import inspect
+
+from app.logger import logger
+
+# кэш пользователей для current_user, USER_CACHE_TTL=0 отключает кэш
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30))  # секунды
+# последние известные версии токенов пользователей, по ним current_user_claims определяет устаревшие claims
+TOKEN_VERSION_CACHE_SIZE = int(os.environ.get("TOKEN_VERSION_CACHE_SIZE", 100000))
+TOKEN_VERSION_CACHE_TTL = float(os.environ.get("TOKEN_VERSION_CACHE_TTL", 60 * 60))
+# проверенные access токены (ключ - sha256 токена), запись живет до exp токена, но не дольше TTL
+ACCESS_TOKEN_CACHE_SIZE = int(os.environ.get("ACCESS_TOKEN_CACHE_SIZE", 10000))
+ACCESS_TOKEN_CACHE_TTL = float(os.environ.get("ACCESS_TOKEN_CACHE_TTL", 300))
+# кэши хранятся в памяти каждого воркера, CACHE_BACKEND=redis рассылает сброс кэша пользователя всем воркерам
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")  # memory | redis
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", os.environ.get("REDIS_URL", "redis://redis:6379/0"))
+CACHE_INVALIDATION_CHANNEL = os.environ.get("CACHE_INVALIDATION_CHANNEL", "auth:cache_invalidation")
+
+
+class TTLCache:
+    """
+    Кэш в памяти процесса с ограничением по количеству записей (LRU) и времени жизни
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, value), порядок ключей - порядок использования
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, value)
+        # вытесняем самые давно использованные записи
+        while len(self._data) > self.maxsize:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+
+    def delete(self, key: Hashable):
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def _remove(self, key: Hashable):
+        _, value = self._data.pop(key)
+        self._on_remove(key, value)
+
+    def _on_remove(self, key: Hashable, value: Any):
+        pass
+
+
+def row_snapshot(obj) -> dict:
+    """
+    Значения колонок ORM объекта, без связи с сессией
+    """
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+
+class UserCache(TTLCache):
+    """
+    Кэш пользователей по email (subject токена) с возможностью инвалидации по id.
+    Хранятся значения колонок пользователя и загруженной роли (ключ "role"), а не ORM объект:
+    изменения объекта в одном запросе не попадают в кэш и в другие запросы
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._email_by_id: dict = {}
+
+    def set_user(self, user):
+        data = row_snapshot(user)
+        # связь не загружается, если ее не было в объекте
+        role = inspect(user).dict.get("role")
+        data["role"] = row_snapshot(role) if role is not None else None
+        self.set(user.email, data)
+        if user.email in self._data:
+            self._email_by_id[user.id] = user.email
+
+    def invalidate_user(self, user_id: Optional[int] = None, email: Optional[str] = None):
+        if email is None and user_id is not None:
+            email = self._email_by_id.get(user_id)
+        if email is not None:
+            self.delete(email)
+
+    def clear(self):
+        super().clear()
+        self._email_by_id.clear()
+
+    def _on_remove(self, key, value):
+        if self._email_by_id.get(value["id"]) == key:
+            del self._email_by_id[value["id"]]
+
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+token_version_cache = TTLCache(maxsize=TOKEN_VERSION_CACHE_SIZE, ttl=TOKEN_VERSION_CACHE_TTL)
+access_token_cache = TTLCache(maxsize=ACCESS_TOKEN_CACHE_SIZE, ttl=ACCESS_TOKEN_CACHE_TTL)
+
+
+def apply_invalidation(message: dict):
+    user_id = message.get("user_id")
+    token_version = message.get("token_version")
+    user_cache.invalidate_user(user_id=user_id, email=message.get("email"))
+    if token_version is not None and user_id is not None:
+        token_version_cache.set(user_id, token_version)
+
+
+def invalidate_user(user_id: Optional[int] = None, email: Optional[str] = None, token_version: Optional[int] = None):
+    """
+    Сбрасывает кэш пользователя после изменения его данных, в этом процессе и в остальных воркерах.
+    Если передана новая версия токенов, access токены со старой версией считаются устаревшими
+    """
+    message = {"user_id": user_id, "email": email, "token_version": token_version}
+    apply_invalidation(message)
+    get_cache_backend().publish(message)
+
+
+class CacheBackend(ABC):
+    """
+    Доставляет сброс кэша другим процессам. start и stop нужны только backend с фоновой подпиской
+    """
+    @abstractmethod
+    def publish(self, message: dict):
+        ...
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Один процесс: сброс уже применен локально, рассылать некому
+    """
+    def publish(self, message):
+        pass
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Рассылка через Redis pub/sub. Пока подписка не работает, воркер не узнает о сбросах,
+    поэтому после восстановления подписки кэш пользователей очищается целиком
+    """
+    def __init__(self, url: str = CACHE_REDIS_URL, channel: str = CACHE_INVALIDATION_CHANNEL):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.channel = channel
+        # собственные сообщения процесс пропускает
+        self.instance_id = uuid.uuid4().hex
+        self._listener: Optional[asyncio.Task] = None
+        self._pending: set = set()
+
+    def publish(self, message):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # вне event loop (например, в CLI) других воркеров нет
+            return
+        task = loop.create_task(self._publish({**message, "src": self.instance_id}))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _publish(self, message: dict):
+        try:
+            await self.client.publish(self.channel, json.dumps(message))
+        except RedisError as e:
+            logger.warning(f"Не удалось разослать сброс кэша: {e}")
+
+    async def start(self):
+        self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                await pubsub.subscribe(self.channel)
+                user_cache.clear()
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data.get("src") != self.instance_id:
+                        apply_invalidation(data)
+            except RedisError as e:
+                logger.warning(f"Подписка на сброс кэша прервана: {e}")
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self.client.close()
+
+
+_cache_backend: Optional[CacheBackend] = None
+
+def create_cache_backend(backend: str = CACHE_BACKEND) -> CacheBackend:
+    if backend == "memory":
+        return MemoryCacheBackend()
+    if backend == "redis":
+        return RedisCacheBackend()
+    raise ValueError(f"Неизвестный CACHE_BACKEND: {backend}")
+
+def get_cache_backend() -> CacheBackend:
+    global _cache_backend
+    if _cache_backend is None:
+        _cache_backend = create_cache_backend()
+    return _cache_backend
+
+def set_cache_backend(backend: Optional[CacheBackend]):
+    """
+    Подменяет backend рассылки (для тестов)
+    """
+    global _cache_backend
+    _cache_backend = backend
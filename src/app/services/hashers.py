@@ -1,10 +1,251 @@
+"""
+Хэширование паролей. Схемы и стоимость задаются переменными окружения, первая схема в PASSWORD_SCHEMES
+используется для новых паролей, остальные только для проверки старых хэшей. Хэши устаревших схем и
+с меньшей стоимостью пересчитываются после успешного входа (см. services.auth.schedule_password_rehash).
+
+Подбор стоимости под время хэширования на текущем сервере:
+
+    python -m app.services.hashers calibrate --target-ms 250
+"""
+import argparse
+import asyncio
+import math
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from app.metrics import HASHER_QUEUE_WAIT, HASHER_HASH_TIME, HASHER_REJECTED
+
+# например "argon2,bcrypt" - новые пароли в argon2id, старые bcrypt хэши проверяются и обновляются при входе
+PASSWORD_SCHEMES = [scheme.strip() for scheme in os.environ.get("PASSWORD_SCHEMES", "bcrypt").split(",") if scheme.strip()]
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.environ.get("ARGON2_MEMORY_COST", 65536))  # КиБ
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", 4))
+
+
+def build_password_context(
+    schemes: list = PASSWORD_SCHEMES,
+    bcrypt_rounds: int = BCRYPT_ROUNDS,
+    argon2_time_cost: int = ARGON2_TIME_COST,
+    argon2_memory_cost: int = ARGON2_MEMORY_COST,
+    argon2_parallelism: int = ARGON2_PARALLELISM,
+) -> CryptContext:
+    """
+    Все схемы, кроме первой, считаются устаревшими. bcrypt хэши с меньшим количеством раундов
+    и argon2 хэши с другими параметрами тоже требуют обновления (needs_update)
+    """
+    return CryptContext(
+        schemes=schemes,
+        deprecated="auto",
+        bcrypt__rounds=bcrypt_rounds,
+        bcrypt__min_rounds=bcrypt_rounds,
+        argon2__type="ID",
+        argon2__time_cost=argon2_time_cost,
+        argon2__memory_cost=argon2_memory_cost,
+        argon2__parallelism=argon2_parallelism,
+    )
+
+
+pwd_context = build_password_context()
+
+# bcrypt отпускает GIL, поэтому по умолчанию хватает пула потоков.
+# process - если хэширование упирается в CPU одного процесса
+HASHER_POOL_KIND = os.environ.get("HASHER_POOL_KIND", "thread")  # thread | process
+HASHER_POOL_SIZE = int(os.environ.get("HASHER_POOL_SIZE", os.cpu_count() or 1))
+# сколько задач может ждать свободного воркера, остальные получают отказ (503)
+HASHER_QUEUE_SIZE = int(os.environ.get("HASHER_QUEUE_SIZE", 64))
+
 
 def make_password(password: str):
     password = pwd_context.hash(password)
     return password
 
 def get_password(password: str, password_hash: str) -> bool:
-    return pwd_context.verify(password, password_hash)
\ No newline at end of file
+    return pwd_context.verify(password, password_hash)
+
+def password_needs_update(password_hash: str) -> bool:
+    """
+    Хэш создан устаревшей схемой или с другой стоимостью. Только разбор строки хэша, без хэширования
+    """
+    return pwd_context.needs_update(password_hash)
+
+
+class HasherBusyError(Exception):
+    """
+    Пул хэширования переполнен, запрос нужно отклонить, а не ставить в очередь
+    """
+
+
+class HasherStats:
+    """
+    Метрики пула: время ожидания в очереди и время самого хэширования (в секундах)
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    def observe(self, queue_wait: float, hash_time: float):
+        self.calls += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.hash_time_total += hash_time
+        self.hash_time_max = max(self.hash_time_max, hash_time)
+
+    def as_dict(self) -> dict:
+        calls = self.calls or 1
+        return {
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "queue_wait_avg": self.queue_wait_total / calls,
+            "queue_wait_max": self.queue_wait_max,
+            "hash_time_avg": self.hash_time_total / calls,
+            "hash_time_max": self.hash_time_max,
+        }
+
+
+# выполняется внутри воркера, должна быть на уровне модуля, чтобы её можно было передать в процесс
+def _timed_call(func, *args):
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time()
+
+
+class HasherPool:
+    """
+    Ограниченный пул для bcrypt, чтобы хэширование не блокировало event loop
+    """
+    def __init__(self, kind: str = HASHER_POOL_KIND, size: int = HASHER_POOL_SIZE, queue_size: int = HASHER_QUEUE_SIZE):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Неизвестный тип пула хэширования: {kind}")
+        self.kind = kind
+        self.size = size
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.stats = HasherStats()
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        # пул создается лениво, чтобы не плодить процессы при импорте
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.size)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="hasher")
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.size + self.queue_size:
+            self.stats.rejected += 1
+            HASHER_REJECTED.inc()
+            raise HasherBusyError("Password hasher pool is saturated")
+
+        self.in_flight += 1
+        submitted = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, finished = await loop.run_in_executor(self._get_executor(), _timed_call, func, *args)
+        finally:
+            self.in_flight -= 1
+        queue_wait = max(started - submitted, 0.0)
+        self.stats.observe(queue_wait, finished - started)
+        HASHER_QUEUE_WAIT.observe(queue_wait)
+        HASHER_HASH_TIME.observe(finished - started)
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hasher_pool = HasherPool()
+
+async def make_password_async(password: str) -> str:
+    return await hasher_pool.run(make_password, password)
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    return await hasher_pool.run(get_password, password, password_hash)
+
+def get_hasher_stats() -> dict:
+    return {"in_flight": hasher_pool.in_flight, **hasher_pool.stats.as_dict()}
+
+def shutdown_hasher_pool():
+    hasher_pool.shutdown()
+
+
+def measure_hash_time(context: CryptContext, samples: int = 3) -> float:
+    """
+    Медиана времени хэширования в секундах
+    """
+    durations = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        context.hash("calibration-password")
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations)
+
+
+def calibrate(scheme: str, target_ms: float, samples: int = 3) -> dict:
+    """
+    Подбирает стоимость хэширования, при которой один хэш занимает около target_ms на этом сервере.
+    bcrypt: время удваивается с каждым раундом; argon2: растет линейно с time_cost при заданной памяти
+    """
+    target = target_ms / 1000
+    if scheme == "bcrypt":
+        base_rounds = 8
+        base = measure_hash_time(build_password_context(["bcrypt"], bcrypt_rounds=base_rounds), samples)
+        rounds = min(max(base_rounds + round(math.log2(target / base)), 4), 31)
+        context = build_password_context(["bcrypt"], bcrypt_rounds=rounds)
+        settings = {"BCRYPT_ROUNDS": rounds}
+    elif scheme == "argon2":
+        base = measure_hash_time(build_password_context(["argon2"], argon2_time_cost=1), samples)
+        time_cost = max(1, round(target / base))
+        context = build_password_context(["argon2"], argon2_time_cost=time_cost)
+        settings = {"ARGON2_TIME_COST": time_cost}
+    else:
+        raise ValueError(f"Калибровка не поддерживается для схемы {scheme}")
+
+    hash_time = measure_hash_time(context, samples)
+    return {
+        "scheme": scheme,
+        "settings": settings,
+        "hash_ms": hash_time * 1000,
+        # сколько входов в секунду выдержит пул хэширования такого размера
+        "logins_per_second": HASHER_POOL_SIZE / hash_time,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Настройка хэширования паролей")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="подобрать стоимость хэширования под целевое время")
+    calibrate_parser.add_argument("--scheme", default=PASSWORD_SCHEMES[0], choices=["bcrypt", "argon2"])
+    calibrate_parser.add_argument("--target-ms", type=float, default=250, help="целевое время одного хэша")
+    calibrate_parser.add_argument("--samples", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    result = calibrate(args.scheme, args.target_ms, args.samples)
+    for name, value in result["settings"].items():
+        print(f"{name}={value}")
+    print(
+        f"# {result['scheme']}: {result['hash_ms']:.0f} ms на хэш, "
+        f"~{result['logins_per_second']:.0f} входов/с при HASHER_POOL_SIZE={HASHER_POOL_SIZE}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Реализации кодирования и проверки JWT. Выбирается переменной JWT_BACKEND:
+
+jose - python-jose (по умолчанию)
+pyjwt - PyJWT, нужно установить отдельно (pip install PyJWT)
+fast - собственная реализация HS256 на hmac/hashlib, остальные алгоритмы передаются в python-jose
+
+Все реализации бросают jose.JWTError для невалидных токенов.
+Сравнение скорости: python -m benchmarks.jwt_bench
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from calendar import timegm
+from datetime import datetime
+from typing import Optional
+
+from jose import jwt as jose_jwt, JWTError, ExpiredSignatureError
+from jose.exceptions import JWTClaimsError
+
+JWT_BACKEND = os.environ.get("JWT_BACKEND", "jose")  # jose | pyjwt | fast
+
+
+class JWTBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def encode(self, payload: dict, key, algorithm: str, headers: Optional[dict] = None) -> str:
+        ...
+
+    @abstractmethod
+    def decode(self, token: str, key, algorithms: list) -> dict:
+        ...
+
+    @abstractmethod
+    def get_unverified_header(self, token: str) -> dict:
+        ...
+
+
+class JoseBackend(JWTBackend):
+    name = "jose"
+
+    def encode(self, payload, key, algorithm, headers=None):
+        return jose_jwt.encode(payload, key, algorithm, headers=headers)
+
+    def decode(self, token, key, algorithms):
+        return jose_jwt.decode(token, key, algorithms)
+
+    def get_unverified_header(self, token):
+        return jose_jwt.get_unverified_header(token)
+
+
+class PyJWTBackend(JWTBackend):
+    name = "pyjwt"
+
+    def __init__(self):
+        try:
+            import jwt as pyjwt
+        except ImportError:
+            raise RuntimeError("Для JWT_BACKEND=pyjwt нужно установить PyJWT")
+        self._jwt = pyjwt
+
+    def encode(self, payload, key, algorithm, headers=None):
+        return self._jwt.encode(payload, key, algorithm, headers=headers)
+
+    def decode(self, token, key, algorithms):
+        try:
+            if isinstance(key, dict):
+                # открытый ключ из набора ключей приходит в формате JWK
+                key = self._jwt.PyJWK(key).key
+            return self._jwt.decode(token, key, algorithms=algorithms, options={"verify_aud": False})
+        except self._jwt.ExpiredSignatureError as e:
+            raise ExpiredSignatureError(str(e))
+        except self._jwt.PyJWTError as e:
+            raise JWTError(str(e))
+
+    def get_unverified_header(self, token):
+        try:
+            return self._jwt.get_unverified_header(token)
+        except self._jwt.PyJWTError as e:
+            raise JWTError(str(e))
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+def _numeric_date(value):
+    if isinstance(value, datetime):
+        return timegm(value.utctimetuple())
+    return value
+
+
+class FastHS256Backend(JWTBackend):
+    """
+    HS256 без общих механизмов python-jose: заголовки кодируются один раз, подпись - один вызов hmac.
+    Проверяет те же claims, что и python-jose: exp, nbf, iat, sub и jti
+    """
+    name = "fast"
+
+    def __init__(self, fallback: JWTBackend = None):
+        self.fallback = fallback or JoseBackend()
+        self._header_segments: dict = {}
+
+    def _header_segment(self, headers: Optional[dict]) -> bytes:
+        cache_key = tuple(sorted(headers.items())) if headers else ()
+        segment = self._header_segments.get(cache_key)
+        if segment is None:
+            header = {"typ": "JWT", "alg": "HS256", **(headers or {})}
+            segment = _b64encode(json.dumps(header, separators=(",", ":"), sort_keys=True).encode())
+            self._header_segments[cache_key] = segment
+        return segment
+
+    def encode(self, payload, key, algorithm, headers=None):
+        if algorithm != "HS256" or not isinstance(key, str):
+            return self.fallback.encode(payload, key, algorithm, headers)
+        claims = dict(payload)
+        for claim in ("exp", "iat", "nbf"):
+            if claim in claims:
+                claims[claim] = _numeric_date(claims[claim])
+        signing_input = self._header_segment(headers) + b"." + _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        signature = hmac.new(key.encode(), signing_input, hashlib.sha256).digest()
+        return (signing_input + b"." + _b64encode(signature)).decode()
+
+    def decode(self, token, key, algorithms):
+        if "HS256" not in algorithms or not isinstance(key, str):
+            return self.fallback.decode(token, key, algorithms)
+        try:
+            signing_input, _, signature = token.encode().rpartition(b".")
+            header_segment, _, payload_segment = signing_input.partition(b".")
+            header = json.loads(_b64decode(header_segment))
+            expected = hmac.new(key.encode(), signing_input, hashlib.sha256).digest()
+            signature_ok = hmac.compare_digest(expected, _b64decode(signature))
+            payload = json.loads(_b64decode(payload_segment)) if signature_ok else None
+        except (ValueError, TypeError, UnicodeError):
+            raise JWTError("Invalid token")
+        if not isinstance(header, dict) or header.get("alg") != "HS256":
+            raise JWTError("The specified alg value is not allowed")
+        if not signature_ok:
+            raise JWTError("Signature verification failed.")
+        if not isinstance(payload, dict):
+            raise JWTError("Invalid payload")
+        self._validate_claims(payload)
+        return payload
+
+    @staticmethod
+    def _validate_claims(claims: dict):
+        now = int(time.time())
+        for claim in ("exp", "nbf", "iat"):
+            if claim in claims and not isinstance(claims[claim], (int, float)):
+                raise JWTClaimsError(f"{claim} claim must be a number.")
+        if "exp" in claims and int(claims["exp"]) < now:
+            raise ExpiredSignatureError("Signature has expired.")
+        if "nbf" in claims and int(claims["nbf"]) > now:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+        for claim in ("sub", "jti"):
+            if claim in claims and not isinstance(claims[claim], str):
+                raise JWTClaimsError(f"{claim} claim must be a string.")
+
+    def get_unverified_header(self, token):
+        try:
+            header = json.loads(_b64decode(token.encode().partition(b".")[0]))
+        except (ValueError, TypeError, UnicodeError):
+            raise JWTError("Error decoding token headers.")
+        if not isinstance(header, dict):
+            raise JWTError("Invalid header string: must be a json object")
+        return header
+
+
+JWT_BACKENDS = {
+    "jose": JoseBackend,
+    "pyjwt": PyJWTBackend,
+    "fast": FastHS256Backend,
+}
+
+def create_jwt_backend(name: str = JWT_BACKEND) -> JWTBackend:
+    if name not in JWT_BACKENDS:
+        raise ValueError(f"Неизвестный JWT_BACKEND: {name}")
+    return JWT_BACKENDS[name]()
@@ -0,0 +1,206 @@
+"""
+Ключи для асимметричной подписи access токенов (JWT_ALGORITHM=RS256 или ES256).
+
+Закрытые ключи лежат в JWT_KEYS_DIR, по одному PEM файлу на ключ, имя файла без расширения - kid.
+Все ключи каталога публикуются в /.well-known/jwks.json, подписывает самый новый из активных.
+Новый ключ становится активным через JWT_KEY_ACTIVATION_DELAY секунд после создания, чтобы другие сервисы
+успели получить его из JWKS. При ротации старый ключ удаляется, только если ключ, сменивший его,
+активен дольше JWT_KEY_RETENTION секунд (срока действия access токена) - то есть все подписанные
+старым ключом токены истекли. Ключи, которые еще нужны, остаются, даже если их больше --keep.
+
+Ротация (например, по cron раз в сутки):
+
+    python -m app.services.keys rotate --keep 2
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from dotenv import load_dotenv
+from jose import jwk
+
+from app.services.cache import access_token_cache
+from app.logger import logger
+
+load_dotenv()
+
+JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")  # HS256 | RS256 | ES256
+JWT_KEYS_DIR = os.environ.get("JWT_KEYS_DIR", "keys")
+# время жизни JWKS в кэше других сервисов (Cache-Control: max-age)
+JWKS_MAX_AGE = int(os.environ.get("JWKS_MAX_AGE", 300))
+JWT_KEY_ACTIVATION_DELAY = float(os.environ.get("JWT_KEY_ACTIVATION_DELAY", JWKS_MAX_AGE))
+# сколько секунд после смены ключа принимаются подписанные им токены, не меньше ACCESS_TOKEN_EXPIRE_MINUTES
+JWT_KEY_RETENTION = float(os.environ.get("JWT_KEY_RETENTION", 30 * 60))
+# как часто перечитывать каталог ключей, чтобы подхватить ротацию, сделанную другим процессом
+JWT_KEYS_RELOAD_INTERVAL = float(os.environ.get("JWT_KEYS_RELOAD_INTERVAL", 60))
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256")
+
+
+class SigningKey:
+    def __init__(self, kid: str, private_pem: str, algorithm: str, created_at: float):
+        self.kid = kid
+        self.private_pem = private_pem
+        self.algorithm = algorithm
+        self.created_at = created_at
+        self.public_jwk = {
+            **jwk.construct(private_pem, algorithm).public_key().to_dict(),
+            "kid": kid,
+            "use": "sig",
+        }
+
+
+class KeyRing:
+    """
+    Набор ключей подписи: активный ключ для новых токенов и предыдущие ключи для проверки выданных
+    """
+    def __init__(self, algorithm: str, keys_dir: str, activation_delay: float = JWT_KEY_ACTIVATION_DELAY,
+                 reload_interval: float = JWT_KEYS_RELOAD_INTERVAL):
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"Алгоритм {algorithm} не поддерживается, доступны: {', '.join(ASYMMETRIC_ALGORITHMS)}")
+        self.algorithm = algorithm
+        self.keys_dir = keys_dir
+        self.activation_delay = activation_delay
+        self.reload_interval = reload_interval
+        self.keys: dict = {}
+        self._loaded_at = 0.0
+        self._dir_mtime = None
+
+    def load(self):
+        keys = {}
+        for name in os.listdir(self.keys_dir):
+            if not name.endswith(".pem"):
+                continue
+            path = os.path.join(self.keys_dir, name)
+            with open(path) as f:
+                keys[name[:-4]] = SigningKey(name[:-4], f.read(), self.algorithm, os.path.getmtime(path))
+        if not keys:
+            raise RuntimeError(f"В каталоге {self.keys_dir} нет ключей подписи, создайте их: python -m app.services.keys rotate")
+        if set(self.keys) - set(keys):
+            # токены удаленных ключей больше не должны приниматься из кэша проверенных токенов
+            access_token_cache.clear()
+        self.keys = keys
+        self._dir_mtime = os.path.getmtime(self.keys_dir)
+        self._loaded_at = time.monotonic()
+
+    def reload_if_changed(self, force: bool = False):
+        if not force and time.monotonic() - self._loaded_at < self.reload_interval:
+            return
+        self._loaded_at = time.monotonic()
+        if os.path.getmtime(self.keys_dir) != self._dir_mtime:
+            self.load()
+            logger.info(f"Ключи подписи перечитаны: {', '.join(sorted(self.keys))}")
+
+    def active_key(self) -> SigningKey:
+        self.reload_if_changed()
+        now = time.time()
+        by_age = sorted(self.keys.values(), key=lambda key: key.created_at, reverse=True)
+        for key in by_age:
+            if key.created_at + self.activation_delay <= now:
+                return key
+        # все ключи новые (первый запуск) - подписываем самым старым
+        return by_age[-1]
+
+    def verification_key(self, kid: Optional[str]) -> Optional[dict]:
+        key = self.keys.get(kid)
+        if key is None and kid is not None:
+            # токен подписан ключом, появившимся после последней загрузки
+            self.reload_if_changed()
+            key = self.keys.get(kid)
+        return key.public_jwk if key is not None else None
+
+    def jwks(self) -> dict:
+        self.reload_if_changed()
+        return {"keys": [self.keys[kid].public_jwk for kid in sorted(self.keys)]}
+
+
+def generate_private_key(algorithm: str) -> str:
+    if algorithm == "RS256":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm == "ES256":
+        key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Алгоритм {algorithm} не поддерживается")
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+
+def rotate_keys(keys_dir: str, algorithm: str, keep: int = 2, activation_delay: float = JWT_KEY_ACTIVATION_DELAY,
+                retention: float = JWT_KEY_RETENTION) -> str:
+    """
+    Создает новый ключ и удаляет самые старые, оставляя не меньше keep ключей (включая новый).
+    Ключ удаляется, только если следующий за ним ключ стал активным больше retention секунд назад.
+    Возвращает kid нового ключа
+    """
+    os.makedirs(keys_dir, exist_ok=True)
+    kid = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(keys_dir, f"{kid}.pem")
+    # файл закрытого ключа доступен только владельцу
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(generate_private_key(algorithm))
+
+    now = time.time()
+    # время создания - как в KeyRing, по нему определяется, когда ключ стал активным
+    keys = sorted(
+        (os.path.getmtime(os.path.join(keys_dir, name)), name)
+        for name in os.listdir(keys_dir) if name.endswith(".pem")
+    )
+    for index, (_, name) in enumerate(keys[:-keep]):
+        replaced_at = keys[index + 1][0] + activation_delay
+        if now < replaced_at + retention:
+            # токены этого ключа еще действуют, более новые ключи тем более нужны
+            break
+        os.remove(os.path.join(keys_dir, name))
+        logger.info(f"Удален ключ подписи {name[:-4]}")
+    logger.info(f"Создан ключ подписи {kid}")
+    return kid
+
+
+_key_ring: Optional[KeyRing] = None
+
+def get_key_ring() -> Optional[KeyRing]:
+    """
+    Набор ключей процесса, None для симметричной подписи (HS256)
+    """
+    global _key_ring
+    if JWT_ALGORITHM not in ASYMMETRIC_ALGORITHMS:
+        return None
+    if _key_ring is None:
+        key_ring = KeyRing(JWT_ALGORITHM, JWT_KEYS_DIR)
+        key_ring.load()
+        _key_ring = key_ring
+    return _key_ring
+
+def set_key_ring(key_ring: Optional[KeyRing]):
+    """
+    Подменяет набор ключей (для тестов)
+    """
+    global _key_ring
+    _key_ring = key_ring
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Управление ключами подписи access токенов")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rotate = subparsers.add_parser("rotate", help="создать новый ключ и удалить старые")
+    rotate.add_argument("--dir", default=JWT_KEYS_DIR)
+    rotate.add_argument("--algorithm", default=JWT_ALGORITHM if JWT_ALGORITHM in ASYMMETRIC_ALGORITHMS else "RS256",
+                        choices=ASYMMETRIC_ALGORITHMS)
+    rotate.add_argument("--keep", type=int, default=2, help="сколько ключей оставить, включая новый")
+    args = parser.parse_args(argv)
+
+    if args.keep < 2:
+        parser.error("--keep должен быть не меньше 2, иначе выданные токены перестанут проверяться")
+    print(rotate_keys(args.dir, args.algorithm, args.keep))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
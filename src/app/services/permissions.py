@@ -0,0 +1,67 @@
+from enum import IntFlag
+from typing import Optional
+
+
+class Permission(IntFlag):
+    """
+    Разрешения пользователей. Значения битов попадают в access токены (claim perm),
+    поэтому существующие биты нельзя менять местами или переиспользовать, новые добавляются в конец
+    """
+    VIEW = 1 << 0
+    CREATE = 1 << 1
+    EDIT = 1 << 2
+    PUBLISH = 1 << 3
+    DELETE = 1 << 4
+    MANAGE_USERS = 1 << 5
+    MANAGE_SETTINGS = 1 << 6
+
+
+ALL_PERMISSIONS = Permission(sum(Permission))
+
+# роль -> собственные разрешения и роли, от которых она наследует разрешения (см. описание RoleModel)
+ROLE_DEFINITIONS = {
+    "user": {"permissions": Permission.VIEW, "inherits": []},
+    "moderator": {"permissions": Permission.CREATE | Permission.EDIT | Permission.PUBLISH, "inherits": ["user"]},
+    "admin": {"permissions": Permission.DELETE | Permission.MANAGE_USERS | Permission.MANAGE_SETTINGS, "inherits": ["moderator"]},
+}
+
+
+def compile_role_permissions(definitions: dict) -> dict:
+    """
+    Раскрывает наследование ролей и возвращает словарь роль -> битовая маска всех её разрешений
+    """
+    compiled: dict = {}
+
+    def resolve(name: str, path: tuple) -> int:
+        if name in compiled:
+            return compiled[name]
+        if name in path:
+            raise ValueError(f"Циклическое наследование ролей: {' -> '.join(path + (name,))}")
+        if name not in definitions:
+            raise ValueError(f"Неизвестная роль в наследовании: {name}")
+        mask = int(definitions[name]["permissions"])
+        for parent in definitions[name].get("inherits", []):
+            mask |= resolve(parent, path + (name,))
+        compiled[name] = mask
+        return mask
+
+    for name in definitions:
+        resolve(name, ())
+    return compiled
+
+
+# маски вычисляются один раз при запуске, проверка разрешения - одна битовая операция
+ROLE_PERMISSIONS = compile_role_permissions(ROLE_DEFINITIONS)
+
+
+def permissions_for(role: Optional[str], is_superuser: bool = False) -> int:
+    """
+    Маска разрешений пользователя с указанной ролью, суперпользователю доступно все
+    """
+    if is_superuser:
+        return int(ALL_PERMISSIONS)
+    return ROLE_PERMISSIONS.get(role, 0)
+
+
+def has_permissions(mask: int, required: int) -> bool:
+    return mask & required == required
@@ -0,0 +1,244 @@
+"""
+Ограничение частоты запросов к /login и /signup, проверяется до хэширования пароля.
+
+Счетчики - скользящее окно (sliding window counter): количество запросов в текущем окне плюс
+доля количества из предыдущего окна. Хранится два числа на ключ, точность достаточна для защиты от перебора.
+Лимиты задаются строкой "количество/секунды", пустая строка отключает лимит.
+Запрос, отклоненный одним из лимитов, не расходует остальные
+"""
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from app.metrics import RATE_LIMIT_REJECTED
+from app.logger import logger
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")  # memory | redis
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL", os.environ.get("REDIS_URL", "redis://redis:6379/0"))
+# брать адрес клиента из X-Forwarded-For, только если сервис стоит за доверенным прокси
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+# сколько ключей хранит backend memory, при превышении удаляются самые старые
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+
+class RateLimit(NamedTuple):
+    limit: int
+    window: float  # секунды
+
+
+def parse_rate(value: str) -> Optional[RateLimit]:
+    """
+    "10/60" -> RateLimit(10, 60.0), пустая строка -> None
+    """
+    if not value:
+        return None
+    limit, _, window = value.partition("/")
+    return RateLimit(int(limit), float(window or 1))
+
+
+RATE_LIMIT_LOGIN_IP = parse_rate(os.environ.get("RATE_LIMIT_LOGIN_IP", "30/60"))
+RATE_LIMIT_LOGIN_EMAIL = parse_rate(os.environ.get("RATE_LIMIT_LOGIN_EMAIL", "10/60"))
+# общий лимит попыток входа, по умолчанию отключен. Для memory он действует в каждом процессе отдельно
+# (при N воркерах фактический лимит в N раз больше), для redis - на все воркеры
+RATE_LIMIT_LOGIN_GLOBAL = parse_rate(os.environ.get("RATE_LIMIT_LOGIN_GLOBAL", ""))
+RATE_LIMIT_SIGNUP_IP = parse_rate(os.environ.get("RATE_LIMIT_SIGNUP_IP", "10/60"))
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Rate limit exceeded: {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def _retry_after(rate: RateLimit, current: float, previous: float, elapsed: float) -> int:
+    """
+    Через сколько секунд оценка количества запросов опустится ниже лимита
+    """
+    if current + 1 > rate.limit or previous <= 0:
+        wait = rate.window - elapsed
+    else:
+        # вес предыдущего окна должен упасть до (limit - current - 1) / previous
+        wait = rate.window * (1 - (rate.limit - current - 1) / previous) - elapsed
+    return max(1, math.ceil(wait))
+
+
+class RateLimiter(ABC):
+    @abstractmethod
+    async def hit(self, key: str, rate: RateLimit) -> int:
+        """
+        Учитывает запрос и возвращает 0, если он укладывается в лимит, иначе - сколько секунд ждать
+        (отклоненные запросы не учитываются)
+        """
+
+    @abstractmethod
+    async def refund(self, key: str, rate: RateLimit):
+        """
+        Отменяет учтенный запрос, который отклонил другой лимит (если окно еще не сменилось)
+        """
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+
+class MemoryRateLimiter(RateLimiter):
+    """
+    Счетчики в памяти процесса, при нескольких воркерах лимиты действуют в каждом отдельно
+    """
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._counters: dict = {}  # key -> [номер окна, текущее, предыдущее]
+
+    async def hit(self, key, rate):
+        now = time.time()
+        window = int(now // rate.window)
+        counter = self._counters.get(key)
+        if counter is None:
+            if len(self._counters) >= self.max_keys:
+                self._evict()
+            counter = self._counters[key] = [window, 0, 0]
+        elif counter[0] != window:
+            # окно сменилось: текущее становится предыдущим, если окна соседние
+            counter[2] = counter[1] if counter[0] == window - 1 else 0
+            counter[0], counter[1] = window, 0
+
+        elapsed = now - window * rate.window
+        estimated = counter[2] * (1 - elapsed / rate.window) + counter[1]
+        if estimated + 1 > rate.limit:
+            return _retry_after(rate, counter[1], counter[2], elapsed)
+        counter[1] += 1
+        return 0
+
+    async def refund(self, key, rate):
+        counter = self._counters.get(key)
+        if counter is not None and counter[0] == int(time.time() // rate.window) and counter[1] > 0:
+            counter[1] -= 1
+
+    def _evict(self):
+        # ключи лежат в порядке создания, удаляется самая старая четверть
+        for key in list(self._counters)[: max(1, self.max_keys // 4)]:
+            del self._counters[key]
+
+    async def clear(self):
+        self._counters.clear()
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Общие для всех воркеров счетчики в Redis, проверка и учет - один вызов скрипта.
+    При недоступности Redis запросы пропускаются, чтобы не блокировать вход
+    """
+    # KEYS: счетчик текущего окна, счетчик предыдущего; ARGV: лимит, окно (секунды), прошедшая доля окна
+    HIT_SCRIPT = """
+    local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+    local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+    if previous * (1 - tonumber(ARGV[3])) + current + 1 > tonumber(ARGV[1]) then
+        return {0, current, previous}
+    end
+    redis.call('INCR', KEYS[1])
+    redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2]) * 2))
+    return {1, current + 1, previous}
+    """
+    # KEYS: счетчик текущего окна
+    REFUND_SCRIPT = """
+    if tonumber(redis.call('GET', KEYS[1]) or '0') > 0 then
+        redis.call('DECR', KEYS[1])
+    end
+    """
+
+    def __init__(self, url: str = RATE_LIMIT_REDIS_URL):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._hit = self.client.register_script(self.HIT_SCRIPT)
+        self._refund = self.client.register_script(self.REFUND_SCRIPT)
+
+    async def hit(self, key, rate):
+        now = time.time()
+        window = int(now // rate.window)
+        elapsed = now - window * rate.window
+        try:
+            allowed, current, previous = await self._hit(
+                keys=[f"rate_limit:{key}:{window}", f"rate_limit:{key}:{window - 1}"],
+                args=[rate.limit, rate.window, elapsed / rate.window],
+            )
+        except RedisError as e:
+            logger.warning(f"Redis недоступен, ограничение частоты запросов не проверяется: {e}")
+            return 0
+        if allowed:
+            return 0
+        return _retry_after(rate, current, previous, elapsed)
+
+    async def refund(self, key, rate):
+        window = int(time.time() // rate.window)
+        try:
+            await self._refund(keys=[f"rate_limit:{key}:{window}"])
+        except RedisError as e:
+            logger.warning(f"Redis недоступен, запрос не возвращен в лимит: {e}")
+
+    async def clear(self):
+        pass
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+def create_rate_limiter(backend: str = RATE_LIMIT_BACKEND) -> RateLimiter:
+    if backend == "memory":
+        return MemoryRateLimiter()
+    if backend == "redis":
+        return RedisRateLimiter()
+    raise ValueError(f"Неизвестный RATE_LIMIT_BACKEND: {backend}")
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = create_rate_limiter()
+    return _rate_limiter
+
+
+async def check_rate_limits(*checks: tuple):
+    """
+    checks - кортежи (scope, ключ, лимит). Бросает RateLimitExceeded на первом превышенном лимите,
+    запрос при этом возвращается в уже проверенные лимиты
+    """
+    if not RATE_LIMIT_ENABLED:
+        return
+    limiter = get_rate_limiter()
+    counted = []
+    for scope, key, rate in checks:
+        if rate is None:
+            continue
+        retry_after = await limiter.hit(f"{scope}:{key}", rate)
+        if retry_after:
+            for counted_key, counted_rate in counted:
+                await limiter.refund(counted_key, counted_rate)
+            RATE_LIMIT_REJECTED.labels(scope).inc()
+            raise RateLimitExceeded(scope, retry_after)
+        counted.append((f"{scope}:{key}", rate))
+
+
+def client_ip(request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def limit_login(request, email: str):
+    # общий лимит проверяется последним, чтобы при его превышении ответ называл его, а не лимит адреса или email
+    await check_rate_limits(
+        ("login_ip", client_ip(request), RATE_LIMIT_LOGIN_IP),
+        ("login_email", email.strip().lower(), RATE_LIMIT_LOGIN_EMAIL),
+        ("login_global", "all", RATE_LIMIT_LOGIN_GLOBAL),
+    )
+
+async def limit_signup(request):
+    await check_rate_limits(
+        ("signup_ip", client_ip(request), RATE_LIMIT_SIGNUP_IP),
+    )
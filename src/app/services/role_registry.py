@@ -0,0 +1,57 @@
+from typing import Iterable, Optional, Tuple
+
+
+class RoleRegistry:
+    """
+    Таблица ролей (id -> имя) в памяти процесса. Ролей немного и они почти не меняются,
+    поэтому проверки ролей не обращаются к базе данных.
+    Заполняется RoleModel.load_registry при запуске и дополняется при обращении к неизвестной роли
+    """
+    def __init__(self):
+        self._names: dict = {}
+        self._ids: dict = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def load(self, roles: Iterable[Tuple[int, str]]):
+        """
+        Заменяет содержимое реестра парами (id, имя)
+        """
+        self.clear()
+        for role_id, name in roles:
+            self.add(role_id, name)
+
+    def add(self, role_id: int, name: str):
+        old_name = self._names.get(role_id)
+        if old_name is not None:
+            self._ids.pop(old_name, None)
+        self._names[role_id] = name
+        self._ids[name] = role_id
+
+    def name(self, role_id: Optional[int]) -> Optional[str]:
+        return self._names.get(role_id)
+
+    def id(self, name: str) -> Optional[int]:
+        return self._ids.get(name)
+
+    def clear(self):
+        self._names.clear()
+        self._ids.clear()
+
+
+role_registry = RoleRegistry()
+
+
+def user_role_name(user) -> Optional[str]:
+    """
+    Имя роли пользователя по role_id. Если роли нет в реестре, берется из связи user.role,
+    поэтому она должна быть загружена вместе с пользователем (joinedload)
+    """
+    if user.role_id is None:
+        return None
+    name = role_registry.name(user.role_id)
+    if name is None and user.role is not None:
+        name = user.role.role
+        role_registry.add(user.role_id, name)
+    return name
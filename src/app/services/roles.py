@@ -1,22 +1,63 @@
-from .auth import current_user
+from .auth import current_user, current_user_claims
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 from fastapi import HTTPException, status, Depends
-from app.models.auth import UserAuthModel
+from app.models.auth import UserAuthModel, UserClaims
+from app.services.role_registry import user_role_name
+from app.services.permissions import Permission, has_permissions
 from app.db import get_session
 
 def require_role(role: str):
     async def role_checker(current_user = Depends(current_user)):
-        if current_user.role is None:
+        # имя роли берется из реестра ролей по role_id, без обращения к связи current_user.role
+        role_name = user_role_name(current_user)
+        if role_name is None:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="User have not any role"
 			)
-        if current_user.role.role != role:
+        if role_name != role:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You do not have the required role",
             )
         return current_user
     return role_checker
+
+def require_role_claims(role: str):
+    """
+    Аналог require_role, который проверяет роль по claims access токена без загрузки пользователя
+    """
+    async def role_checker(claims: UserClaims = Depends(current_user_claims)):
+        if claims.role is None:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="User have not any role"
+            )
+        if claims.role != role:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You do not have the required role",
+            )
+        return claims
+    return role_checker
+
+
+def require_permissions(*permissions: Permission):
+    """
+    Проверяет, что у пользователя есть все указанные разрешения (с учетом наследования ролей).
+    Маска берется из claims access токена, для thin токенов вычисляется по роли из базы данных
+    """
+    required = 0
+    for permission in permissions:
+        required |= permission
+
+    async def permissions_checker(claims: UserClaims = Depends(current_user_claims)):
+        if not has_permissions(claims.permissions, required):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You do not have the required permissions",
+            )
+        return claims
+    return permissions_checker
@@ -0,0 +1,252 @@
+"""
+Сессии (устройства) пользователей. Сессия создается при входе, ее id передается в refresh токене (claim sid)
+и сохраняется при замене токена. Пользователь видит список своих сессий и может завершить любую из них -
+все токены ее семейства отзываются.
+
+Время последнего использования не записывается при каждом обновлении токена: отметки копятся в памяти воркера
+(последняя на сессию) и записываются одним запросом раз в SESSION_ACTIVITY_FLUSH_INTERVAL секунд,
+а также при остановке приложения
+"""
+import asyncio
+import base64
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import Request
+from sqlalchemy import select, update, delete, func, bindparam, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine
+
+from app.db import async_session
+from app.models.sessions import SessionModel
+from app.services.token_store import get_token_store
+from app.logger import logger
+
+SESSION_ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("SESSION_ACTIVITY_FLUSH_INTERVAL", 30))
+# при таком количестве ожидающих отметок запись выполняется, не дожидаясь интервала
+SESSION_ACTIVITY_MAX_PENDING = int(os.environ.get("SESSION_ACTIVITY_MAX_PENDING", 10000))
+SESSIONS_PAGE_SIZE = 20
+SESSIONS_MAX_PAGE_SIZE = 100
+# заголовок, в котором клиент может передать понятное пользователю название устройства
+DEVICE_HEADER = "x-device-name"
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def client_info(request: Request) -> dict:
+    """
+    Данные устройства из запроса на вход
+    """
+    device = request.headers.get(DEVICE_HEADER)
+    user_agent = request.headers.get("user-agent")
+    return {
+        "device": device[:100] if device else None,
+        "ip": request.client.host if request.client else None,
+        "user_agent": user_agent[:255] if user_agent else None,
+    }
+
+
+def new_session(session_id: str, user_id: int, family_id: bytes, expires_at: datetime,
+                client: Optional[dict] = None) -> SessionModel:
+    return SessionModel(id=session_id, user_id=user_id, family_id=family_id, expires_at=expires_at, **(client or {}))
+
+
+def _utc(moment: datetime) -> datetime:
+    # SQLite возвращает даты без часового пояса
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+class SessionActivity:
+    """
+    Отметки использования сессий, ожидающие записи в базу: id сессии -> (last_used_at, expires_at или None)
+    """
+    def __init__(self, session_factory=async_session, interval: float = SESSION_ACTIVITY_FLUSH_INTERVAL,
+                 max_pending: int = SESSION_ACTIVITY_MAX_PENDING):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: dict = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, session_id: str, expires_at: Optional[datetime] = None):
+        """
+        Отмечает использование сессии, expires_at - новый срок действия, если токен был заменен
+        """
+        self._pending[session_id] = (datetime.now(timezone.utc), expires_at)
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def pending(self, session_id: str) -> Optional[tuple]:
+        return self._pending.get(session_id)
+
+    def discard(self, session_id: str):
+        self._pending.pop(session_id, None)
+
+    async def flush(self) -> int:
+        """
+        Записывает накопленные отметки одним запросом, возвращает количество записанных.
+        Отметка не перезаписывает более позднюю, уже записанную другим воркером
+        """
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        table = SessionModel.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("session_id"), table.c.last_used_at < bindparam("last_used_at"))
+            .values(
+                last_used_at=bindparam("last_used_at"),
+                expires_at=func.coalesce(bindparam("new_expires_at", type_=table.c.expires_at.type), table.c.expires_at),
+            )
+        )
+        rows = [
+            {"session_id": session_id, "last_used_at": last_used_at, "new_expires_at": expires_at}
+            for session_id, (last_used_at, expires_at) in pending.items()
+        ]
+        try:
+            async with self.session_factory() as session:
+                await session.execute(statement, rows)
+                await session.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"Не удалось записать время использования сессий: {e}")
+            # отметки, появившиеся во время записи, новее возвращаемых
+            for session_id, value in pending.items():
+                if len(self._pending) >= self.max_pending:
+                    break
+                self._pending.setdefault(session_id, value)
+            return 0
+        return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+session_activity = SessionActivity()
+
+
+def encode_cursor(session: SessionModel) -> str:
+    value = f"{_utc(session.expires_at).isoformat()}|{session.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    (expires_at, id) последней сессии предыдущей страницы, ValueError для некорректного курсора
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        expires_at, session_id = value.split("|", 1)
+        return datetime.fromisoformat(expires_at), session_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+async def list_sessions(user_id: int, db: AsyncSession, limit: int = SESSIONS_PAGE_SIZE,
+                        cursor: Optional[str] = None) -> tuple:
+    """
+    Страница действующих сессий пользователя, начиная с самых долгоживущих, и курсор следующей страницы.
+    Страница читается по индексу (user_id, expires_at) с условием на последнюю запись предыдущей страницы
+    вместо OFFSET, поэтому ее стоимость не зависит от номера страницы
+    """
+    statement = (
+        select(SessionModel)
+        .where(SessionModel.user_id == user_id, SessionModel.expires_at > datetime.now(timezone.utc))
+        .order_by(SessionModel.expires_at.desc(), SessionModel.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        expires_at, session_id = decode_cursor(cursor)
+        statement = statement.where(tuple_(SessionModel.expires_at, SessionModel.id) < tuple_(expires_at, session_id))
+    sessions = list((await db.execute(statement)).scalars())
+    next_cursor = encode_cursor(sessions[limit - 1]) if len(sessions) > limit else None
+    return sessions[:limit], next_cursor
+
+
+def session_info(session: SessionModel) -> dict:
+    last_used_at = session.last_used_at
+    # отметка этого воркера, еще не записанная в базу
+    pending = session_activity.pending(session.id)
+    if pending is not None:
+        last_used_at = pending[0]
+    return {
+        "id": session.id,
+        "device": session.device,
+        "ip": session.ip,
+        "user_agent": session.user_agent,
+        "created_at": _utc(session.created_at).isoformat(),
+        "last_used_at": _utc(last_used_at).isoformat(),
+        "expires_at": _utc(session.expires_at).isoformat(),
+    }
+
+
+async def revoke_session(user_id: int, session_id: str, db: AsyncSession) -> bool:
+    """
+    Завершает сессию пользователя и отзывает ее токены, False если у пользователя нет такой сессии
+    """
+    session = await db.get(SessionModel, session_id)
+    if session is None or session.user_id != user_id:
+        return False
+    await db.delete(session)
+    await get_token_store().revoke_family(session.family_id, db)
+    await db.commit()
+    session_activity.discard(session_id)
+    return True
+
+
+async def end_session(session_id: str, db: AsyncSession):
+    """
+    Удаляет сессию после выхода (токен уже отозван)
+    """
+    await db.execute(delete(SessionModel).where(SessionModel.id == session_id))
+    await db.commit()
+    session_activity.discard(session_id)
+
+
+async def end_all_sessions(user_id: int, db: AsyncSession):
+    await db.execute(delete(SessionModel).where(SessionModel.user_id == user_id))
+    await db.commit()
+
+
+async def cleanup_expired_sessions(engine: AsyncEngine, batch_size: int = 1000, pause: float = 0.0) -> int:
+    """
+    Удаляет истекшие сессии пачками, возвращает количество удаленных
+    """
+    removed = 0
+    async with engine.connect() as conn:
+        while True:
+            expired = (
+                select(SessionModel.id)
+                .where(SessionModel.expires_at < datetime.now(timezone.utc))
+                .limit(batch_size)
+            )
+            try:
+                result = await conn.execute(delete(SessionModel).where(SessionModel.id.in_(expired)))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+            removed += result.rowcount
+            if result.rowcount < batch_size:
+                return removed
+            await asyncio.sleep(pause)
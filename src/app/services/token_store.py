@@ -0,0 +1,722 @@
+import os
+import re
+import asyncio
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy import select, update, insert, delete, or_, and_, exists, func, literal, text, true, false, LargeBinary, DateTime
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, AsyncConnection
+
+from app.db import engine, advisory_lock
+from app.models.auth import TokenModel, UserAuthModel, RoleModel
+from app.logger import logger
+
+# sql - таблица TokenModel, sql_partitioned - она же, секционированная по сроку действия (PostgreSQL),
+# redis - общее хранилище для нескольких воркеров и реплик, memory - для тестов
+TOKEN_STORE_BACKEND = os.environ.get("TOKEN_STORE_BACKEND", "sql")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379/0")
+# ключ advisory-блокировки, под которой очистку выполняет только один воркер
+TOKEN_CLEANUP_LOCK_KEY = 7_100_001
+# для TOKEN_STORE_BACKEND=sql_partitioned (только PostgreSQL): размер секции по сроку действия токенов
+# и на сколько дней вперед создаются секции - должно быть больше срока действия refresh токена (проверяется при запуске)
+TOKEN_PARTITION_PERIOD = os.environ.get("TOKEN_PARTITION_PERIOD", "day")  # day | week
+TOKEN_PARTITIONS_AHEAD_DAYS = int(os.environ.get("TOKEN_PARTITIONS_AHEAD_DAYS", 14))
+# ожидание блокировки таблицы при создании и удалении секций, чтобы не останавливать вход пользователей
+TOKEN_PARTITION_LOCK_TIMEOUT = os.environ.get("TOKEN_PARTITION_LOCK_TIMEOUT", "5s")
+# секция для токенов, срок действия которых не попал ни в одну секцию
+TOKEN_DEFAULT_PARTITION = "tokenmodel_default"
+
+
+class TokenStoreUnavailable(Exception):
+    """
+    Хранилище токенов недоступно (ошибка соединения и т.п.)
+    """
+
+
+class TokenStore(ABC):
+    """
+    Хранилище refresh токенов. Токены хранятся по ключу token_id (sha256 от jti, см. tokens.refresh_token_id).
+    Сессия базы данных передается во все методы, хранилища, которые не работают с базой, ее игнорируют
+    """
+    @abstractmethod
+    async def add(self, token_id: bytes, user_id: int, expires_at: datetime, db: AsyncSession,
+                  family_id: Optional[bytes] = None) -> None:
+        """
+        Сохраняет новый токен, без family_id токен начинает новое семейство
+        """
+
+    def token_model(self, token_id: bytes, user_id: int, expires_at: datetime,
+                    family_id: Optional[bytes] = None) -> Optional[TokenModel]:
+        """
+        Строка таблицы токенов для отложенной записи при входе (app.services.write_behind),
+        None если хранилище не использует базу данных - тогда токен сохраняется через add
+        """
+        return None
+
+    @abstractmethod
+    async def get_user_id(self, token_id: bytes, db: AsyncSession, token_expires_at: Optional[datetime] = None) -> Optional[int]:
+        """
+        Возвращает id пользователя для действующего токена или None.
+        token_expires_at - срок действия из exp токена, если известен (ускоряет поиск в секционированной таблице)
+        """
+
+    @abstractmethod
+    async def rotate(self, token_id: bytes, new_token_id: bytes, expires_at: datetime, db: AsyncSession,
+                     token_expires_at: Optional[datetime] = None) -> Optional[int]:
+        """
+        Атомарно заменяет действующий токен новым из того же семейства и возвращает id пользователя.
+        Если токен уже был заменен (повторное использование, например украденного токена),
+        отзывает все семейство и возвращает None
+        """
+
+    async def rotate_with_user(self, token_id: bytes, new_token_id: bytes, expires_at: datetime, db: AsyncSession,
+                               token_expires_at: Optional[datetime] = None) -> tuple:
+        """
+        То же, что rotate, и данные пользователя для claims access токена: словарь с колонками
+        is_active, is_superuser, token_version, role_id и role (имя роли), если хранилище получает их
+        тем же запросом, иначе None - тогда пользователь читается отдельно
+        """
+        return await self.rotate(token_id, new_token_id, expires_at, db, token_expires_at=token_expires_at), None
+
+    @abstractmethod
+    async def revoke(self, token_id: bytes, db: AsyncSession, token_expires_at: Optional[datetime] = None) -> bool:
+        """
+        Отзывает токен, возвращает False если токен не найден
+        """
+
+    @abstractmethod
+    async def revoke_all(self, user_id: int, db: AsyncSession) -> None:
+        """
+        Отзывает все токены пользователя
+        """
+
+    @abstractmethod
+    async def revoke_family(self, family_id: bytes, db: AsyncSession) -> int:
+        """
+        Отзывает все токены семейства (одной сессии пользователя), возвращает количество отозванных
+        """
+
+    @abstractmethod
+    async def cleanup(self, batch_size: int = 1000, pause: float = 0.0) -> int:
+        """
+        Удаляет отозванные и просроченные токены пачками по batch_size с паузой pause секунд между ними,
+        возвращает количество удаленных
+        """
+
+
+def _same_token(token_hash, expires_at, token_id: bytes, token_expires_at: Optional[datetime]):
+    condition = token_hash == token_id
+    if token_expires_at is not None:
+        # в секционированной таблице условие по сроку действия оставляет в плане одну секцию
+        condition = and_(condition, expires_at == token_expires_at)
+    return condition
+
+
+class SQLTokenStore(TokenStore):
+    def __init__(self, engine: AsyncEngine = engine):
+        # движок для фоновой очистки, запросы из обработчиков идут через сессию запроса
+        self.engine = engine
+
+    def token_model(self, token_id, user_id, expires_at, family_id=None):
+        return TokenModel(token_hash=token_id, user_id=user_id, family_id=family_id or token_id, expires_at=expires_at)
+
+    async def add(self, token_id, user_id, expires_at, db, family_id=None):
+        db.add(self.token_model(token_id, user_id, expires_at, family_id))
+        await db.commit()
+
+    async def get_user_id(self, token_id, db, token_expires_at=None):
+        # токен и момент последнего выхода на всех устройствах проверяются одним запросом
+        statement = (
+            select(TokenModel.user_id)
+            .join(UserAuthModel, UserAuthModel.id == TokenModel.user_id)
+            .where(
+                _same_token(TokenModel.token_hash, TokenModel.expires_at, token_id, token_expires_at),
+                TokenModel.invalidated == False,
+                or_(UserAuthModel.tokens_valid_after == None, TokenModel.issued_at > UserAuthModel.tokens_valid_after),
+            )
+        )
+        result = await db.execute(statement)
+        return result.scalar_one_or_none()
+
+    async def rotate(self, token_id, new_token_id, expires_at, db, token_expires_at=None):
+        user_id, _ = await self.rotate_with_user(token_id, new_token_id, expires_at, db, token_expires_at=token_expires_at)
+        return user_id
+
+    async def rotate_with_user(self, token_id, new_token_id, expires_at, db, token_expires_at=None):
+        tokens = TokenModel.__table__
+        users = UserAuthModel.__table__
+        roles = RoleModel.__table__
+        now = datetime.now(timezone.utc)
+        same_token = _same_token(tokens.c.token_hash, tokens.c.expires_at, token_id, token_expires_at)
+        # у токенов, выданных до появления семейств, family_id пустой, семейство начинается с них
+        family = func.coalesce(tokens.c.family_id, tokens.c.token_hash)
+        revoked_by_user = exists().where(users.c.id == tokens.c.user_id, tokens.c.issued_at <= users.c.tokens_valid_after)
+        # старый токен помечается замененным только если он еще действует, поэтому из параллельных
+        # запросов с одним токеном его заменяет только один, остальные получают 401
+        consume = (
+            update(tokens)
+            .where(same_token, tokens.c.invalidated == false(), ~revoked_by_user)
+            .values(invalidated=True, rotated=True)
+            .returning(tokens.c.user_id, family.label("family_id"))
+        )
+        reused_family = select(family).where(same_token, tokens.c.rotated == true()).scalar_subquery()
+        # обе колонки индексированы, в отличие от coalesce(family_id, token_hash)
+        in_reused_family = or_(tokens.c.family_id == reused_family, tokens.c.token_hash == reused_family)
+
+        if db.bind.dialect.name == "postgresql":
+            # замена, выдача нового токена и отзыв семейства при повторном использовании - одним запросом
+            old = consume.cte("old")
+            new = (
+                insert(tokens)
+                .from_select(
+                    ["token_hash", "user_id", "family_id", "issued_at", "expires_at", "invalidated", "rotated"],
+                    select(
+                        literal(new_token_id, LargeBinary), old.c.user_id, old.c.family_id,
+                        literal(now, DateTime(timezone=True)), literal(expires_at, DateTime(timezone=True)),
+                        false(), false(),
+                    ),
+                )
+                .returning(tokens.c.user_id)
+                .cte("new")
+            )
+            reused = (
+                update(tokens)
+                .where(in_reused_family, ~exists(select(old.c.user_id)))
+                .values(invalidated=True)
+                .returning(tokens.c.token_hash)
+                .cte("reused")
+            )
+            # данные пользователя для claims access токена читаются тем же запросом
+            revoked_count = select(func.count().label("revoked")).select_from(reused).subquery("revoked_count")
+            statement = (
+                select(
+                    revoked_count.c.revoked, new.c.user_id, users.c.is_active, users.c.is_superuser,
+                    users.c.token_version, users.c.role_id, roles.c.role,
+                )
+                .select_from(
+                    revoked_count
+                    .outerjoin(new, true())
+                    .outerjoin(users, users.c.id == new.c.user_id)
+                    .outerjoin(roles, roles.c.id == users.c.role_id)
+                )
+            )
+            row = (await db.execute(statement)).one()
+            await db.commit()
+            user_id, revoked = row.user_id, row.revoked
+            user = None
+            # is_active пустой, если пользователь удален
+            if user_id is not None and row.is_active is not None:
+                user = {
+                    "is_active": row.is_active, "is_superuser": row.is_superuser,
+                    "token_version": row.token_version, "role_id": row.role_id, "role": row.role,
+                }
+        else:
+            # SQLite не поддерживает изменяющие CTE: те же шаги отдельными запросами в одной транзакции
+            user_id, revoked, user = None, 0, None
+            row = (await db.execute(consume)).first()
+            if row is not None:
+                await db.execute(insert(tokens).values(
+                    token_hash=new_token_id, user_id=row.user_id, family_id=row.family_id,
+                    issued_at=now, expires_at=expires_at, invalidated=False, rotated=False,
+                ))
+                user_id = row.user_id
+            else:
+                revoked = (await db.execute(update(tokens).where(in_reused_family).values(invalidated=True))).rowcount
+            await db.commit()
+
+        if revoked:
+            logger.warning(f"Повторное использование refresh токена, отозвано токенов семейства: {revoked}")
+        return user_id, user
+
+    async def revoke(self, token_id, db, token_expires_at=None):
+        statement = (
+            update(TokenModel)
+            .where(_same_token(TokenModel.token_hash, TokenModel.expires_at, token_id, token_expires_at))
+            .values(invalidated=True)
+            # сравнение дат не вычисляется в Python для объектов сессии, их состояние берется из RETURNING
+            .execution_options(synchronize_session="fetch")
+        )
+        result = await db.execute(statement)
+        await db.commit()
+        return result.rowcount > 0
+
+    async def revoke_all(self, user_id, db):
+        # одна строка пользователя вместо обновления всех его токенов,
+        # сами токены удаляются фоновой очисткой
+        statement = update(UserAuthModel).where(UserAuthModel.id == user_id).values(tokens_valid_after=datetime.now(timezone.utc))
+        await db.execute(statement)
+        await db.commit()
+
+    async def revoke_family(self, family_id, db):
+        statement = (
+            update(TokenModel)
+            .where(or_(TokenModel.family_id == family_id, TokenModel.token_hash == family_id), TokenModel.invalidated == False)
+            .values(invalidated=True)
+            .execution_options(synchronize_session="fetch")
+        )
+        result = await db.execute(statement)
+        await db.commit()
+        return result.rowcount
+
+    async def cleanup(self, batch_size=1000, pause=0.0):
+        removed = 0
+        async with self.engine.connect() as conn:
+            async with advisory_lock(conn, TOKEN_CLEANUP_LOCK_KEY) as acquired:
+                if not acquired:
+                    logger.info("Очистку токенов уже выполняет другой воркер")
+                    return 0
+                while True:
+                    # каждая пачка - отдельная короткая транзакция
+                    revoked_by_user = exists().where(
+                        UserAuthModel.id == TokenModel.user_id,
+                        TokenModel.issued_at <= UserAuthModel.tokens_valid_after,
+                    )
+                    # замененные токены хранятся до истечения срока, чтобы обнаружить их повторное использование
+                    expired = (
+                        select(TokenModel.token_hash)
+                        .where(or_(
+                            and_(TokenModel.invalidated == True, TokenModel.rotated == False),
+                            TokenModel.expires_at < datetime.now(timezone.utc),
+                            revoked_by_user,
+                        ))
+                        .limit(batch_size)
+                    )
+                    try:
+                        result = await conn.execute(delete(TokenModel).where(TokenModel.token_hash.in_(expired)))
+                        await conn.commit()
+                    except Exception:
+                        await conn.rollback()
+                        raise
+                    removed += result.rowcount
+                    if result.rowcount < batch_size:
+                        return removed
+                    await asyncio.sleep(pause)
+
+
+PARTITION_NAME = re.compile(r"^tokenmodel_p(\d{8})_(\d{8})$")
+
+
+def partition_start(moment: datetime, period: str = TOKEN_PARTITION_PERIOD) -> datetime:
+    """
+    Начало секции, в которую попадает moment: полночь UTC, для недельных секций - понедельник
+    """
+    start = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        start -= timedelta(days=start.weekday())
+    elif period != "day":
+        raise ValueError(f"Неизвестный период секций: {period}")
+    return start
+
+
+def check_partition_settings(token_lifetime: timedelta, period: str = TOKEN_PARTITION_PERIOD,
+                             ahead_days: int = TOKEN_PARTITIONS_AHEAD_DAYS):
+    """
+    ValueError, если секции создаются на срок меньше срока действия refresh токена
+    (с запасом в сутки, чтобы очистка успевала создать следующую секцию)
+    """
+    partition_start(datetime.now(timezone.utc), period)
+    if timedelta(days=ahead_days) < token_lifetime + timedelta(days=1):
+        raise ValueError(
+            f"TOKEN_PARTITIONS_AHEAD_DAYS={ahead_days} должно быть больше срока действия refresh токена "
+            f"({token_lifetime}) хотя бы на сутки"
+        )
+
+
+def partition_name(start: datetime, end: datetime) -> str:
+    return f"tokenmodel_p{start:%Y%m%d}_{end:%Y%m%d}"
+
+
+async def list_token_partitions(conn: AsyncConnection) -> list:
+    """
+    Секции таблицы токенов: список (начало, конец, имя), отсортированный по началу
+    """
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'tokenmodel'::regclass"
+    ))
+    partitions = []
+    for name in result.scalars():
+        if name == TOKEN_DEFAULT_PARTITION:
+            continue
+        match = PARTITION_NAME.match(name)
+        if match is None:
+            logger.warning(f"Секция {name} создана вручную, она не удаляется очисткой")
+            continue
+        start, end = (datetime.strptime(value, "%Y%m%d").replace(tzinfo=timezone.utc) for value in match.groups())
+        partitions.append((start, end, name))
+    return sorted(partitions)
+
+
+async def maintain_token_partitions(conn: AsyncConnection, now: Optional[datetime] = None,
+                                    period: str = TOKEN_PARTITION_PERIOD,
+                                    ahead_days: int = TOKEN_PARTITIONS_AHEAD_DAYS) -> tuple:
+    """
+    Создает секции до now + ahead_days и удаляет секции, все токены которых истекли.
+    Токены, для которых не нашлось секции, попадают в секцию DEFAULT, при создании секции
+    они переносятся в нее. Возвращает списки имен созданных и удаленных секций и оценку количества
+    удаленных строк (по статистике PostgreSQL, без подсчета). Выполняется в транзакции conn
+    """
+    now = now or datetime.now(timezone.utc)
+    until = now + timedelta(days=ahead_days)
+    await conn.execute(text("SELECT set_config('lock_timeout', :value, true)"), {"value": TOKEN_PARTITION_LOCK_TIMEOUT})
+    if not (await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": TOKEN_DEFAULT_PARTITION})).scalar():
+        await conn.execute(text(f"CREATE TABLE {TOKEN_DEFAULT_PARTITION} PARTITION OF tokenmodel DEFAULT"))
+    partitions = await list_token_partitions(conn)
+
+    dropped = []
+    removed = 0
+    for start, end, name in partitions:
+        if end <= now:
+            rows = (await conn.execute(text("SELECT reltuples FROM pg_class WHERE relname = :name"), {"name": name})).scalar()
+            await conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+            removed += max(int(rows or 0), 0)
+    partitions = [partition for partition in partitions if partition[2] not in dropped]
+    removed += (await conn.execute(
+        text(f"DELETE FROM {TOKEN_DEFAULT_PARTITION} WHERE expires_at < :now"), {"now": now},
+    )).rowcount
+
+    created = []
+    cursor = partition_start(now, period)
+    while cursor < until:
+        covering = next(((start, end) for start, end, _ in partitions if start <= cursor < end), None)
+        if covering is not None:
+            cursor = covering[1]
+            continue
+        # при смене периода новая секция не должна пересекаться с уже созданными
+        end = partition_start(cursor, period) + timedelta(days=7 if period == "week" else 1)
+        end = min([end] + [start for start, _, _ in partitions if start > cursor])
+        if end <= now:
+            # промежуток в прошлом, токены в него уже не попадут
+            cursor = end
+            continue
+        name = partition_name(cursor, end)
+        # секция подключается после переноса строк ее диапазона из DEFAULT, иначе PostgreSQL ее не создаст
+        await conn.execute(text(f"CREATE TABLE {name} (LIKE tokenmodel INCLUDING DEFAULTS)"))
+        moved = (await conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM {TOKEN_DEFAULT_PARTITION} WHERE expires_at >= :start AND expires_at < :end "
+                f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+            ),
+            {"start": cursor, "end": end},
+        )).rowcount
+        if moved:
+            logger.warning(f"Из секции {TOKEN_DEFAULT_PARTITION} в {name} перенесено токенов: {moved}")
+        await conn.execute(text(
+            f"ALTER TABLE tokenmodel ATTACH PARTITION {name} FOR VALUES FROM ('{cursor.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        partitions.append((cursor, end, name))
+        created.append(name)
+        cursor = end
+    return created, dropped, removed
+
+
+class PartitionedSQLTokenStore(SQLTokenStore):
+    """
+    Таблица токенов, секционированная по expires_at (PostgreSQL, см. app.migrations.partition_refresh_tokens).
+    Просроченные токены удаляются целыми секциями вместо удаления строк, поэтому таблица и индексы
+    не разрастаются и не нуждаются в частом vacuum. Отозванные токены остаются в своей секции до ее удаления,
+    проверка токена их уже не принимает. Истекшие токены секции DEFAULT удаляются построчно
+    """
+    async def cleanup(self, batch_size=1000, pause=0.0):
+        async with self.engine.connect() as conn:
+            async with advisory_lock(conn, TOKEN_CLEANUP_LOCK_KEY) as acquired:
+                if not acquired:
+                    logger.info("Очистку токенов уже выполняет другой воркер")
+                    return 0
+                try:
+                    created, dropped, removed = await maintain_token_partitions(conn)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        if created or dropped:
+            logger.info(f"Секции refresh токенов: создано {len(created)}, удалено {len(dropped)}")
+        return removed
+
+
+class RedisTokenStore(TokenStore):
+    """
+    Токены хранятся с TTL равным сроку действия, поэтому периодическая очистка не нужна.
+    Значение ключа токена - "user_id:family_id"
+    """
+    # Все ключи передаются в KEYS, имена ключей в скриптах не составляются (требование Redis Cluster).
+    # Семейство и пользователь становятся известны только после чтения токена, поэтому скрипт
+    # получает прочитанное значение и ничего не меняет, если оно успело измениться, - тогда чтение повторяется.
+    # KEYS: старый токен, новый токен, метка замены старого токена, множество семейства, множество пользователя
+    # ARGV: id старого токена, id нового токена, TTL нового токена, прочитанное значение старого токена
+    ROTATE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) ~= ARGV[4] then
+        return 0
+    end
+    local value = ARGV[4]
+    local sep = string.find(value, ':', 1, true)
+    local user_id = sep and string.sub(value, 1, sep - 1) or value
+    local family = sep and string.sub(value, sep + 1) or ARGV[1]
+    local old_ttl = math.max(redis.call('TTL', KEYS[1]), 1)
+    local ttl = tonumber(ARGV[3])
+    redis.call('DEL', KEYS[1])
+    redis.call('SET', KEYS[3], family, 'EX', old_ttl)
+    redis.call('SET', KEYS[2], user_id .. ':' .. family, 'EX', ttl)
+    redis.call('SREM', KEYS[4], ARGV[1])
+    redis.call('SADD', KEYS[4], ARGV[2])
+    redis.call('EXPIRE', KEYS[4], ttl)
+    redis.call('SREM', KEYS[5], ARGV[1])
+    redis.call('SADD', KEYS[5], ARGV[2])
+    if redis.call('TTL', KEYS[5]) < ttl then
+        redis.call('EXPIRE', KEYS[5], ttl)
+    end
+    return tonumber(user_id)
+    """
+    # KEYS: множество семейства, ключи токенов семейства, множества их пользователей
+    # ARGV: количество токенов, id токенов семейства (в порядке ключей)
+    # Возвращает -1, если состав семейства изменился после чтения, иначе количество удаленных токенов
+    REVOKE_FAMILY_SCRIPT = """
+    local count = tonumber(ARGV[1])
+    if redis.call('SCARD', KEYS[1]) ~= count then
+        return -1
+    end
+    local ids = {}
+    for i = 1, count do
+        if redis.call('SISMEMBER', KEYS[1], ARGV[i + 1]) == 0 then
+            return -1
+        end
+        ids[i] = ARGV[i + 1]
+    end
+    local removed = 0
+    for i = 2, count + 1 do
+        removed = removed + redis.call('DEL', KEYS[i])
+    end
+    if count > 0 then
+        for i = count + 2, #KEYS do
+            redis.call('SREM', KEYS[i], unpack(ids))
+        end
+    end
+    redis.call('DEL', KEYS[1])
+    return removed
+    """
+    # сколько раз повторять чтение, если токен или семейство изменились параллельным запросом
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, url: str = REDIS_URL):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._rotate = self.client.register_script(self.ROTATE_SCRIPT)
+        self._revoke_family = self.client.register_script(self.REVOKE_FAMILY_SCRIPT)
+
+    @staticmethod
+    def _token_key(token_id: str) -> str:
+        return f"refresh_token:{token_id}"
+
+    @staticmethod
+    def _user_key(user_id: int) -> str:
+        return f"user_refresh_tokens:{user_id}"
+
+    @staticmethod
+    def _family_key(family_id: str) -> str:
+        return f"refresh_family:{family_id}"
+
+    @staticmethod
+    def _rotated_key(token_id: str) -> str:
+        return f"refresh_rotated:{token_id}"
+
+    @staticmethod
+    def _parse_user_id(value: str) -> int:
+        # значения без семейства остались от версии без замены токенов
+        return int(value.split(":", 1)[0])
+
+    async def add(self, token_id, user_id, expires_at, db, family_id=None):
+        ttl = max(int((expires_at - datetime.now(timezone.utc)).total_seconds()), 1)
+        token_id = token_id.hex()
+        family_id = family_id.hex() if family_id is not None else token_id
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.set(self._token_key(token_id), f"{user_id}:{family_id}", ex=ttl)
+                pipe.sadd(self._user_key(user_id), token_id)
+                pipe.sadd(self._family_key(family_id), token_id)
+                pipe.expire(self._family_key(family_id), ttl)
+                # множество живет не меньше самого нового токена пользователя
+                pipe.expire(self._user_key(user_id), ttl, gt=True)
+                pipe.expire(self._user_key(user_id), ttl, nx=True)
+                await pipe.execute()
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+
+    async def get_user_id(self, token_id, db, token_expires_at=None):
+        try:
+            value = await self.client.get(self._token_key(token_id.hex()))
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+        return self._parse_user_id(value) if value is not None else None
+
+    async def _try_revoke_family(self, family_id: str) -> Optional[int]:
+        """
+        Удаляет токены семейства и их id из множеств пользователей, None если семейство изменилось во время чтения
+        """
+        family_key = self._family_key(family_id)
+        token_ids = sorted(await self.client.smembers(family_key))
+        async with self.client.pipeline(transaction=False) as pipe:
+            for token_id in token_ids:
+                pipe.get(self._token_key(token_id))
+            values = await pipe.execute()
+        user_keys = sorted({self._user_key(self._parse_user_id(value)) for value in values if value is not None})
+        removed = await self._revoke_family(
+            keys=[family_key, *(self._token_key(token_id) for token_id in token_ids), *user_keys],
+            args=[len(token_ids), *token_ids],
+        )
+        return removed if removed >= 0 else None
+
+    async def rotate(self, token_id, new_token_id, expires_at, db, token_expires_at=None):
+        ttl = max(int((expires_at - datetime.now(timezone.utc)).total_seconds()), 1)
+        token_id, new_token_id = token_id.hex(), new_token_id.hex()
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                value = await self.client.get(self._token_key(token_id))
+                if value is None:
+                    family_id = await self.client.get(self._rotated_key(token_id))
+                    if family_id is None:
+                        return None
+                    # токен уже был заменен: отзываем все семейство
+                    removed = await self._try_revoke_family(family_id)
+                    if removed is None:
+                        continue
+                    logger.warning(f"Повторное использование refresh токена, отозвано токенов семейства: {removed}")
+                    return None
+                _, _, family_id = value.partition(":")
+                family_id = family_id or token_id
+                # скрипт выполняется в Redis атомарно, за одно обращение
+                user_id = await self._rotate(
+                    keys=[
+                        self._token_key(token_id), self._token_key(new_token_id), self._rotated_key(token_id),
+                        self._family_key(family_id), self._user_key(self._parse_user_id(value)),
+                    ],
+                    args=[token_id, new_token_id, ttl, value],
+                )
+                if user_id:
+                    return user_id
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+        raise TokenStoreUnavailable("Refresh token is being modified concurrently")
+
+    async def revoke(self, token_id, db, token_expires_at=None):
+        token_id = token_id.hex()
+        try:
+            value = await self.client.getdel(self._token_key(token_id))
+            if value is None:
+                return False
+            await self.client.srem(self._user_key(self._parse_user_id(value)), token_id)
+            return True
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+
+    async def revoke_all(self, user_id, db):
+        try:
+            token_ids = await self.client.smembers(self._user_key(user_id))
+            keys = [self._token_key(token_id) for token_id in token_ids]
+            await self.client.delete(self._user_key(user_id), *keys)
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+
+    async def revoke_family(self, family_id, db):
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                removed = await self._try_revoke_family(family_id.hex())
+                if removed is not None:
+                    return removed
+        except RedisError as e:
+            raise TokenStoreUnavailable(str(e)) from e
+        raise TokenStoreUnavailable("Token family is being modified concurrently")
+
+    async def cleanup(self, batch_size=1000, pause=0.0):
+        return 0
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    Хранилище в памяти процесса, используется в тестах
+    """
+    def __init__(self):
+        self._tokens: dict = {}  # token_id -> (user_id, expires_at, family_id)
+        self._user_tokens: dict = {}  # user_id -> set(token_id)
+        self._rotated: dict = {}  # id замененного токена -> (family_id, expires_at)
+
+    async def add(self, token_id, user_id, expires_at, db, family_id=None):
+        self._tokens[token_id] = (user_id, expires_at, family_id or token_id)
+        self._user_tokens.setdefault(user_id, set()).add(token_id)
+
+    async def get_user_id(self, token_id, db, token_expires_at=None):
+        item = self._tokens.get(token_id)
+        if item is None or item[1] <= datetime.now(timezone.utc):
+            return None
+        return item[0]
+
+    async def rotate(self, token_id, new_token_id, expires_at, db, token_expires_at=None):
+        user_id = await self.get_user_id(token_id, db)
+        if user_id is None:
+            rotated = self._rotated.get(token_id)
+            if rotated is not None:
+                family = [other for other, item in self._tokens.items() if item[2] == rotated[0]]
+                for other in family:
+                    await self.revoke(other, db)
+                logger.warning(f"Повторное использование refresh токена, отозвано токенов семейства: {len(family)}")
+            return None
+        _, old_expires_at, family_id = self._tokens[token_id]
+        await self.revoke(token_id, db)
+        self._rotated[token_id] = (family_id, old_expires_at)
+        await self.add(new_token_id, user_id, expires_at, db, family_id=family_id)
+        return user_id
+
+    async def revoke(self, token_id, db, token_expires_at=None):
+        item = self._tokens.pop(token_id, None)
+        if item is None:
+            return False
+        self._user_tokens.get(item[0], set()).discard(token_id)
+        return True
+
+    async def revoke_all(self, user_id, db):
+        for token_id in self._user_tokens.pop(user_id, set()):
+            self._tokens.pop(token_id, None)
+
+    async def revoke_family(self, family_id, db):
+        family = [token_id for token_id, item in self._tokens.items() if item[2] == family_id]
+        for token_id in family:
+            await self.revoke(token_id, db)
+        return len(family)
+
+    async def cleanup(self, batch_size=1000, pause=0.0):
+        now = datetime.now(timezone.utc)
+        expired = [token_id for token_id, item in self._tokens.items() if item[1] <= now]
+        for token_id in expired:
+            await self.revoke(token_id, None)
+        self._rotated = {token_id: item for token_id, item in self._rotated.items() if item[1] > now}
+        return len(expired)
+
+
+_token_store: Optional[TokenStore] = None
+
+def create_token_store(backend: str = TOKEN_STORE_BACKEND) -> TokenStore:
+    if backend == "sql":
+        return SQLTokenStore()
+    if backend == "sql_partitioned":
+        return PartitionedSQLTokenStore()
+    if backend == "redis":
+        return RedisTokenStore()
+    if backend == "memory":
+        return MemoryTokenStore()
+    raise ValueError(f"Неизвестное хранилище токенов: {backend}")
+
+def get_token_store() -> TokenStore:
+    global _token_store
+    if _token_store is None:
+        _token_store = create_token_store()
+        logger.info(f"Хранилище refresh токенов: {type(_token_store).__name__}")
+    return _token_store
+
+def set_token_store(store: Optional[TokenStore]):
+    """
+    Подменяет хранилище токенов (для тестов), None - вернуть хранилище по умолчанию
+    """
+    global _token_store
+    _token_store = store
@@ -1,16 +1,30 @@
 from fastapi import Cookie
-from jose import jwt, JWTError
+from jose import JWTError
 from datetime import datetime, timedelta, timezone
-from typing import Union, Any
+from typing import Union, Any, Optional, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 import os
+import time
+import uuid
+import hashlib
 from sqlalchemy.exc import OperationalError, SQLAlchemyError, NoResultFound
 from dotenv import load_dotenv
 from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 from fastapi import HTTPException, status
 
+from app.metrics import observe_stage
 from app.logger import logger
-from app.models.auth import TokenModel
+from app.models.auth import UserAuthModel
+from app.services.role_registry import user_role_name
+from app.services.permissions import permissions_for
+from app.services.keys import get_key_ring
+from app.services.jwt_backends import create_jwt_backend
+from app.services.cache import access_token_cache
+from app.services.token_store import (
+    get_token_store, check_partition_settings, TokenStoreUnavailable, TOKEN_STORE_BACKEND,
+)
+from app.services.sessions import session_activity, end_session
 
 
 # для работы с .env
@@ -21,30 +35,112 @@ load_dotenv()
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  # 30 минут
 REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 7 дней
-ALGORITHM = "HS256"
+ALGORITHM = "HS256"  # refresh токены и access токены без JWT_ALGORITHM, см. app.services.keys
 JWT_SECRET_KEY = os.environ['JWT_SECRET_KEY']   # обязательно сохранять в секрете
 JWT_REFRESH_SECRET_KEY = os.environ['JWT_REFRESH_SECRET_KEY']   # обязательно сохранять в секрете
+# thin - в access токене только email,
+# fat - еще id, роль, флаги и версия токенов пользователя, см. current_user_claims
+ACCESS_TOKEN_MODE = os.environ.get("ACCESS_TOKEN_MODE", "thin")
+# в режиме fat добавлять в токен маску разрешений (claim perm), иначе она вычисляется по роли при проверке
+ACCESS_TOKEN_PERMISSIONS = os.environ.get("ACCESS_TOKEN_PERMISSIONS", "true").lower() == "true"
+# при каждом обновлении refresh токен заменяется новым (см. TokenStore.rotate)
+REFRESH_TOKEN_ROTATION = os.environ.get("REFRESH_TOKEN_ROTATION", "true").lower() == "true"
+
+jwt_backend = create_jwt_backend()
+
+if TOKEN_STORE_BACKEND == "sql_partitioned":
+    # токен со сроком за пределами созданных секций попадет в секцию DEFAULT
+    check_partition_settings(timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES))
 
 # функция для создания access JWT токена
-def create_access_token(subject: Union[str, Any], expires_delta: int = None) -> str:
-    if expires_delta is not None:
-        expires_delta = datetime.now(timezone.utc) + expires_delta
-    else:
-        expires_delta = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode = {"exp": expires_delta, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, ALGORITHM)
+def create_access_token(subject: Union[str, Any], expires_delta: int = None, claims: Optional[dict] = None) -> str:
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # exp сразу в секундах (NumericDate), без промежуточного datetime
+    to_encode = {"exp": int(time.time() + expires_delta.total_seconds()), "sub": str(subject)}
+    if claims:
+        to_encode.update(claims)
+    key_ring = get_key_ring()
+    if key_ring is not None:
+        # асимметричная подпись, kid в заголовке указывает другим сервисам ключ из JWKS
+        key = key_ring.active_key()
+        return jwt_backend.encode(to_encode, key.private_pem, key.algorithm, headers={"kid": key.kid})
+    encoded_jwt = jwt_backend.encode(to_encode, JWT_SECRET_KEY, ALGORITHM)
     return encoded_jwt
 
+def user_token_claims(user: UserAuthModel) -> Optional[dict]:
+    """
+    Дополнительные claims access токена для режима fat, см. user_role_name
+    """
+    if ACCESS_TOKEN_MODE != "fat":
+        return None
+    return token_claims(user.id, user_role_name(user), user.is_active, user.is_superuser, user.token_version)
+
+def token_claims(user_id: int, role: Optional[str], is_active: bool, is_superuser: bool, token_version: int) -> dict:
+    claims = {
+        "uid": user_id,
+        "role": role,
+        "act": is_active,
+        "su": is_superuser,
+        "ver": token_version,
+    }
+    if ACCESS_TOKEN_PERMISSIONS:
+        claims["perm"] = permissions_for(role, is_superuser)
+    return claims
+
 # функция для создания refresh JWT токена
 def create_refresh_token(subject: Union[str, Any], expires_delta: int = None) -> str:
-    if expires_delta is not None:
-        expires_delta = datetime.now(timezone.utc) + expires_delta
-    else:
-        expires_delta = datetime.now(timezone.utc) + timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
+    refresh_token, _, _ = issue_refresh_token(subject, expires_delta)
+    return refresh_token
 
-    to_encode = {"exp": expires_delta, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, JWT_REFRESH_SECRET_KEY, ALGORITHM)
-    return encoded_jwt
+def issue_refresh_token(subject: Union[str, Any], expires_delta: timedelta = None,
+                        session_id: Optional[str] = None) -> Tuple[str, bytes, datetime]:
+    """
+    Создает refresh токен с уникальным jti, session_id - id сессии (app.services.sessions).
+    Возвращает сам токен, его ключ в хранилище токенов и срок действия
+    """
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
+    # exp в JWT хранится с точностью до секунды, срок в хранилище должен с ним совпадать
+    expires_at = (datetime.now(timezone.utc) + expires_delta).replace(microsecond=0)
+    jti = uuid.uuid4().hex
+
+    to_encode = {"exp": expires_at, "sub": str(subject), "jti": jti}
+    if session_id is not None:
+        to_encode["sid"] = session_id
+    encoded_jwt = jwt_backend.encode(to_encode, JWT_REFRESH_SECRET_KEY, ALGORITHM)
+    return encoded_jwt, refresh_token_id(to_encode, encoded_jwt), expires_at
+
+def refresh_token_id(payload: dict, token: str) -> bytes:
+    """
+    Ключ refresh токена в хранилище: sha256 от jti.
+    У токенов, выданных до появления jti, ключ считается от всего токена
+    """
+    jti = payload.get("jti")
+    return hashlib.sha256((jti or token).encode()).digest()
+
+def refresh_token_expires_at(payload: dict) -> Optional[datetime]:
+    """
+    Срок действия refresh токена из exp, совпадает с expires_at в хранилище
+    """
+    exp = payload.get("exp")
+    return datetime.fromtimestamp(exp, timezone.utc) if isinstance(exp, (int, float)) else None
+
+def get_refresh_token_id(token: str) -> Optional[bytes]:
+    """
+    Проверяет подпись refresh токена и возвращает его ключ в хранилище, None для невалидных токенов
+    """
+    key = get_refresh_token_key(token)
+    return key[0] if key is not None else None
+
+def get_refresh_token_key(token: str) -> Optional[Tuple[bytes, Optional[datetime]]]:
+    """
+    Ключ refresh токена в хранилище и срок его действия, None для невалидных токенов
+    """
+    payload = decode_refresh_token(token)
+    if payload is None:
+        return None
+    return refresh_token_id(payload, token), refresh_token_expires_at(payload)
 
 # функция для обновления access токена
 async def refresh_access_token(refresh_token: str, db: AsyncSession):
@@ -55,28 +151,58 @@ async def refresh_access_token(refresh_token: str, db: AsyncSession):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        # проверяем наличие токена в базе данных
-        statement = select(TokenModel).where(TokenModel.token==refresh_token)
-        token_check = await db.execute(statement)
-        result = token_check.scalar_one_or_none()
-        if result is not None:
-            # пробуем раскодировать токен
-            try:
-                payload = decode_refresh_token(refresh_token)
-                email: str = payload.get('sub')
-                if email is None:
+        # проверяем подпись и срок действия токена, после этого ищем его в хранилище
+        with observe_stage("refresh.decode"):
+            payload = decode_refresh_token(refresh_token)
+        user_id = None
+        user = None
+        new_refresh_token = None
+        if payload is not None and payload.get('sub') is not None:
+            token_id = refresh_token_id(payload, refresh_token)
+            token_expires_at = refresh_token_expires_at(payload)
+            with observe_stage("refresh.token_lookup"):
+                if REFRESH_TOKEN_ROTATION:
+                    # старый токен заменяется новым, повторное использование старого отзывает все семейство
+                    new_refresh_token, new_token_id, expires_at = issue_refresh_token(
+                        payload['sub'], session_id=payload.get('sid'),
+                    )
+                    # в режиме fat данные пользователя для claims возвращает тот же запрос, если хранилище это умеет
+                    user_id, user = await get_token_store().rotate_with_user(
+                        token_id, new_token_id, expires_at, db, token_expires_at=token_expires_at,
+                    )
+                    if user_id is None and payload.get('sid'):
+                        # токен уже заменен или отозван, семейство отозвано - сессия больше не действует
+                        await end_session(payload['sid'], db)
+                else:
+                    user_id = await get_token_store().get_user_id(token_id, db, token_expires_at=token_expires_at)
+        if user_id is not None:
+            if payload.get('sid'):
+                # время использования сессии записывается позже, вместе с отметками других сессий
+                session_activity.touch(payload['sid'], expires_at if new_refresh_token is not None else None)
+            email: str = payload.get('sub')
+            # в режиме fat claims берутся из актуальных данных пользователя
+            claims = None
+            if ACCESS_TOKEN_MODE == "fat" and user is not None:
+                claims = token_claims(user_id, user["role"], user["is_active"], user["is_superuser"], user["token_version"])
+            elif ACCESS_TOKEN_MODE == "fat":
+                statement = select(UserAuthModel).where(UserAuthModel.email == email).options(joinedload(UserAuthModel.role))
+                with observe_stage("refresh.user_lookup"):
+                    user = (await db.execute(statement)).scalar_one_or_none()
+                if user is None:
                     raise credentials_exception
-            except JWTError:
-                raise credentials_exception
-            
-            # Проверяем, что refresh-токен не истек
-            if datetime.now(timezone.utc) > datetime.fromtimestamp(payload.get('exp'), timezone.utc):
-                raise HTTPException(status_code=401, detail='Refresh token expired')
+                claims = user_token_claims(user)
             # создаем новый access токен
-            new_access_token = create_access_token(email)
-            return {'access_token': new_access_token, 'token_type': 'bearer'}
+            with observe_stage("refresh.token_encode"):
+                new_access_token = create_access_token(email, claims=claims)
+            result = {'access_token': new_access_token, 'token_type': 'bearer'}
+            if new_refresh_token is not None:
+                result['refresh_token'] = new_refresh_token
+            return result
         else:
             raise HTTPException(status_code=401, detail='Refresh token expired or not found')
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
+        raise HTTPException(status_code=503, detail="Service unavailable")
     except OperationalError as e:
         logger.error(f"Ошибка соединения с базой данных: {e}")
         raise HTTPException(status_code=503, detail="Service unavailable")
@@ -98,15 +224,39 @@ async def get_refresh_token(refresh_token: str = Cookie(None)):
 
 
 def decode_access_token(token: str):
+    """
+    Проверяет access токен. Один и тот же токен приходит во многих запросах,
+    поэтому уже проверенные токены кэшируются по sha256 до истечения exp (но не дольше ACCESS_TOKEN_CACHE_TTL)
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = access_token_cache.get(digest)
+    if payload is not None:
+        # копия, чтобы изменения у вызывающего не попали в кэш
+        return dict(payload)
+
+    payload = _decode_access_token(token)
+    if payload is not None and isinstance(payload.get("exp"), (int, float)):
+        ttl = min(payload["exp"] - time.time(), access_token_cache.ttl)
+        access_token_cache.set(digest, dict(payload), ttl=ttl)
+    return payload
+
+def _decode_access_token(token: str):
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, ALGORITHM)
+        key_ring = get_key_ring()
+        if key_ring is not None:
+            # ключ выбирается по kid, алгоритм фиксирован, чтобы нельзя было подсунуть токен с alg=HS256
+            key = key_ring.verification_key(jwt_backend.get_unverified_header(token).get("kid"))
+            if key is None:
+                return None
+            return jwt_backend.decode(token, key, algorithms=[key_ring.algorithm])
+        payload = jwt_backend.decode(token, JWT_SECRET_KEY, [ALGORITHM])
         return payload
     except JWTError:
         return None
     
 def decode_refresh_token(token: str):
     try:
-        payload = jwt.decode(token, JWT_REFRESH_SECRET_KEY, ALGORITHM)
+        payload = jwt_backend.decode(token, JWT_REFRESH_SECRET_KEY, [ALGORITHM])
         return payload
     except JWTError:
         return None
\ No newline at end of file
@@ -0,0 +1,291 @@
+"""
+Массовый импорт пользователей из CSV или JSONL (например, перенос из старой системы).
+
+Поля строки: username, email и password (открытый пароль, проверяется как при /signup) или password_hash
+(готовый хэш схемы из PASSWORD_SCHEMES, например bcrypt из старой системы - при первом входе он будет
+пересчитан, если схема или стоимость устарели). Файл читается потоково, пачками по IMPORT_BATCH_SIZE строк:
+существующие email отсеиваются одним запросом на пачку до хэширования, пароли хэшируются параллельно
+в пуле процессов (CLI) или небольшими частями в общем пуле хэширования приложения (импорт через API),
+пачка вставляется одним INSERT ... ON CONFLICT DO NOTHING.
+
+    python -m app.services.user_import users.csv --errors import_errors.csv
+"""
+import argparse
+import asyncio
+import csv
+import json
+import math
+import os
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+
+from pydantic import ValidationError, field_validator
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import Field
+
+from app.db import async_session, insert_ignore
+from app.models.auth import UserAuthModel, CreateUserModel, normalize_email
+from app.services.hashers import make_password, pwd_context, HasherPool
+from app.logger import logger
+
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+IMPORT_HASH_WORKERS = int(os.environ.get("IMPORT_HASH_WORKERS", os.cpu_count() or 1))
+# паролей в одной задаче общего пула хэширования: между задачами импорта выполняются хэши входов
+IMPORT_SHARED_HASH_CHUNK = 10
+
+FORMATS = ("csv", "jsonl")
+
+
+class ImportReport:
+    def __init__(self):
+        self.processed = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.errors: list = []  # (номер строки, email, ошибка)
+
+    def add_error(self, line: int, email: Optional[str], error: str):
+        self.errors.append((line, email, error))
+
+    def as_dict(self, max_errors: Optional[int] = None) -> dict:
+        errors = self.errors if max_errors is None else self.errors[:max_errors]
+        return {
+            "processed": self.processed,
+            "imported": self.imported,
+            "duplicates": self.duplicates,
+            "failed": len(self.errors) - self.duplicates,
+            "errors": [{"line": line, "email": email, "error": error} for line, email, error in errors],
+        }
+
+
+def detect_format(filename: str) -> str:
+    return "jsonl" if filename.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def read_rows(file: Iterable[str], fmt: str) -> Iterator[tuple]:
+    """
+    Потоково читает файл и отдает пары (номер строки, словарь полей или None для нечитаемой строки)
+    """
+    if fmt == "csv":
+        # номер строки с учетом заголовка
+        for line, row in enumerate(csv.DictReader(file), start=2):
+            yield line, row
+    elif fmt == "jsonl":
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            yield line, row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f"Неизвестный формат импорта: {fmt}")
+
+
+def hash_passwords(passwords: list) -> list:
+    # выполняется в пуле процессов
+    return [make_password(password) for password in passwords]
+
+
+class HashedUserModel(CreateUserModel):
+    """
+    Строка с готовым хэшем: username и email проверяются как при /signup, хэш - только по длине колонки
+    """
+    password: str = Field(max_length=100)
+
+    @field_validator("password")
+    def validate_password(cls, password):
+        return password
+
+
+def _validate_row(row: Optional[dict]) -> dict:
+    """
+    Значения для вставки в таблицу пользователей, ValueError для некорректной строки.
+    Открытый пароль остается в поле password до хэширования
+    """
+    if row is None:
+        raise ValueError("Unreadable row")
+    for field in ("username", "email", "password", "password_hash"):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            raise ValueError(f"Field {field} must be a string")
+    username = (row.get("username") or "").strip() or None
+    email = (row.get("email") or "").strip()
+    password_hash = row.get("password_hash")
+    model = HashedUserModel if password_hash else CreateUserModel
+    try:
+        user = model.model_validate({"username": username, "email": email, "password": password_hash or row.get("password") or ""})
+    except ValidationError as e:
+        raise ValueError("; ".join(error["msg"] for error in e.errors()))
+    if password_hash and pwd_context.identify(password_hash, required=False) is None:
+        raise ValueError("Unsupported password hash")
+    return {"username": user.username, "email": user.email, "password": user.password, "hashed": bool(password_hash)}
+
+
+class UserImporter:
+    """
+    hasher - общий пул хэширования приложения (при импорте из обработчика запроса), без него
+    создается собственный пул из workers процессов
+    """
+    def __init__(self, session: AsyncSession, batch_size: int = IMPORT_BATCH_SIZE, workers: int = IMPORT_HASH_WORKERS,
+                 on_progress: Optional[Callable[[ImportReport], None]] = None, hasher: Optional[HasherPool] = None):
+        self.session = session
+        self.batch_size = batch_size
+        self.workers = workers
+        self.on_progress = on_progress
+        self.hasher = hasher
+        self.report = ImportReport()
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        # процессы создаются только если в файле есть открытые пароли
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def run(self, rows: Iterable[tuple]) -> ImportReport:
+        try:
+            batch = []
+            for line, row in rows:
+                batch.append((line, row))
+                if len(batch) >= self.batch_size:
+                    await self._import_batch(batch)
+                    batch = []
+            if batch:
+                await self._import_batch(batch)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        return self.report
+
+    async def _import_batch(self, batch: list):
+        report = self.report
+        report.processed += len(batch)
+
+        candidates = {}  # email без учета регистра -> (номер строки, значения)
+        for line, row in batch:
+            try:
+                values = _validate_row(row)
+            except ValueError as e:
+                email = (row or {}).get("email")
+                report.add_error(line, email if isinstance(email, str) else None, str(e))
+                continue
+            key = normalize_email(values["email"])
+            if key in candidates:
+                self._duplicate(line, values["email"])
+                continue
+            candidates[key] = (line, values)
+
+        # уже существующие email отсеиваются до хэширования
+        if candidates:
+            existing = await self.session.execute(
+                select(func.lower(UserAuthModel.email)).where(func.lower(UserAuthModel.email).in_(list(candidates)))
+            )
+            for key in existing.scalars():
+                line, values = candidates.pop(key)
+                self._duplicate(line, values["email"])
+            # транзакция не держится открытой во время хэширования
+            await self.session.commit()
+
+        await self._hash(list(candidates.values()))
+
+        if candidates:
+            table = UserAuthModel.__table__
+            dialect_name = (await self.session.connection()).dialect.name
+            statement = insert_ignore(table, dialect_name).values([
+                {
+                    "username": values["username"],
+                    "email": values["email"],
+                    "password": values["password"],
+                    "is_active": True,
+                    "is_superuser": False,
+                    "token_version": 0,
+                }
+                for _, values in candidates.values()
+            ]).returning(table.c.email)
+            inserted = {normalize_email(email) for email in (await self.session.execute(statement)).scalars()}
+            await self.session.commit()
+            report.imported += len(inserted)
+            # email, добавленные между проверкой и вставкой (другой импорт или /signup)
+            for key, (line, values) in candidates.items():
+                if key not in inserted:
+                    self._duplicate(line, values["email"])
+
+        if self.on_progress is not None:
+            self.on_progress(report)
+
+    async def _hash(self, candidates: list):
+        plain = [values for _, values in candidates if not values["hashed"]]
+        if not plain:
+            return
+        if self.hasher is not None:
+            # задачи импорта по очереди, чтобы он занимал не больше одного воркера пула
+            for i in range(0, len(plain), IMPORT_SHARED_HASH_CHUNK):
+                chunk = plain[i:i + IMPORT_SHARED_HASH_CHUNK]
+                hashes = await self.hasher.run(hash_passwords, [values["password"] for values in chunk])
+                for values, password_hash in zip(chunk, hashes):
+                    values["password"] = password_hash
+            return
+        loop = asyncio.get_running_loop()
+        chunk_size = math.ceil(len(plain) / self.workers)
+        chunks = [plain[i:i + chunk_size] for i in range(0, len(plain), chunk_size)]
+        hashed = await asyncio.gather(*(
+            loop.run_in_executor(self._get_executor(), hash_passwords, [values["password"] for values in chunk])
+            for chunk in chunks
+        ))
+        for chunk, hashes in zip(chunks, hashed):
+            for values, password_hash in zip(chunk, hashes):
+                values["password"] = password_hash
+
+    def _duplicate(self, line: int, email: str):
+        self.report.duplicates += 1
+        self.report.add_error(line, email, "Email already exists")
+
+
+async def import_users(rows: Iterable[tuple], session: AsyncSession, **kwargs) -> ImportReport:
+    return await UserImporter(session, **kwargs).run(rows)
+
+
+def write_error_report(report: ImportReport, file):
+    writer = csv.writer(file)
+    writer.writerow(["line", "email", "error"])
+    writer.writerows(report.errors)
+
+
+async def import_file(path: str, fmt: str, errors_path: Optional[str], batch_size: int, workers: int) -> ImportReport:
+    def log_progress(report: ImportReport):
+        logger.info(f"Импорт: обработано {report.processed}, добавлено {report.imported}, ошибок {len(report.errors)}")
+
+    with open(path, newline="", encoding="utf-8") as file:
+        async with async_session() as session:
+            report = await import_users(
+                read_rows(file, fmt), session, batch_size=batch_size, workers=workers, on_progress=log_progress,
+            )
+    if errors_path and report.errors:
+        with open(errors_path, "w", newline="", encoding="utf-8") as file:
+            write_error_report(report, file)
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Массовый импорт пользователей из CSV или JSONL")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, help="по умолчанию определяется по расширению файла")
+    parser.add_argument("--errors", help="CSV файл для строк, которые не удалось импортировать")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=IMPORT_HASH_WORKERS, help="процессов для хэширования паролей")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(import_file(
+        args.path, args.format or detect_format(args.path), args.errors, args.batch_size, args.workers,
+    ))
+    summary = report.as_dict(max_errors=0)
+    print(f"processed={summary['processed']} imported={summary['imported']} "
+          f"duplicates={summary['duplicates']} failed={summary['failed']}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
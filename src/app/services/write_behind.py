@@ -0,0 +1,128 @@
+"""
+Отложенная запись (write-behind) строк, которые создает вход: refresh токена и сессии.
+
+Без нее каждый вход - отдельная транзакция с ожиданием записи на диск. С LOGIN_WRITE_BEHIND=true строки
+входа попадают в очередь процесса, фоновая задача собирает их в течение WRITE_BEHIND_WINDOW_MS
+(и пока пишется предыдущая пачка) и вставляет многострочными INSERT в одной транзакции (group commit).
+Вход ждет фиксации своей пачки, поэтому ответ с токеном отдается только после его записи. Ошибка вставки
+отклоняет все входы пачки. Очередь ограничена WRITE_BEHIND_QUEUE_SIZE входами, при переполнении
+вход отклоняется (503), а не ждет. При остановке приложения очередь записывается до конца
+"""
+import asyncio
+import os
+from typing import Optional
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import SQLModel
+
+from app.db import engine
+from app.metrics import WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_REJECTED
+from app.logger import logger
+
+LOGIN_WRITE_BEHIND = os.environ.get("LOGIN_WRITE_BEHIND", "false").lower() == "true"
+# сколько миллисекунд собирать пачку после первого входа
+WRITE_BEHIND_WINDOW_MS = float(os.environ.get("WRITE_BEHIND_WINDOW_MS", 5))
+# входов в одной транзакции, ограничивает и количество параметров запроса
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get("WRITE_BEHIND_MAX_BATCH", 500))
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", 10000))
+
+
+class WriteQueueFull(Exception):
+    """
+    Очередь отложенной записи переполнена, вход нужно отклонить, а не ставить в очередь
+    """
+
+
+def model_row(obj: SQLModel) -> tuple:
+    table = obj.__table__
+    return table, {column.name: getattr(obj, column.name) for column in table.columns}
+
+
+class WriteBehindQueue:
+    def __init__(self, engine: AsyncEngine = engine, window: float = WRITE_BEHIND_WINDOW_MS / 1000,
+                 max_batch: int = WRITE_BEHIND_MAX_BATCH, queue_size: int = WRITE_BEHIND_QUEUE_SIZE):
+        self.engine = engine
+        self.window = window
+        self.max_batch = max_batch
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None  # (строки одного входа, future) или None - остановка
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, *objects: SQLModel):
+        """
+        Вставляет строки в одной транзакции с другими входами и ждет ее фиксации
+        """
+        rows = [model_row(obj) for obj in objects]
+        if self._task is None:
+            # очередь не запущена (CLI, тесты) или приложение уже останавливается
+            await self._insert(rows)
+            return
+        if self._queue.full():
+            WRITE_BEHIND_REJECTED.inc()
+            raise WriteQueueFull("Write-behind queue is full")
+        future = asyncio.get_running_loop().create_future()
+        # строки одного входа всегда попадают в одну пачку
+        self._queue.put_nowait((rows, future))
+        await future
+
+    async def _insert(self, rows: list):
+        by_table: dict = {}
+        for table, values in rows:
+            by_table.setdefault(table, []).append(values)
+        async with self.engine.begin() as conn:
+            for table, values in by_table.items():
+                await conn.execute(insert(table).values(values))
+
+    async def _flush(self, batch: list):
+        rows = [row for rows, _ in batch for row in rows]
+        try:
+            await self._insert(rows)
+        except Exception as e:
+            logger.error(f"Ошибка отложенной записи, отклонено входов: {len(batch)}: {e}")
+            for _, future in batch:
+                # запрос мог быть отменен, пока пачка записывалась
+                if not future.done():
+                    future.set_exception(e)
+            return
+        WRITE_BEHIND_BATCH_SIZE.observe(len(batch))
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            if self.window:
+                await asyncio.sleep(self.window)
+            stopping = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Записывает все, что уже в очереди, и останавливает фоновую задачу
+        """
+        task, self._task = self._task, None
+        if task is None:
+            return
+        # новые входы пишутся сразу, метка остановки встает в очередь за уже принятыми
+        await self._queue.put(None)
+        await task
+
+
+login_writer = WriteBehindQueue()
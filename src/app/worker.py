@@ -1,44 +1,109 @@
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.exc import DatabaseError, OperationalError, NoResultFound, SQLAlchemyError
+"""
+Фоновые задачи. Выполняются планировщиком (app.scheduler) в ведущем веб-воркере или отдельным процессом:
 
-from app.db import engine
-from app.models.auth import TokenModel
+    SCHEDULER_MODE=external  # в веб-воркерах
+    python -m app.worker
+"""
+import asyncio
+import os
+import signal
+import time
+from sqlalchemy.exc import DatabaseError, OperationalError, SQLAlchemyError
+
+from app.db import init_db, engine
+from app.leader import run_as_leader, startup_lock
+from app.scheduler import Scheduler
+from app.services.token_store import get_token_store, TokenStoreUnavailable
+from app.services.sessions import cleanup_expired_sessions
+from app.metrics import observe_stage, TOKEN_CLEANUP_REMOVED
 from app.logger import logger
 
-async def cleanup_expired_refresh_tokens():
+# inprocess - планировщик работает в ведущем веб-воркере, external - только в python -m app.worker
+SCHEDULER_MODE = os.environ.get("SCHEDULER_MODE", "inprocess")
+
+# токены удаляются пачками, чтобы не держать длинную транзакцию и не блокировать таблицу
+TOKEN_CLEANUP_BATCH_SIZE = int(os.environ.get("TOKEN_CLEANUP_BATCH_SIZE", 5000))
+TOKEN_CLEANUP_BATCH_PAUSE = float(os.environ.get("TOKEN_CLEANUP_BATCH_PAUSE", 0.1))  # секунды между пачками
+# интервал между запусками очистки или расписание cron (например "0 3 * * *"), cron важнее интервала
+TOKEN_CLEANUP_INTERVAL = float(os.environ.get("TOKEN_CLEANUP_INTERVAL", 60))
+TOKEN_CLEANUP_CRON = os.environ.get("TOKEN_CLEANUP_CRON") or None
+TOKEN_CLEANUP_JITTER = float(os.environ.get("TOKEN_CLEANUP_JITTER", 5))
+TOKEN_CLEANUP_MAX_RUNTIME = float(os.environ.get("TOKEN_CLEANUP_MAX_RUNTIME", 600))
+SESSION_CLEANUP_INTERVAL = float(os.environ.get("SESSION_CLEANUP_INTERVAL", 3600))
+
+async def cleanup_expired_refresh_tokens() -> dict:
     logger.info("Задача cleanup_expired_refresh_tokens запущена.")
-    """Удаляет из базы данных просроченные и недействительные токены."""
+    """Удаляет из хранилища просроченные и недействительные токены, возвращает количество удаленных и время работы."""
+    started = time.monotonic()
+    removed = 0
     try:
-        async with AsyncSession(engine) as db:
-            try:
-                # Выполняем запрос для поиска истекших токенов
-                result = await db.execute(
-                    select(TokenModel).where(
-                        TokenModel.invalidated == True
-                    )
-                )
-                expired_tokens = result.scalars().all()
-
-                if not expired_tokens:
-                    logger.info("Нет просроченных токенов для удаления.")
-                    return
-                # Удаляем каждый истекший токен
-                for token in expired_tokens:
-                    await db.delete(token) 
-
-                # Фиксируем транзакцию
-                await db.commit()
-        
-            except (DatabaseError, OperationalError) as e:
-                # Откатываем транзакцию в случае ошибки
-                await db.rollback()
-                logger.error(f"Ошибка базы данных: {e}")
-            except Exception as e:
-                # Откатываем транзакцию в случае ошибки
-                await db.rollback()
-                logger.error(f"Error in cleanup_expired_refresh_tokens: {e}")
+        with observe_stage("cleanup"):
+            removed = await get_token_store().cleanup(
+                batch_size=TOKEN_CLEANUP_BATCH_SIZE, pause=TOKEN_CLEANUP_BATCH_PAUSE
+            )
+        TOKEN_CLEANUP_REMOVED.inc(removed)
+        if not removed:
+            logger.info("Нет просроченных токенов для удаления.")
+
+    except (DatabaseError, OperationalError) as e:
+        logger.error(f"Ошибка базы данных: {e}")
+    except TokenStoreUnavailable as e:
+        logger.error(f"Хранилище токенов недоступно: {e}")
     except SQLAlchemyError as e:
         logger.error(f"Ошибка при создании сессии: {e}")
     except Exception as e:
-        logger.critical(f"Error with session: {e}")
+        logger.critical(f"Error in cleanup_expired_refresh_tokens: {e}")
+
+    duration = time.monotonic() - started
+    if removed:
+        logger.info(f"Удалено недействительных токенов: {removed} за {duration:.2f} с")
+    return {"removed": removed, "duration": duration}
+
+
+async def cleanup_expired_sessions_job() -> int:
+    """Удаляет истекшие сессии пользователей (app.services.sessions)."""
+    try:
+        removed = await cleanup_expired_sessions(engine, batch_size=TOKEN_CLEANUP_BATCH_SIZE, pause=TOKEN_CLEANUP_BATCH_PAUSE)
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка базы данных при удалении сессий: {e}")
+        return 0
+    if removed:
+        logger.info(f"Удалено истекших сессий: {removed}")
+    return removed
+
+
+scheduler = Scheduler()
+scheduler.add_job(
+    "cleanup_expired_refresh_tokens",
+    cleanup_expired_refresh_tokens,
+    interval=None if TOKEN_CLEANUP_CRON else TOKEN_CLEANUP_INTERVAL,
+    cron=TOKEN_CLEANUP_CRON,
+    jitter=TOKEN_CLEANUP_JITTER,
+    max_runtime=TOKEN_CLEANUP_MAX_RUNTIME,
+)
+scheduler.add_job(
+    "cleanup_expired_sessions",
+    cleanup_expired_sessions_job,
+    interval=SESSION_CLEANUP_INTERVAL,
+    jitter=TOKEN_CLEANUP_JITTER,
+    max_runtime=TOKEN_CLEANUP_MAX_RUNTIME,
+)
+
+
+async def run_worker():
+    # таблицы могут одновременно создавать веб-воркеры
+    async with startup_lock():
+        await init_db(engine)
+    task = asyncio.create_task(run_as_leader([scheduler.run]))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info("Планировщик остановлен")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
@@ -0,0 +1,72 @@
+"""
+Сравнение реализаций JWT (app.services.jwt_backends) и кэша проверенных токенов.
+Время в микросекундах на одну операцию.
+
+    python -m benchmarks.jwt_bench --iterations 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("JWT_REFRESH_SECRET_KEY", "benchmark-refresh-secret")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///benchmark.db")
+
+from app.services import tokens
+from app.services.cache import access_token_cache
+from app.services.jwt_backends import JWT_BACKENDS, create_jwt_backend
+
+CLAIMS = {"uid": 1, "role": "admin", "act": True, "su": False, "ver": 3, "perm": 127}
+
+
+def measure(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1_000_000
+
+
+def run_jwt_benchmark(iterations: int = 10000, backends: list = None) -> dict:
+    results = {}
+    original_backend = tokens.jwt_backend
+    try:
+        for name in backends or list(JWT_BACKENDS):
+            try:
+                tokens.jwt_backend = create_jwt_backend(name)
+            except RuntimeError:
+                # необязательная зависимость не установлена
+                continue
+            token = tokens.create_access_token("bench@example.com", claims=CLAIMS)
+
+            def decode_uncached():
+                access_token_cache.clear()
+                tokens.decode_access_token(token)
+
+            results[name] = {
+                "encode_us": measure(lambda: tokens.create_access_token("bench@example.com", claims=CLAIMS), iterations),
+                "decode_us": measure(decode_uncached, iterations),
+                "cached_decode_us": measure(lambda: tokens.decode_access_token(token), iterations),
+            }
+    finally:
+        tokens.jwt_backend = original_backend
+        access_token_cache.clear()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Сравнение реализаций JWT")
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--backend", action="append", choices=list(JWT_BACKENDS), help="можно указать несколько раз")
+    args = parser.parse_args(argv)
+
+    for name, stats in run_jwt_benchmark(args.iterations, args.backend).items():
+        print(
+            f"{name:<6} encode {stats['encode_us']:>8.1f} us  decode {stats['decode_us']:>8.1f} us  "
+            f"cached decode {stats['cached_decode_us']:>8.1f} us"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
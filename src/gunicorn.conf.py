@@ -0,0 +1,34 @@
+"""
+Запуск в production с несколькими воркерами:
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+Воркеры - uvicorn, их количество задается WEB_CONCURRENCY (по умолчанию по числу ядер).
+Схему и роли создает первый воркер, фоновые задачи выполняет один ведущий воркер (см. app.leader)
+"""
+import os
+import shutil
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+accesslog = "-"
+
+# метрики всех воркеров собираются через общий каталог, переменная должна быть задана
+# до импорта prometheus_client в воркерах
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+
+def on_starting(server):
+    # файлы метрик прошлого запуска
+    multiproc_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from app.metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -10,27 +10,41 @@ from app.services.hashers import make_password
 from app.services.tokens import create_refresh_token
 from app.services.auth import login, current_user
 from app.main import app
+from app.services.cache import user_cache, access_token_cache
+from app.services.role_registry import role_registry
+from app.services.rate_limit import get_rate_limiter
 
-@pytest_asyncio.fixture(name="test_session")
-async def session_fixture():
-    # Создаем движок для SQLite
+@pytest_asyncio.fixture(name="test_engine")
+async def engine_fixture():
+    # Создаем движок для SQLite, общий для сессии теста и фоновых задач, которым нужен свой движок
     engine = create_async_engine("sqlite+aiosqlite:///test.db", echo=True)
 
-    async_session = sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
-    
     # Создаем таблицы асинхронно 
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
-    
-    # Возвращаем сессию
-    async with async_session() as session:
-        yield session
+
+    yield engine
 
     # Удаляем все таблицы асинхронно после завершения теста
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.drop_all)
+    await engine.dispose()
+
+@pytest_asyncio.fixture(name="test_session_factory")
+async def session_factory_fixture(test_engine: AsyncEngine):
+    return sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False)
+
+@pytest_asyncio.fixture(name="test_session")
+async def session_fixture(test_session_factory):
+    # кэш пользователей и реестр ролей не должны переживать пересоздание базы между тестами
+    user_cache.clear()
+    access_token_cache.clear()
+    role_registry.clear()
+    await get_rate_limiter().clear()
+
+    # Возвращаем сессию
+    async with test_session_factory() as session:
+        yield session
 
 @pytest_asyncio.fixture(name="test_user")
 async def user_fixture(test_session: AsyncSession):
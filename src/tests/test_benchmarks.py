@@ -0,0 +1,33 @@
+import pytest
+
+from benchmarks.auth_bench import run_benchmark, compare, summarize
+
+
+def test_summarize_percentiles():
+    stats = summarize([i / 1000 for i in range(1, 101)], errors=1, elapsed=2.0)
+
+    assert stats["requests"] == 100
+    assert stats["throughput"] == 50.0
+    assert stats["p50_ms"] == pytest.approx(50)
+    assert stats["p95_ms"] == pytest.approx(95)
+    assert stats["p99_ms"] == pytest.approx(99)
+
+def test_compare_with_baseline():
+    baseline = {"scenarios": {"me": {"p95_ms": 10.0, "throughput": 100.0, "errors": 0}}}
+    same = {"scenarios": {"me": {"p95_ms": 11.0, "throughput": 95.0, "errors": 0}}}
+    slower = {"scenarios": {"me": {"p95_ms": 20.0, "throughput": 50.0, "errors": 0}}}
+
+    assert compare(same, baseline, max_regression=0.2) == []
+    assert len(compare(slower, baseline, max_regression=0.2)) == 2
+
+@pytest.mark.asyncio
+async def test_benchmark_smoke(tmp_path):
+    results = await run_benchmark(
+        f"sqlite+aiosqlite:///{tmp_path / 'bench.db'}", requests=2, concurrency=1, scenarios=["me", "refresh_token", "admin"]
+    )
+
+    assert set(results["scenarios"]) == {"me", "refresh_token", "admin"}
+    assert results["scenarios"]["me"]["errors"] == 0
+    assert results["scenarios"]["admin"]["errors"] == 0
+    assert results["scenarios"]["refresh_token"]["requests"] == 2
+    assert results["scenarios"]["refresh_token"]["errors"] == 0
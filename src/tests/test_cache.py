@@ -0,0 +1,79 @@
+import time
+import pytest
+from fastapi.security import OAuth2PasswordRequestForm
+
+from app.models.auth import UserAuthModel
+from app.services.auth import login, current_user
+from app.services.cache import (
+    TTLCache, CacheBackend, user_cache, token_version_cache, invalidate_user, apply_invalidation, set_cache_backend,
+)
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # "a" становится последним использованным, вытесняется "b"
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1}
+
+def test_ttl_cache_expiration():
+    cache = TTLCache(maxsize=10, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+@pytest.mark.asyncio
+async def test_current_user_cached(roles, test_user, test_session):
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    access_token = (await login(form_data=form_data, db=test_session))['access_token']
+
+    await current_user(access_token, db=test_session)
+    hits = user_cache.hits
+    curr = await current_user(access_token, db=test_session)
+
+    assert user_cache.hits == hits + 1
+    assert curr.email == "test@example.com"
+
+    # изменения объекта в запросе не попадают в кэш
+    curr.username = "changed"
+    test_session.expunge(curr)
+    assert user_cache.get("test@example.com")["username"] == "testuser"
+    assert (await current_user(access_token, db=test_session)).username == "testuser"
+
+    # изменение роли сбрасывает запись в кэше
+    await UserAuthModel.set_role(curr.id, "user", test_session)
+    assert user_cache.get("test@example.com") is None
+
+
+class RecordingCacheBackend(CacheBackend):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, message):
+        self.messages.append(message)
+
+@pytest.mark.asyncio
+async def test_invalidate_user_published(test_user):
+    backend = RecordingCacheBackend()
+    set_cache_backend(backend)
+    try:
+        user_cache.set_user(test_user)
+        invalidate_user(user_id=test_user.id, token_version=3)
+    finally:
+        set_cache_backend(None)
+
+    assert user_cache.get(test_user.email) is None
+    assert backend.messages == [{"user_id": test_user.id, "email": None, "token_version": 3}]
+
+    # сообщение от другого воркера сбрасывает кэш так же, как локальный вызов
+    user_cache.set_user(test_user)
+    apply_invalidation({"user_id": test_user.id, "email": None, "token_version": 4, "src": "other"})
+    assert user_cache.get(test_user.email) is None
+    assert token_version_cache.get(test_user.id) == 4
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from fastapi.security import OAuth2PasswordRequestForm
+
+from app.services import auth
+from app.services.hashers import (
+    HasherPool, HasherBusyError, make_password, get_password,
+    make_password_async, verify_password_async, get_hasher_stats,
+    build_password_context, password_needs_update,
+)
+
+
+@pytest.mark.asyncio
+async def test_async_hash_and_verify():
+    password_hash = await make_password_async("Passw!@#ord123!")
+
+    assert password_hash != "Passw!@#ord123!"
+    assert await verify_password_async("Passw!@#ord123!", password_hash) == True
+    assert await verify_password_async("wrong", password_hash) == False
+    assert get_hasher_stats()["calls"] >= 3
+
+@pytest.mark.asyncio
+async def test_hasher_pool_backpressure():
+    # один воркер и нулевая очередь: второй одновременный запрос должен получить отказ
+    pool = HasherPool(kind="thread", size=1, queue_size=0)
+    password_hash = make_password("Passw!@#ord123!")
+
+    results = await asyncio.gather(
+        pool.run(get_password, "Passw!@#ord123!", password_hash),
+        pool.run(get_password, "Passw!@#ord123!", password_hash),
+        return_exceptions=True,
+    )
+    pool.shutdown()
+
+    assert results.count(True) == 1
+    assert any(isinstance(r, HasherBusyError) for r in results)
+    assert pool.stats.rejected == 1
+    assert pool.in_flight == 0
+
+def test_password_needs_update():
+    weak_hash = build_password_context(["bcrypt"], bcrypt_rounds=4).hash("Passw!@#ord123!")
+    argon2_hash = build_password_context(["argon2"], argon2_time_cost=1, argon2_memory_cost=1024).hash("Passw!@#ord123!")
+
+    assert password_needs_update(make_password("Passw!@#ord123!")) == False
+    assert password_needs_update(weak_hash) == True
+    # хэш схемы, которой нет в PASSWORD_SCHEMES, тоже проверяется и требует обновления
+    migrating = build_password_context(["argon2", "bcrypt"], argon2_time_cost=1, argon2_memory_cost=1024)
+    assert migrating.needs_update(weak_hash) == True
+    assert migrating.needs_update(argon2_hash) == False
+    assert migrating.verify("Passw!@#ord123!", weak_hash) == True
+
+@pytest.mark.asyncio
+async def test_login_rehashes_weak_password(monkeypatch, test_user, test_session, test_session_factory):
+    weak_hash = build_password_context(["bcrypt"], bcrypt_rounds=4).hash("Passw!@#ord123!")
+    test_user.password = weak_hash
+    await test_session.commit()
+
+    monkeypatch.setattr(auth, "async_session", test_session_factory)
+
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    await auth.login(form_data=form_data, db=test_session)
+    await auth.wait_password_rehash()
+
+    await test_session.refresh(test_user)
+    assert test_user.password != weak_hash
+    assert password_needs_update(test_user.password) == False
+    assert get_password("Passw!@#ord123!", test_user.password) == True
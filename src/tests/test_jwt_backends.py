@@ -0,0 +1,65 @@
+import time
+import pytest
+from jose import JWTError
+
+from app.services import tokens
+from app.services.cache import access_token_cache
+from app.services.jwt_backends import JoseBackend, FastHS256Backend, PyJWTBackend
+from benchmarks.jwt_bench import run_jwt_benchmark
+
+KEY = "secret"
+
+
+def test_fast_backend_compatible_with_jose():
+    jose, fast = JoseBackend(), FastHS256Backend()
+    payload = {"exp": int(time.time()) + 60, "sub": "test@example.com", "uid": 1}
+
+    assert fast.encode(payload, KEY, "HS256") == jose.encode(payload, KEY, "HS256")
+    assert fast.decode(jose.encode(payload, KEY, "HS256", headers={"kid": "1"}), KEY, ["HS256"]) == payload
+    assert fast.get_unverified_header(fast.encode(payload, KEY, "HS256", headers={"kid": "1"}))["kid"] == "1"
+
+@pytest.mark.parametrize("token", [
+    "garbage",
+    "a.b.c",
+    JoseBackend().encode({"sub": "test@example.com"}, "other", "HS256"),
+    JoseBackend().encode({"exp": int(time.time()) - 10, "sub": "test@example.com"}, KEY, "HS256"),
+    JoseBackend().encode({"sub": 1}, KEY, "HS256"),
+])
+def test_fast_backend_rejects_invalid_tokens(token):
+    with pytest.raises(JWTError):
+        FastHS256Backend().decode(token, KEY, ["HS256"])
+
+def test_pyjwt_backend():
+    pytest.importorskip("jwt")
+    payload = {"exp": int(time.time()) + 60, "sub": "test@example.com"}
+
+    assert PyJWTBackend().decode(JoseBackend().encode(payload, KEY, "HS256"), KEY, ["HS256"]) == payload
+    with pytest.raises(JWTError):
+        PyJWTBackend().decode(JoseBackend().encode(payload, "other", "HS256"), KEY, ["HS256"])
+
+def test_verified_token_cache():
+    access_token_cache.clear()
+    token = tokens.create_access_token("test@example.com")
+
+    payload = tokens.decode_access_token(token)
+    hits = access_token_cache.hits
+    payload["sub"] = "changed"
+
+    assert tokens.decode_access_token(token)["sub"] == "test@example.com"
+    assert access_token_cache.hits == hits + 1
+    assert tokens.decode_access_token(token + "x") is None
+
+def test_jwt_microbenchmark(monkeypatch):
+    decodes = []
+    decode = JoseBackend.decode
+    def counting_decode(self, token, key, algorithms):
+        decodes.append(token)
+        return decode(self, token, key, algorithms)
+    monkeypatch.setattr(JoseBackend, "decode", counting_decode)
+
+    results = run_jwt_benchmark(iterations=50, backends=["jose", "fast"])
+
+    assert set(results) == {"jose", "fast"}
+    assert all(value > 0 for stats in results.values() for value in stats.values())
+    # токен проверяется только в замерах без кэша, кэшированные проверки не доходят до реализации JWT
+    assert len(decodes) == 50
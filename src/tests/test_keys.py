@@ -0,0 +1,78 @@
+import os
+import pytest
+from jose import jwt
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.services.keys import KeyRing, rotate_keys, set_key_ring
+from app.services.tokens import create_access_token, decode_access_token, JWT_SECRET_KEY
+
+client = TestClient(app)
+
+
+@pytest.fixture(name="key_ring")
+def key_ring_fixture(tmp_path):
+    rotate_keys(str(tmp_path), "RS256")
+    key_ring = KeyRing("RS256", str(tmp_path), activation_delay=0)
+    key_ring.load()
+    set_key_ring(key_ring)
+    yield key_ring
+    set_key_ring(None)
+
+
+def test_rs256_token_with_kid(monkeypatch, key_ring):
+    monkeypatch.setattr("app.services.keys.JWT_ALGORITHM", "RS256")
+    token = create_access_token("test@example.com")
+
+    assert jwt.get_unverified_header(token)["kid"] == key_ring.active_key().kid
+    assert decode_access_token(token)["sub"] == "test@example.com"
+    # токен, подписанный общим секретом, не принимается
+    assert decode_access_token(jwt.encode({"sub": "test@example.com"}, JWT_SECRET_KEY, "HS256")) is None
+
+def test_key_rotation(monkeypatch, key_ring):
+    monkeypatch.setattr("app.services.keys.JWT_ALGORITHM", "RS256")
+    old_token = create_access_token("test@example.com")
+
+    rotate_keys(key_ring.keys_dir, "RS256", keep=2)
+    key_ring.reload_if_changed(force=True)
+    new_token = create_access_token("test@example.com")
+
+    assert jwt.get_unverified_header(new_token)["kid"] != jwt.get_unverified_header(old_token)["kid"]
+    assert decode_access_token(old_token) is not None
+
+    # пока токены старого ключа могут действовать, он не удаляется
+    rotate_keys(key_ring.keys_dir, "RS256", keep=2)
+    assert len(os.listdir(key_ring.keys_dir)) == 3
+
+    # после истечения срока хранения ротация удаляет самые старые ключи
+    rotate_keys(key_ring.keys_dir, "RS256", keep=2, activation_delay=0, retention=0)
+    key_ring.reload_if_changed(force=True)
+    assert len(os.listdir(key_ring.keys_dir)) == 2
+    assert decode_access_token(old_token) is None
+
+def test_new_key_is_not_active_before_delay(tmp_path):
+    first = rotate_keys(str(tmp_path), "ES256")
+    key_ring = KeyRing("ES256", str(tmp_path), activation_delay=3600)
+    key_ring.load()
+    rotate_keys(str(tmp_path), "ES256")
+    key_ring.reload_if_changed(force=True)
+
+    # новый ключ уже опубликован, но подписывает пока старый
+    assert len(key_ring.jwks()["keys"]) == 2
+    assert key_ring.active_key().kid == first
+
+    # единственный активный ключ не удаляется, пока новые ключи не начали подписывать
+    rotate_keys(str(tmp_path), "ES256", keep=2, activation_delay=3600, retention=0)
+    key_ring.reload_if_changed(force=True)
+    assert key_ring.active_key().kid == first
+
+def test_jwks_endpoint(monkeypatch, key_ring):
+    monkeypatch.setattr("app.main.get_key_ring", lambda: key_ring)
+    response = client.get('/.well-known/jwks.json')
+
+    assert response.status_code == 200
+    assert response.json()["keys"][0]["kid"] == key_ring.active_key().kid
+    assert "max-age" in response.headers["cache-control"]
+
+    response = client.get('/.well-known/jwks.json', headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.db import async_session
+from app.leader import ProcessLock, run_as_leader
+from app.main import app, lifespan
+from app.models.auth import RoleModel
+
+
+@pytest.mark.asyncio
+async def test_process_lock_exclusive(tmp_path):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    first = ProcessLock(1, engine, lock_dir=str(tmp_path))
+    second = ProcessLock(1, engine, lock_dir=str(tmp_path))
+
+    assert await first.acquire() == True
+    assert await second.acquire() == False
+    await first.release()
+    assert await second.acquire() == True
+    await second.release()
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_run_as_leader_failover(tmp_path):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    runs = {"first": 0, "second": 0}
+
+    def job(name):
+        async def run():
+            runs[name] += 1
+            await asyncio.Event().wait()
+        return run
+
+    first = asyncio.create_task(run_as_leader([job("first")], ProcessLock(2, engine, str(tmp_path)), retry_interval=0.01))
+    await asyncio.sleep(0.05)
+    second = asyncio.create_task(run_as_leader([job("second")], ProcessLock(2, engine, str(tmp_path)), retry_interval=0.01))
+    await asyncio.sleep(0.05)
+    assert runs == {"first": 1, "second": 0}
+
+    # ведущий процесс завершился - задачи подхватывает другой
+    first.cancel()
+    await asyncio.gather(first, return_exceptions=True)
+    await asyncio.sleep(0.05)
+    assert runs == {"first": 1, "second": 1}
+
+    second.cancel()
+    await asyncio.gather(second, return_exceptions=True)
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_run_as_leader_restarts_failed_job(tmp_path):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    runs = {"failing": 0, "steady": 0}
+
+    async def failing():
+        runs["failing"] += 1
+        if runs["failing"] < 3:
+            raise RuntimeError("boom")
+        await asyncio.Event().wait()
+
+    async def steady():
+        runs["steady"] += 1
+        await asyncio.Event().wait()
+
+    leader = asyncio.create_task(run_as_leader([failing, steady], ProcessLock(3, engine, str(tmp_path)), retry_interval=0.01))
+    await asyncio.sleep(0.1)
+    # упавшая задача перезапускается, работающая не трогается
+    assert runs == {"failing": 3, "steady": 1}
+
+    leader.cancel()
+    await asyncio.gather(leader, return_exceptions=True)
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_lifespan_creates_roles_once():
+    # повторный запуск (другой воркер) не создает роли заново
+    async with lifespan(app):
+        pass
+    async with lifespan(app):
+        pass
+
+    async with async_session() as session:
+        count = (await session.execute(select(func.count()).select_from(RoleModel))).scalar()
+    assert count == 3
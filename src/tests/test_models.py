@@ -1,22 +1,58 @@
+import sqlite3
 import pytest
-from app.models.auth import UserAuthModel, TokenModel, ChangePasswordRequest, RoleModel
+from sqlalchemy.exc import IntegrityError
+from app.models.auth import UserAuthModel, TokenModel, ChangePasswordRequest, RoleModel, EmailAlreadyExistsError, is_email_conflict
 from app.db import get_session
 from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.services.auth import current_user
-from app.services.tokens import create_refresh_token
+from app.services.tokens import issue_refresh_token
 from app.services.roles import require_role
+from app.services.role_registry import role_registry
 from sqlalchemy import select
 
 
 @pytest.mark.asyncio
 async def test_tokenmodel(test_user, test_session: AsyncSession):
-    token = TokenModel(token=create_refresh_token(test_user.email), user_id=test_user.id)
+    refresh_token, token_id, expires_at = issue_refresh_token(test_user.email)
+    token = TokenModel(token_hash=token_id, user_id=test_user.id, expires_at=expires_at)
 
     assert token is not None
+    assert len(token.token_hash) == 32
     assert token.user_id == 1
     assert token.invalidated == False
 
+@pytest.mark.asyncio
+async def test_create_user_integrity_errors(monkeypatch, test_user, test_session: AsyncSession):
+    # занятый email без учета регистра - 409 в /signup
+    with pytest.raises(EmailAlreadyExistsError):
+        await UserAuthModel.create_user(
+            username='other', email='TEST@example.com', password='qwe123QW$#!', session=test_session,
+        )
+    # другие нарушения ограничений не выдаются за занятый email
+    not_null = IntegrityError("INSERT", {}, sqlite3.IntegrityError("NOT NULL constraint failed: userauthmodel.username"))
+    async def failing_commit():
+        raise not_null
+    monkeypatch.setattr(test_session, "commit", failing_commit)
+    with pytest.raises(IntegrityError):
+        await UserAuthModel.create_user(
+            username='other', email='other@example.com', password='qwe123QW$#!', session=test_session,
+        )
+
+def test_is_email_conflict():
+    class PostgresError(Exception):
+        def __init__(self, sqlstate, message):
+            super().__init__(message)
+            self.sqlstate = sqlstate
+
+    duplicate = 'duplicate key value violates unique constraint "ux_userauthmodel_email_lower"'
+    assert is_email_conflict(IntegrityError("INSERT", {}, PostgresError("23505", duplicate))) == True
+    assert is_email_conflict(IntegrityError("INSERT", {}, PostgresError("23502", "null value in column"))) == False
+    assert is_email_conflict(IntegrityError("INSERT", {}, PostgresError("23505", 'unique constraint "rolemodel_pkey"'))) == False
+    assert is_email_conflict(IntegrityError(
+        "INSERT", {}, sqlite3.IntegrityError("UNIQUE constraint failed: index 'ux_userauthmodel_email_lower'"),
+    )) == True
+
 @pytest.mark.asyncio
 async def test_usermodel(test_session: AsyncSession):
     user = await UserAuthModel.create_user(
@@ -74,4 +110,16 @@ async def test_roles(roles, test_current_user, test_session: AsyncSession):
     assert check_role == "user"
     
     # get_role = await require_role("user")
-    # assert get_role == True
\ No newline at end of file
+    # assert get_role == True
+
+@pytest.mark.asyncio
+async def test_role_registry(roles, test_current_user, test_session: AsyncSession):
+    await RoleModel.load_registry(test_session)
+    assert len(role_registry) == 3
+    assert role_registry.name(role_registry.id("admin")) == "admin"
+
+    await UserAuthModel.set_role(test_current_user.id, "admin", test_session)
+    # роль проверяется по реестру, связь role у пользователя не нужна
+    test_session.expunge(test_current_user)
+    assert await UserAuthModel.check_user_role(test_current_user.id, test_session) == "admin"
+    assert await require_role("admin")(current_user=test_current_user) is test_current_user
@@ -2,10 +2,11 @@ import pytest
 import time
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi import HTTPException
-from app.models.auth import TokenModel
+from app.models.auth import TokenModel, UserAuthModel
 from sqlmodel import select
 
-from app.services.auth import login, current_user
+from app.services import tokens
+from app.services.auth import login, current_user, current_user_claims
 from app.services.roles import require_role
 from app.services.tokens import create_access_token, create_refresh_token, decode_access_token, refresh_access_token
 
@@ -104,6 +105,36 @@ async def test_refresh_token_raise(test_user, test_session):
     assert exc_info.value.detail == 'Refresh token expired or not found'
 
 
+@pytest.mark.asyncio
+async def test_current_user_claims_fat_token(monkeypatch, roles, test_user, test_session):
+    monkeypatch.setattr(tokens, "ACCESS_TOKEN_MODE", "fat")
+    await UserAuthModel.set_role(test_user.id, "admin", test_session)
+
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    access_token = (await login(form_data=form_data, db=test_session))['access_token']
+
+    payload = decode_access_token(access_token)
+    assert payload['uid'] == test_user.id
+    assert payload['role'] == "admin"
+
+    # claims берутся из токена, сессия базы данных не нужна
+    claims = await current_user_claims(access_token, db=None)
+    assert claims.id == test_user.id
+    assert claims.role == "admin"
+
+    # после смены роли версия токена устаревает и данные берутся из базы
+    await UserAuthModel.set_role(test_user.id, "user", test_session)
+    claims = await current_user_claims(access_token, db=test_session)
+    assert claims.role == "user"
+
+@pytest.mark.asyncio
+async def test_current_user_claims_thin_token(roles, test_user, test_session):
+    claims = await current_user_claims(create_access_token(test_user.email), db=test_session)
+
+    assert claims.id == test_user.id
+    assert claims.role is None
+
+
 # установить ACCESS_TOKEN_EXPIRE_MINUTES = 1 для правильной работы теста
 # @pytest.mark.asyncio
 # async def test_refresh_work(test_user, test_session):
@@ -0,0 +1,50 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
+
+from app.models.auth import UserAuthModel
+from app.services import tokens
+from app.services.auth import login, current_user_claims
+from app.services.roles import require_permissions
+from app.services.tokens import decode_access_token
+from app.services.permissions import Permission, ROLE_PERMISSIONS, compile_role_permissions, permissions_for
+
+
+def test_role_inheritance():
+    assert ROLE_PERMISSIONS["user"] == Permission.VIEW
+    assert ROLE_PERMISSIONS["admin"] & ROLE_PERMISSIONS["moderator"] == ROLE_PERMISSIONS["moderator"]
+    assert not ROLE_PERMISSIONS["moderator"] & Permission.DELETE
+    assert permissions_for(None) == 0
+    assert permissions_for(None, is_superuser=True) & Permission.MANAGE_SETTINGS
+
+def test_role_inheritance_cycle():
+    definitions = {
+        "a": {"permissions": Permission.VIEW, "inherits": ["b"]},
+        "b": {"permissions": Permission.EDIT, "inherits": ["a"]},
+    }
+    with pytest.raises(ValueError):
+        compile_role_permissions(definitions)
+
+@pytest.mark.asyncio
+async def test_require_permissions_fat_token(monkeypatch, roles, test_user, test_session):
+    monkeypatch.setattr(tokens, "ACCESS_TOKEN_MODE", "fat")
+    await UserAuthModel.set_role(test_user.id, "admin", test_session)
+
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    access_token = (await login(form_data=form_data, db=test_session))['access_token']
+    assert decode_access_token(access_token)['perm'] == ROLE_PERMISSIONS["admin"]
+
+    # права проверяются по маске из токена, без обращения к базе данных
+    claims = await current_user_claims(access_token, db=None)
+    assert await require_permissions(Permission.EDIT, Permission.PUBLISH)(claims=claims) is claims
+    assert await require_permissions(Permission.DELETE)(claims=claims) is claims
+
+@pytest.mark.asyncio
+async def test_require_permissions_forbidden(roles, test_user, test_session):
+    await UserAuthModel.set_role(test_user.id, "user", test_session)
+    claims = await current_user_claims(tokens.create_access_token(test_user.email), db=test_session)
+
+    assert claims.permissions == Permission.VIEW
+    with pytest.raises(HTTPException) as exc_info:
+        await require_permissions(Permission.VIEW, Permission.EDIT)(claims=claims)
+    assert exc_info.value.status_code == 403
@@ -0,0 +1,88 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.db import get_session
+from app.services import rate_limit
+from app.services.rate_limit import MemoryRateLimiter, RateLimit, RateLimitExceeded, check_rate_limits
+
+client = TestClient(app)
+
+
+@pytest.mark.asyncio
+async def test_memory_limiter_sliding_window(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(rate_limit.time, "time", lambda: now)
+    limiter = MemoryRateLimiter()
+    rate = RateLimit(3, 10)
+
+    assert [await limiter.hit("key", rate) for _ in range(3)] == [0, 0, 0]
+    assert await limiter.hit("key", rate) == 10
+    assert await limiter.hit("other", rate) == 0
+
+    # в середине следующего окна учитывается половина предыдущего: 3 * 0.5 + 0
+    now = 1015.0
+    assert await limiter.hit("key", rate) == 0
+    assert await limiter.hit("key", rate) > 0
+
+@pytest.mark.asyncio
+async def test_memory_limiter_evicts_old_keys():
+    limiter = MemoryRateLimiter(max_keys=4)
+    for i in range(10):
+        await limiter.hit(f"key{i}", RateLimit(1, 60))
+
+    assert len(limiter._counters) <= 4
+
+@pytest.mark.asyncio
+async def test_check_rate_limits_scope(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_rate_limiter", MemoryRateLimiter())
+
+    await check_rate_limits(("test", "a", RateLimit(1, 60)), ("test_disabled", "a", None))
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await check_rate_limits(("test", "a", RateLimit(1, 60)))
+    assert exc_info.value.scope == "test"
+    assert exc_info.value.retry_after > 0
+
+@pytest.mark.asyncio
+async def test_rejected_request_does_not_use_other_limits(monkeypatch):
+    limiter = MemoryRateLimiter()
+    monkeypatch.setattr(rate_limit, "_rate_limiter", limiter)
+    ip_rate, email_rate = RateLimit(3, 60), RateLimit(1, 60)
+
+    await check_rate_limits(("ip", "a", ip_rate), ("email", "x", email_rate))
+    # отклоненные по email запросы не учитываются в лимите адреса
+    for _ in range(5):
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            await check_rate_limits(("ip", "a", ip_rate), ("email", "x", email_rate))
+        assert exc_info.value.scope == "email"
+    await check_rate_limits(("ip", "a", ip_rate), ("email", "y", email_rate))
+    await check_rate_limits(("ip", "a", ip_rate), ("email", "z", email_rate))
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await check_rate_limits(("ip", "a", ip_rate), ("email", "w", email_rate))
+    assert exc_info.value.scope == "ip"
+
+@pytest.mark.asyncio
+async def test_login_rate_limited(monkeypatch, test_user, test_session):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_LOGIN_EMAIL", RateLimit(2, 60))
+    app.dependency_overrides[get_session] = lambda: test_session
+    form_data = {"username": "test@example.com", "password": "wrong"}
+
+    statuses = [client.post('/login', data=form_data).status_code for _ in range(3)]
+    assert statuses == [401, 401, 429]
+
+    response = client.post('/login', data={"username": "TEST@example.com", "password": "Passw!@#ord123!"})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+    app.dependency_overrides.clear()
+
+@pytest.mark.asyncio
+async def test_signup_rate_limited(monkeypatch, test_session):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_SIGNUP_IP", RateLimit(1, 60))
+    app.dependency_overrides[get_session] = lambda: test_session
+    user_data = {"username": "user", "email": "first@example.com", "password": "Passw!@#ord123!"}
+
+    assert client.post('/signup', json=user_data).status_code == 200
+    response = client.post('/signup', json={**user_data, "email": "second@example.com"})
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
+    app.dependency_overrides.clear()
@@ -3,14 +3,19 @@ import pytest
 from fastapi.testclient import TestClient
 from app.main import app, auth_router
 from sqlmodel import Session
-from app.models.auth import UserAuthModel, CreateUserModel, TokenModel
+from app.models.auth import UserAuthModel, CreateUserModel, TokenModel, UserClaims
 from sqlalchemy import select
+from app import db
 from app.db import get_session
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
 from app.services.hashers import get_password
-from app.services.auth import current_user, login
-from app.services.tokens import get_refresh_token, decode_access_token
+from app.services.auth import current_user, current_user_claims, login
+from app.services.permissions import ALL_PERMISSIONS
+from app.services.tokens import get_refresh_token, decode_access_token, get_refresh_token_id
 from fastapi.security import OAuth2PasswordRequestForm
 from app.services.roles import require_role
+from app.services.token_store import get_token_store
 
 app.include_router(auth_router)
 
@@ -42,6 +47,24 @@ async def test_signup(test_user, test_session): # test_user добавлен д
 
     app.dependency_overrides.clear()
 
+@pytest.mark.asyncio
+async def test_signup_duplicate_email(test_user, test_session):
+    app.dependency_overrides[get_session] = lambda: test_session
+    user_data = {
+        "username": "testuser",
+        "email": "Test@Example.com",
+        "password": "Passw!@#ord123!"
+    }
+
+    # email уникален без учета регистра
+    response = client.post('/signup', json=user_data)
+    assert response.status_code == 409
+
+    # вход с email в другом регистре
+    response = client.post('/login', data={"username": "TEST@example.com", "password": "Passw!@#ord123!"})
+    assert response.status_code == 200
+    app.dependency_overrides.clear()
+
 @pytest.mark.asyncio
 async def test_login(test_user, test_session):
     app.dependency_overrides[get_session] = lambda: test_session
@@ -74,12 +97,9 @@ async def test_get_myself_info(test_user, test_current_user):
 @pytest.mark.asyncio
 async def test_refresh_token_response(test_current_user, test_session):
     app.dependency_overrides[get_session] = lambda: test_session
-    statement = select(TokenModel).where(TokenModel.user_id == test_current_user.id)
-    db_token = await test_session.execute(statement)
-    result = db_token.scalar_one_or_none()
-    app.dependency_overrides[get_refresh_token] = lambda: result.token
-
-    assert result is not None
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    refresh_token = (await login(form_data=form_data, db=test_session))['refresh_token']
+    app.dependency_overrides[get_refresh_token] = lambda: refresh_token
 
     response = client.post('/refresh_token')
     assert response.status_code == 200
@@ -87,21 +107,25 @@ async def test_refresh_token_response(test_current_user, test_session):
     response_data = response.json()
     # возвращает access_token в котором access_token и token_type
     assert decode_access_token(response_data['access_token']['access_token'])['sub'] == test_current_user.email
+    # новый refresh токен передается только в cookie
+    assert 'refresh_token' not in response_data['access_token']
+    assert response.cookies['refresh_token'] != refresh_token
 
 @pytest.mark.asyncio
 async def test_logout_response(test_current_user, test_session):
     app.dependency_overrides[get_session] = lambda: test_session
-    statement = select(TokenModel).where(TokenModel.user_id == test_current_user.id)
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    refresh_token = (await login(form_data=form_data, db=test_session))['refresh_token']
+    app.dependency_overrides[get_refresh_token] = lambda: refresh_token
+    statement = select(TokenModel).where(TokenModel.token_hash == get_refresh_token_id(refresh_token))
     db_token = await test_session.execute(statement)
     result = db_token.scalar_one_or_none()
-    app.dependency_overrides[get_refresh_token] = lambda: result.token
     # проверяем что токен активен
     assert result.invalidated == False
 
     response = client.post('/logout')
     assert response.status_code == 200
     
-    statement = select(TokenModel).where(TokenModel.user_id == test_current_user.id)
     db_token = await test_session.execute(statement)
     result = db_token.scalar_one_or_none()
     # проверяем что токен неактивен
@@ -114,16 +138,18 @@ async def test_logout_response(test_current_user, test_session):
 async def test_logout_all_response(test_session, test_current_user):
     app.dependency_overrides[get_session] = lambda: test_session
     app.dependency_overrides[current_user] = lambda: test_current_user
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    refresh_tokens = [(await login(form_data=form_data, db=test_session))['refresh_token'] for _ in range(2)]
 
     response = client.post('/logout_all')
     assert response.status_code == 200
 
-    statement = select(TokenModel).where(TokenModel.user_id == test_current_user.id)
-    refresh_token = await test_session.execute(statement)
-    result = refresh_token.scalars().all()
     # првоеряем что все токены невалидные
-    for token in result:
-        assert token.invalidated == True
+    for refresh_token in refresh_tokens:
+        assert await get_token_store().get_user_id(get_refresh_token_id(refresh_token), test_session) is None
+    # новый вход после выхода на всех устройствах работает
+    refresh_token = (await login(form_data=form_data, db=test_session))['refresh_token']
+    assert await get_token_store().get_user_id(get_refresh_token_id(refresh_token), test_session) == test_current_user.id
 
     response_data = response.json()
     assert response_data['message'] == 'Logged out from all devices successfully'
@@ -138,9 +164,20 @@ async def test_change_password(test_session, test_current_user):
         'new_password': 'newPassword!@32#'
     }
 
+    # копия пользователя со старым хэшем, как в кэше другого воркера или на отстающей реплике
+    stale_user = UserAuthModel(
+        id=test_current_user.id, email=test_current_user.email, username=test_current_user.username,
+        password=test_current_user.password,
+    )
     response = client.post('/change_password', json=password_data)
     assert response.status_code == 200
 
+    # старый пароль не принимается, даже если current_user содержит старый хэш
+    app.dependency_overrides[current_user] = lambda: stale_user
+    response = client.post('/change_password', json={**password_data, 'new_password': 'otherPassword!@32#'})
+    assert response.status_code == 400
+    app.dependency_overrides.clear()
+
 @pytest.mark.asyncio
 async def test_admin_success(roles, test_session, test_current_user):
     app.dependency_overrides[current_user] = lambda: test_current_user
@@ -167,4 +204,57 @@ async def test_admin_raise(roles, test_session, test_current_user):
 async def test_admin_none_role(roles, test_session, test_current_user):
     app.dependency_overrides[current_user] = lambda: test_current_user
     response = client.post('/admin')
-    assert response.status_code == 403
\ No newline at end of file
+    assert response.status_code == 403
+
+
+def test_pool_stats_response():
+    # без токена статистика пула недоступна
+    assert client.get('/health/pool').status_code == 401
+
+    app.dependency_overrides[current_user_claims] = lambda: UserClaims(
+        id=1, email="admin@example.com", permissions=int(ALL_PERMISSIONS),
+    )
+    response = client.get('/health/pool')
+    app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert 'pool' in response.json()
+
+@pytest.mark.asyncio
+async def test_instrumented_pool_counts_new_connections(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=db.InstrumentedPool, pool_size=1)
+    for _ in range(2):
+        async with engine.connect() as conn:
+            await conn.execute(select(1))
+    stats = db.pool_stats(engine)
+    await engine.dispose()
+
+    # открытие соединения считается отдельно от ожидания свободного соединения
+    assert stats["checkouts"] == 2
+    assert stats["connects"] == 1
+
+def test_metrics_response():
+    client.get('/')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'http_requests_total{method="GET",route="/",status="200"}' in response.text
+
+@pytest.mark.asyncio
+async def test_login_stage_metrics(test_current_user):
+    response = client.get('/metrics')
+    for stage in ("login.user_lookup", "login.verify_password", "login.token_encode", "login.token_store"):
+        assert f'auth_stage_duration_seconds_count{{stage="{stage}"}}' in response.text
+    assert 'hasher_hash_seconds_count' in response.text
+
+@pytest.mark.asyncio
+async def test_read_session_falls_back_to_primary(monkeypatch, test_session):
+    # реплика, к которой невозможно подключиться
+    replica = create_async_engine("sqlite+aiosqlite:////nonexistent/replica.db")
+    monkeypatch.setattr(db, "replica_engines", [replica])
+    monkeypatch.setattr(db, "replica_sessions", [sessionmaker(replica, class_=AsyncSession)])
+    monkeypatch.setattr(db, "_replica_down_until", {})
+
+    sessions = db.get_read_session(primary=test_session)
+    assert await sessions.__anext__() is test_session
+    # недоступная реплика временно исключается из списка
+    assert db._replica_order() == []
+    await sessions.aclose()
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+
+from app.models.jobs import JobRunModel
+from app.scheduler import CronSchedule, Scheduler
+
+
+def test_cron_next_after():
+    after = datetime(2024, 1, 1, 10, 7, 30, tzinfo=timezone.utc)  # понедельник
+
+    assert CronSchedule("*/15 * * * *").next_after(after) == datetime(2024, 1, 1, 10, 15, tzinfo=timezone.utc)
+    assert CronSchedule("0 3 * * *").next_after(after) == datetime(2024, 1, 2, 3, 0, tzinfo=timezone.utc)
+    # воскресенье
+    assert CronSchedule("30 2 * * 0").next_after(after) == datetime(2024, 1, 7, 2, 30, tzinfo=timezone.utc)
+    assert CronSchedule("0 0 29 2 *").next_after(after) == datetime(2024, 2, 29, 0, 0, tzinfo=timezone.utc)
+    with pytest.raises(ValueError):
+        CronSchedule("61 * * * *")
+
+@pytest.mark.asyncio
+async def test_scheduler_overlap_and_timeout():
+    scheduler = Scheduler(persist=False)
+    started = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(10)
+
+    job = scheduler.add_job("slow", slow, interval=60, max_runtime=0.05)
+    first = asyncio.create_task(scheduler.run_job(job))
+    await started.wait()
+
+    # пока задача выполняется, повторный запуск пропускается
+    assert await scheduler.run_job(job) == "skipped"
+    assert await first == "timeout"
+    assert job.running == False
+    assert job.next_run_at > datetime.now(timezone.utc) + timedelta(seconds=59)
+
+@pytest.mark.asyncio
+async def test_scheduler_persists_last_run(test_session, test_session_factory):
+    session_factory = test_session_factory
+    runs = []
+
+    async def job():
+        runs.append(datetime.now(timezone.utc))
+
+    scheduler = Scheduler(session_factory)
+    scheduler.add_job("cleanup", job, interval=3600)
+    task = asyncio.create_task(scheduler.run())
+    # ждем, пока результат запуска будет сохранен
+    for _ in range(200):
+        async with session_factory() as session:
+            run = await session.get(JobRunModel, "cleanup")
+        if run is not None and run.last_status == "ok":
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert len(runs) == 1
+    assert run.last_status == "ok"
+
+    # после перезапуска задача не выполняется сразу, а ждет интервал от прошлого запуска
+    restarted = Scheduler(session_factory)
+    restarted.add_job("cleanup", job, interval=3600)
+    await restarted.load_state()
+    assert restarted.jobs["cleanup"].next_run_at > datetime.now(timezone.utc) + timedelta(minutes=59)
@@ -0,0 +1,110 @@
+import pytest
+from datetime import timedelta
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from fastapi.security import OAuth2PasswordRequestForm
+
+from app.main import app
+from app.db import get_session
+from app.models.auth import UserClaims
+from app.models.sessions import SessionModel
+from app.services.auth import login, current_user_claims
+from app.services.sessions import SessionActivity, session_activity
+from app.services.tokens import refresh_access_token, decode_refresh_token, get_refresh_token_id
+from app.services.token_store import get_token_store
+
+client = TestClient(app)
+
+
+async def login_with_device(test_session, device: str) -> str:
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    client = {"device": device, "ip": "10.0.0.1", "user_agent": "pytest"}
+    return (await login(form_data=form_data, db=test_session, client=client))['refresh_token']
+
+
+@pytest.mark.asyncio
+async def test_sessions_list_and_revoke(test_user, test_session):
+    app.dependency_overrides[get_session] = lambda: test_session
+    app.dependency_overrides[current_user_claims] = lambda: UserClaims(id=test_user.id, email=test_user.email)
+    tokens = [await login_with_device(test_session, f"device {i}") for i in range(3)]
+
+    # три сессии по две на страницу
+    response = client.get('/sessions', params={"limit": 2})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert len(first_page["sessions"]) == 2
+    response = client.get('/sessions', params={"limit": 2, "cursor": first_page["next_cursor"]})
+    second_page = response.json()
+    assert len(second_page["sessions"]) == 1
+    assert second_page["next_cursor"] is None
+    sessions = first_page["sessions"] + second_page["sessions"]
+    assert {item["device"] for item in sessions} == {"device 0", "device 1", "device 2"}
+
+    assert client.get('/sessions', params={"cursor": "broken"}).status_code == 400
+
+    # завершение сессии отзывает ее токены, остальные сессии продолжают работать
+    session_id = decode_refresh_token(tokens[0])["sid"]
+    assert client.delete(f'/sessions/{session_id}').status_code == 200
+    assert await get_token_store().get_user_id(get_refresh_token_id(tokens[0]), test_session) is None
+    assert await get_token_store().get_user_id(get_refresh_token_id(tokens[1]), test_session) == test_user.id
+    assert len(client.get('/sessions').json()["sessions"]) == 2
+
+    # чужую или уже завершенную сессию завершить нельзя
+    assert client.delete(f'/sessions/{session_id}').status_code == 404
+    app.dependency_overrides[current_user_claims] = lambda: UserClaims(id=test_user.id + 1, email="other@example.com")
+    other_id = decode_refresh_token(tokens[1])["sid"]
+    assert client.delete(f'/sessions/{other_id}').status_code == 404
+
+    app.dependency_overrides.clear()
+
+@pytest.mark.asyncio
+async def test_session_activity_flush(test_user, test_session, test_session_factory):
+    refresh_token = await login_with_device(test_session, "phone")
+    session_id = decode_refresh_token(refresh_token)["sid"]
+    created = await test_session.get(SessionModel, session_id)
+    created_expires_at = created.expires_at
+
+    # обновление токена не пишет в таблицу сессий, отметка ждет записи в памяти
+    new_refresh_token = (await refresh_access_token(refresh_token, test_session))["refresh_token"]
+    assert decode_refresh_token(new_refresh_token)["sid"] == session_id
+    last_used_at, expires_at = session_activity.pending(session_id)
+    session_activity.discard(session_id)
+
+    activity = SessionActivity(test_session_factory)
+    activity.touch(session_id, expires_at + timedelta(days=1))
+    activity.touch(session_id, expires_at)
+    activity.touch("unknown", None)
+    assert await activity.flush() == 2
+    assert activity.pending(session_id) is None
+
+    await test_session.refresh(created)
+    assert created.expires_at.replace(tzinfo=None) == expires_at.replace(tzinfo=None)
+    assert created.expires_at.replace(tzinfo=None) >= created_expires_at.replace(tzinfo=None)
+
+    # без нового срока действия меняется только время использования
+    activity.touch(session_id)
+    await activity.stop()
+    await test_session.refresh(created)
+    assert created.expires_at.replace(tzinfo=None) == expires_at.replace(tzinfo=None)
+    assert created.last_used_at.replace(tzinfo=None) > last_used_at.replace(tzinfo=None)
+
+    # более старая отметка (например, другого воркера) не перезаписывает записанную
+    written = created.last_used_at
+    activity._pending[session_id] = (last_used_at - timedelta(minutes=1), expires_at - timedelta(days=1))
+    await activity.flush()
+    await test_session.refresh(created)
+    assert created.last_used_at == written
+    assert created.expires_at.replace(tzinfo=None) == expires_at.replace(tzinfo=None)
+
+@pytest.mark.asyncio
+async def test_token_reuse_ends_session(test_user, test_session):
+    refresh_token = await login_with_device(test_session, "phone")
+    session_id = decode_refresh_token(refresh_token)["sid"]
+    await refresh_access_token(refresh_token, test_session)
+    session_activity.discard(session_id)
+
+    # повторное использование замененного токена отзывает семейство и завершает сессию
+    with pytest.raises(HTTPException):
+        await refresh_access_token(refresh_token, test_session)
+    test_session.expunge_all()
+    assert await test_session.get(SessionModel, session_id) is None
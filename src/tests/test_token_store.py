@@ -0,0 +1,367 @@
+import pytest
+from types import SimpleNamespace
+from jose import jwt
+from sqlalchemy import text, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
+
+from app.services.auth import login
+from app.models.auth import TokenModel
+from app.migrations import migrate_refresh_tokens, add_missing_columns, add_missing_indexes
+from app.services.tokens import (
+    refresh_access_token, get_refresh_token_id, get_refresh_token_key, JWT_REFRESH_SECRET_KEY, ALGORITHM,
+)
+from app.services.token_store import (
+    MemoryTokenStore, SQLTokenStore, set_token_store, partition_start, maintain_token_partitions,
+    check_partition_settings,
+)
+
+
+@pytest.fixture(name="memory_store")
+def memory_store_fixture():
+    store = MemoryTokenStore()
+    set_token_store(store)
+    yield store
+    set_token_store(None)
+
+
+@pytest.mark.asyncio
+async def test_memory_store_login_refresh_revoke(memory_store, test_user, test_session):
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    user = await login(form_data=form_data, db=test_session)
+    token = user['refresh_token']
+
+    token_id = get_refresh_token_id(token)
+    assert await memory_store.get_user_id(token_id, None) == test_user.id
+    new_token = (await refresh_access_token(token, test_session))['refresh_token']
+
+    # старый токен заменен новым
+    assert await memory_store.revoke(token_id, None) == False
+    new_token_id = get_refresh_token_id(new_token)
+    assert await memory_store.revoke(new_token_id, None) == True
+
+    with pytest.raises(HTTPException) as exc_info:
+        await refresh_access_token(new_token, test_session)
+    assert exc_info.value.detail == 'Refresh token expired or not found'
+
+@pytest.mark.asyncio
+async def test_memory_store_revoke_all_and_cleanup(memory_store):
+    now = datetime.now(timezone.utc)
+    await memory_store.add(b"a", 1, now + timedelta(days=1), None)
+    await memory_store.add(b"b", 1, now + timedelta(days=1), None)
+    await memory_store.add(b"expired", 2, now - timedelta(seconds=1), None)
+
+    await memory_store.revoke_all(1, None)
+
+    assert await memory_store.get_user_id(b"a", None) is None
+    assert await memory_store.get_user_id(b"b", None) is None
+    assert await memory_store.cleanup() == 1
+
+@pytest.mark.asyncio
+async def test_sql_store_ignores_revoked_tokens(test_user, test_session):
+    store = SQLTokenStore()
+    token_id = b"x" * 32
+    await store.add(token_id, test_user.id, datetime.now(timezone.utc) + timedelta(days=1), test_session)
+
+    assert await store.get_user_id(token_id, test_session) == test_user.id
+    assert await store.revoke(token_id, test_session) == True
+    assert await store.get_user_id(token_id, test_session) is None
+
+@pytest.mark.asyncio
+async def test_migrate_legacy_refresh_tokens(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+    # токен в старом формате, без jti
+    legacy_token = jwt.encode(
+        {"exp": datetime.now(timezone.utc) + timedelta(days=1), "sub": "test@example.com"},
+        JWT_REFRESH_SECRET_KEY, ALGORITHM,
+    )
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE tokenmodel (id INTEGER PRIMARY KEY, token VARCHAR, user_id INTEGER, invalidated BOOLEAN)"
+        ))
+        await conn.execute(text("CREATE INDEX ix_tokenmodel_token ON tokenmodel (token)"))
+        await conn.execute(text("CREATE INDEX ix_tokenmodel_user_id ON tokenmodel (user_id)"))
+        await conn.execute(
+            text("INSERT INTO tokenmodel (token, user_id, invalidated) VALUES (:token, 1, 0), (:token, 1, 0)"),
+            {"token": legacy_token},
+        )
+
+    # вторая копия токена не вставляется и не считается
+    assert await migrate_refresh_tokens(engine, batch_size=1) == 1
+
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(TokenModel.token_hash, TokenModel.user_id))).all()
+    await engine.dispose()
+
+    assert rows == [(get_refresh_token_id(legacy_token), 1)]
+
+@pytest.mark.asyncio
+async def test_sql_store_cleanup_in_batches(test_user, test_session):
+    now = datetime.now(timezone.utc)
+    test_session.add_all([
+        TokenModel(token_hash=b"1" * 32, user_id=test_user.id, expires_at=now + timedelta(days=1)),
+        TokenModel(token_hash=b"2" * 32, user_id=test_user.id, expires_at=now + timedelta(days=1), invalidated=True),
+        TokenModel(token_hash=b"3" * 32, user_id=test_user.id, expires_at=now - timedelta(seconds=1)),
+    ])
+    await test_session.commit()
+
+    store = SQLTokenStore(engine=test_session.bind)
+    assert await store.cleanup(batch_size=1) == 2
+
+    result = await test_session.execute(select(TokenModel.token_hash))
+    assert result.scalars().all() == [b"1" * 32]
+
+@pytest.mark.asyncio
+async def test_sql_store_revoke_all_and_cleanup(test_user, test_session):
+    store = SQLTokenStore(engine=test_session.bind)
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await store.add(b"1" * 32, test_user.id, expires_at, test_session)
+    await store.add(b"2" * 32, test_user.id, expires_at, test_session)
+
+    await store.revoke_all(test_user.id, test_session)
+
+    assert await store.get_user_id(b"1" * 32, test_session) is None
+    assert await store.get_user_id(b"2" * 32, test_session) is None
+    # токены, выданные до выхода на всех устройствах, удаляются очисткой
+    assert await store.cleanup() == 2
+
+@pytest.mark.asyncio
+async def test_add_missing_columns(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE userauthmodel (id INTEGER PRIMARY KEY, username VARCHAR, email VARCHAR, password VARCHAR, "
+            "is_active BOOLEAN, is_superuser BOOLEAN, role_id INTEGER)"
+        ))
+        # таблица токенов до появления issued_at и семейств
+        await conn.execute(text(
+            "CREATE TABLE tokenmodel (token_hash BLOB PRIMARY KEY, user_id INTEGER, expires_at DATETIME, invalidated BOOLEAN)"
+        ))
+        await conn.execute(text("INSERT INTO tokenmodel VALUES (x'00', 1, '2030-01-01 00:00:00', 0)"))
+
+    added = await add_missing_columns(engine)
+    created = await add_missing_indexes(engine)
+    async with engine.connect() as conn:
+        issued_at = (await conn.execute(select(TokenModel.issued_at))).scalar_one()
+    await engine.dispose()
+
+    assert "userauthmodel.token_version" in added
+    assert "userauthmodel.tokens_valid_after" in added
+    assert "tokenmodel.issued_at" in added
+    assert "tokenmodel.family_id" in added
+    assert "tokenmodel.rotated" in added
+    assert issued_at is not None
+    assert "ux_userauthmodel_email_lower" in created
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("store_class", [SQLTokenStore, MemoryTokenStore])
+async def test_rotation_reuse_revokes_family(store_class, test_user, test_session):
+    store = store_class()
+    set_token_store(store)
+    try:
+        form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+        first = (await login(form_data=form_data, db=test_session))['refresh_token']
+        second = (await refresh_access_token(first, test_session))['refresh_token']
+        third = (await refresh_access_token(second, test_session))['refresh_token']
+        assert await store.get_user_id(get_refresh_token_id(third), test_session) == test_user.id
+
+        # повторное использование замененного токена отзывает все семейство
+        with pytest.raises(HTTPException):
+            await refresh_access_token(first, test_session)
+        assert await store.get_user_id(get_refresh_token_id(third), test_session) is None
+        with pytest.raises(HTTPException):
+            await refresh_access_token(third, test_session)
+    finally:
+        set_token_store(None)
+
+@pytest.mark.asyncio
+async def test_sql_rotation_keeps_other_families(test_user, test_session):
+    store = SQLTokenStore()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await store.add(b"a" * 32, test_user.id, expires_at, test_session)
+    await store.add(b"b" * 32, test_user.id, expires_at, test_session)
+
+    assert await store.rotate(b"a" * 32, b"c" * 32, expires_at, test_session) == test_user.id
+    assert await store.rotate(b"a" * 32, b"d" * 32, expires_at, test_session) is None
+
+    assert await store.get_user_id(b"c" * 32, test_session) is None
+    assert await store.get_user_id(b"b" * 32, test_session) == test_user.id
+
+@pytest.mark.asyncio
+async def test_sql_lookup_by_expiry(test_user, test_session):
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    token = (await login(form_data=form_data, db=test_session))['refresh_token']
+    token_id, token_expires_at = get_refresh_token_key(token)
+    store = SQLTokenStore()
+
+    # срок из exp токена совпадает со сроком в таблице
+    assert await store.get_user_id(token_id, test_session, token_expires_at=token_expires_at) == test_user.id
+    assert await store.get_user_id(token_id, test_session, token_expires_at=token_expires_at + timedelta(seconds=1)) is None
+    assert await store.revoke(token_id, test_session, token_expires_at=token_expires_at) == True
+
+
+class FakePartitionConnection:
+    """
+    Выполняемые запросы записываются, список секций отдается из partitions
+    """
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        sql = str(statement)
+        self.statements.append(sql)
+        if "pg_inherits" in sql:
+            return FakeResult(self.partitions + ["tokenmodel_default"])
+        if "to_regclass" in sql:
+            return FakeResult([False])
+        return FakeResult([0])
+
+class FakeResult:
+    def __init__(self, values):
+        self.values = values
+        self.rowcount = 0
+
+    def scalars(self):
+        return iter(self.values)
+
+    def scalar(self):
+        return self.values[0]
+
+def test_check_partition_settings():
+    check_partition_settings(timedelta(days=7), "day", ahead_days=14)
+    with pytest.raises(ValueError):
+        check_partition_settings(timedelta(days=7), "day", ahead_days=7)
+    with pytest.raises(ValueError):
+        check_partition_settings(timedelta(days=7), "month", ahead_days=14)
+
+def test_partition_start():
+    moment = datetime(2024, 1, 3, 15, 30, tzinfo=timezone.utc)  # среда
+    assert partition_start(moment, "day") == datetime(2024, 1, 3, tzinfo=timezone.utc)
+    assert partition_start(moment, "week") == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+@pytest.mark.asyncio
+async def test_maintain_token_partitions():
+    conn = FakePartitionConnection(["tokenmodel_p20240101_20240102", "tokenmodel_p20240102_20240103"])
+    now = datetime(2024, 1, 2, 12, 0, tzinfo=timezone.utc)
+
+    created, dropped, _ = await maintain_token_partitions(conn, now, period="day", ahead_days=3)
+
+    # секция за 1 января полностью истекла, текущая уже есть, создаются следующие до now + 3 дня
+    assert dropped == ["tokenmodel_p20240101_20240102"]
+    assert created == ["tokenmodel_p20240103_20240104", "tokenmodel_p20240104_20240105", "tokenmodel_p20240105_20240106"]
+    assert any(sql.startswith("DROP TABLE tokenmodel_p20240101_20240102") for sql in conn.statements)
+    assert "CREATE TABLE tokenmodel_default PARTITION OF tokenmodel DEFAULT" in conn.statements
+    assert "ALTER TABLE tokenmodel ATTACH PARTITION tokenmodel_p20240103_20240104 FOR VALUES FROM " \
+           "('2024-01-03T00:00:00+00:00') TO ('2024-01-04T00:00:00+00:00')" in conn.statements
+    # значение lock_timeout передается параметром, а не подставляется в текст запроса
+    assert conn.statements[0] == "SELECT set_config('lock_timeout', :value, true)"
+
+    # при переходе на недельные секции новая секция начинается после существующих дневных
+    conn = FakePartitionConnection(["tokenmodel_p20240102_20240103"])
+    created, _, _ = await maintain_token_partitions(conn, now, period="week", ahead_days=7)
+    assert created == ["tokenmodel_p20240103_20240108", "tokenmodel_p20240108_20240115"]
+
+@pytest.mark.asyncio
+async def test_sql_cleanup_keeps_only_rotated_tokens(test_user, test_session):
+    store = SQLTokenStore(engine=test_session.bind)
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await store.add(b"a" * 32, test_user.id, expires_at, test_session)
+    await store.add(b"b" * 32, test_user.id, expires_at, test_session)
+    assert await store.rotate(b"a" * 32, b"c" * 32, expires_at, test_session) == test_user.id
+
+    # токен после выхода удаляется, замененный остается для обнаружения повторного использования
+    assert await store.revoke(b"b" * 32, test_session) == True
+    assert await store.cleanup() == 1
+    result = await test_session.execute(select(TokenModel.token_hash).order_by(TokenModel.token_hash))
+    assert result.scalars().all() == [b"a" * 32, b"c" * 32]
+    assert await store.rotate(b"a" * 32, b"d" * 32, expires_at, test_session) is None
+    assert await store.get_user_id(b"c" * 32, test_session) is None
+
+
+class RecordingPostgresSession:
+    """
+    Сессия, которая не выполняет запросы, а сохраняет их, с диалектом PostgreSQL
+    """
+    def __init__(self, row):
+        self.bind = SimpleNamespace(dialect=postgresql.dialect())
+        self.row = row
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        self.statements.append(statement)
+        return SimpleNamespace(one=lambda: self.row)
+
+    async def commit(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_sql_rotation_postgres_single_statement():
+    db = RecordingPostgresSession(SimpleNamespace(
+        user_id=1, revoked=0, is_active=True, is_superuser=False, token_version=0, role_id=None, role=None,
+    ))
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+
+    assert await SQLTokenStore().rotate(b"a" * 32, b"b" * 32, expires_at, db) == 1
+
+    # замена, выдача нового токена и отзыв семейства - один запрос с изменяющими CTE
+    assert len(db.statements) == 1
+    sql = " ".join(str(db.statements[0].compile(dialect=postgresql.dialect())).split())
+    assert 'WITH "old" AS (UPDATE tokenmodel SET invalidated=' in sql
+    assert "rotated=" in sql
+    assert '"new" AS (INSERT INTO tokenmodel (token_hash, user_id, family_id, issued_at, expires_at, invalidated, rotated)' in sql
+    assert "reused AS (UPDATE tokenmodel SET invalidated=" in sql
+    assert sql.count("RETURNING") == 3
+
+    db = RecordingPostgresSession(SimpleNamespace(user_id=None, revoked=3))
+    assert await SQLTokenStore().rotate(b"a" * 32, b"b" * 32, expires_at, db) is None
+
+@pytest.mark.asyncio
+async def test_sql_rotation_postgres_returns_user_claims():
+    row = SimpleNamespace(
+        user_id=1, revoked=0, is_active=True, is_superuser=False, token_version=2, role_id=3, role="admin",
+    )
+    db = RecordingPostgresSession(row)
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+
+    user_id, user = await SQLTokenStore().rotate_with_user(b"a" * 32, b"b" * 32, expires_at, db)
+
+    # пользователь и роль читаются тем же запросом, что и замена токена
+    assert user_id == 1
+    assert user == {"is_active": True, "is_superuser": False, "token_version": 2, "role_id": 3, "role": "admin"}
+    assert len(db.statements) == 1
+    sql = " ".join(str(db.statements[0].compile(dialect=postgresql.dialect())).split())
+    assert "LEFT OUTER JOIN userauthmodel ON userauthmodel.id = \"new\".user_id" in sql
+    assert "LEFT OUTER JOIN rolemodel ON rolemodel.id = userauthmodel.role_id" in sql
+
+@pytest.mark.asyncio
+async def test_fat_refresh_uses_claims_from_rotation(monkeypatch, test_user, test_session):
+    class ClaimsStore(MemoryTokenStore):
+        async def rotate_with_user(self, token_id, new_token_id, expires_at, db, token_expires_at=None):
+            user_id = await self.rotate(token_id, new_token_id, expires_at, db)
+            return user_id, {"is_active": True, "is_superuser": False, "token_version": 5, "role_id": None, "role": None}
+
+    store = ClaimsStore()
+    set_token_store(store)
+    monkeypatch.setattr("app.services.tokens.ACCESS_TOKEN_MODE", "fat")
+    try:
+        form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+        refresh_token = (await login(form_data=form_data, db=test_session))['refresh_token']
+        statements = []
+        execute = test_session.execute
+        async def counting_execute(statement, *args, **kwargs):
+            statements.append(statement)
+            return await execute(statement, *args, **kwargs)
+        monkeypatch.setattr(test_session, "execute", counting_execute)
+
+        access_token = (await refresh_access_token(refresh_token, test_session))['access_token']
+
+        # отдельный запрос пользователя не выполняется
+        assert statements == []
+        assert jwt.get_unverified_claims(access_token)["ver"] == 5
+    finally:
+        set_token_store(None)
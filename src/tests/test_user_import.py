@@ -0,0 +1,90 @@
+import io
+import json
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+from app.main import app
+from app.db import get_session
+from app.models.auth import UserAuthModel, UserClaims
+from app.services.auth import current_user_claims
+from app.services.hashers import make_password, get_password, hasher_pool
+from app.services.permissions import ALL_PERMISSIONS, Permission
+from app.services.user_import import import_users, read_rows
+
+client = TestClient(app)
+
+
+@pytest.mark.asyncio
+async def test_import_users_report(test_user, test_session):
+    password_hash = make_password("Legacy!pass1")
+    rows = [
+        {"username": "plain", "email": "plain@example.com", "password": "Passw!@#ord123!"},
+        {"username": "legacy", "email": "legacy@example.com", "password_hash": password_hash},
+        {"username": "existing", "email": "test@example.com", "password_hash": password_hash},
+        {"username": "again", "email": "legacy@example.com", "password_hash": password_hash},
+        {"username": "bad", "email": "not-an-email", "password": "Passw!@#ord123!"},
+        {"username": "weak", "email": "weak@example.com", "password": "123"},
+        {"username": "hash", "email": "hash@example.com", "password_hash": "not-a-hash"},
+        {"username": "number", "email": 123, "password": "Passw!@#ord123!"},
+        {"username": 7, "email": "number@example.com", "password": "Passw!@#ord123!"},
+        {"username": "hash number", "email": "number@example.com", "password_hash": 5},
+        {"username": "x" * 101, "email": "long@example.com", "password_hash": password_hash},
+    ]
+    lines = io.StringIO("\n".join(json.dumps(row) for row in rows) + "\n{broken\n")
+
+    progress = []
+    report = await import_users(
+        read_rows(lines, "jsonl"), test_session, batch_size=3, workers=1,
+        on_progress=lambda r: progress.append(r.processed),
+    )
+
+    assert progress == [3, 6, 9, 12]
+    assert report.imported == 2
+    assert report.duplicates == 2
+    assert sorted(line for line, _, _ in report.errors) == [3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
+    assert report.as_dict()["failed"] == 8
+    errors = {line: (email, error) for line, email, error in report.errors}
+    assert errors[8] == (None, "Field email must be a string")
+    assert errors[9] == ("number@example.com", "Field username must be a string")
+    assert errors[10] == ("number@example.com", "Field password_hash must be a string")
+    # username с готовым хэшем проверяется так же, как с открытым паролем
+    assert errors[11] == ("long@example.com", "String should have at most 100 characters")
+
+    users = {
+        user.email: user
+        for user in (await test_session.execute(select(UserAuthModel).where(UserAuthModel.id != test_user.id))).scalars()
+    }
+    assert set(users) == {"plain@example.com", "legacy@example.com"}
+    assert get_password("Passw!@#ord123!", users["plain@example.com"].password) == True
+    assert users["legacy@example.com"].password == password_hash
+
+@pytest.mark.asyncio
+async def test_import_users_endpoint(test_user, test_session):
+    app.dependency_overrides[get_session] = lambda: test_session
+    claims = UserClaims(id=test_user.id, email=test_user.email, is_superuser=True, permissions=int(ALL_PERMISSIONS))
+    app.dependency_overrides[current_user_claims] = lambda: claims
+
+    csv_file = "username,email,password_hash\nlegacy,legacy@example.com,{}\nexisting,test@example.com,{}\n".format(
+        make_password("Legacy!pass1"), make_password("Legacy!pass1"),
+    )
+    response = client.post('/admin/users/import', files={"file": ("users.csv", csv_file, "text/csv")})
+    assert response.status_code == 200
+    assert response.json()["imported"] == 1
+    assert response.json()["errors"] == [{"line": 3, "email": "test@example.com", "error": "Email already exists"}]
+
+    # открытые пароли хэшируются в общем пуле приложения
+    calls = hasher_pool.stats.calls
+    csv_plain = "username,email,password\nplain,plain@example.com,Passw!@#ord123!\n"
+    response = client.post('/admin/users/import', files={"file": ("users.csv", csv_plain, "text/csv")})
+    assert response.json()["imported"] == 1
+    assert hasher_pool.stats.calls == calls + 1
+
+    # без разрешения на управление пользователями импорт запрещен
+    app.dependency_overrides[current_user_claims] = lambda: UserClaims(
+        id=test_user.id, email=test_user.email, permissions=int(Permission.VIEW),
+    )
+    response = client.post('/admin/users/import', files={"file": ("users.csv", csv_file, "text/csv")})
+    assert response.status_code == 403
+
+    app.dependency_overrides.clear()
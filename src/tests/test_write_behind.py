@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select, func
+
+from app.metrics import WRITE_BEHIND_BATCH_SIZE
+from app.models.auth import TokenModel
+from app.models.sessions import SessionModel
+from app.services.auth import login
+from app.services.sessions import new_session
+from app.services.tokens import get_refresh_token_id
+from app.services.token_store import get_token_store
+from app.services.write_behind import WriteBehindQueue, WriteQueueFull
+
+
+@pytest.mark.asyncio
+async def test_login_write_behind(test_user, test_session, test_engine, monkeypatch):
+    writer = WriteBehindQueue(test_engine, window=0.01, max_batch=10)
+    monkeypatch.setattr("app.services.auth.LOGIN_WRITE_BEHIND", True)
+    monkeypatch.setattr("app.services.auth.login_writer", writer)
+    batches = []
+    flush = writer._flush
+    async def counting_flush(batch):
+        batches.append(len(batch))
+        await flush(batch)
+    monkeypatch.setattr(writer, "_flush", counting_flush)
+    observed = []
+    monkeypatch.setattr(WRITE_BEHIND_BATCH_SIZE, "observe", observed.append)
+    await writer.start()
+
+    # строки, пришедшие в окне пачки, записываются одной транзакцией
+    store = get_token_store()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await asyncio.gather(*(
+        writer.write(
+            new_session(str(i), test_user.id, bytes([i]) * 32, expires_at),
+            store.token_model(bytes([i]) * 32, test_user.id, expires_at),
+        )
+        for i in range(3)
+    ))
+    assert batches == [3]
+    # метрика считает входы в коммите, а не строки (сессия и токен на каждый вход)
+    assert observed == [3]
+
+    # токен уже записан к моменту ответа на вход
+    form_data = OAuth2PasswordRequestForm(username="test@example.com", password="Passw!@#ord123!")
+    refresh_token = (await login(form_data=form_data, db=test_session))["refresh_token"]
+    assert batches == [3, 1]
+    assert await store.get_user_id(get_refresh_token_id(refresh_token), test_session) == test_user.id
+    assert (await test_session.execute(select(func.count()).select_from(SessionModel))).scalar() == 4
+    await writer.stop()
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_full_and_stop(test_user, test_session, test_engine):
+    writer = WriteBehindQueue(test_engine, window=0.05, queue_size=2)
+    store = get_token_store()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+    await writer.start()
+
+    # третий вход не помещается в очередь и отклоняется сразу
+    writes = [
+        asyncio.create_task(writer.write(store.token_model(bytes([i]) * 32, test_user.id, expires_at)))
+        for i in range(3)
+    ]
+    await asyncio.sleep(0)
+    assert isinstance(writes[2].exception(), WriteQueueFull)
+    # остановка дожидается записи уже принятых строк
+    await writer.stop()
+    await asyncio.gather(*writes[:2])
+    tokens = (await test_session.execute(select(TokenModel.token_hash))).scalars().all()
+    assert sorted(tokens) == [bytes([0]) * 32, bytes([1]) * 32]
+
+    # после остановки строки записываются сразу
+    await writer.write(store.token_model(bytes([3]) * 32, test_user.id, expires_at))
+    assert await test_session.get(TokenModel, bytes([3]) * 32) is not None